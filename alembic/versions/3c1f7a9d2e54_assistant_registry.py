@@ -0,0 +1,35 @@
+"""Assistant registry
+
+Revision ID: 3c1f7a9d2e54
+Revises: 99a5f334f048
+Create Date: 2026-10-18 10:12:41.503117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c1f7a9d2e54'
+down_revision: Union[str, None] = '99a5f334f048'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('openai_assistants',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('digest', sa.String(), nullable=False, unique=True),
+    sa.Column('openai_id', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.drop_constraint('assistants_openai_id_key', 'assistants', type_='unique')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_unique_constraint('assistants_openai_id_key', 'assistants', ['openai_id'])
+    op.drop_table('openai_assistants')
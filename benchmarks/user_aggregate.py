@@ -0,0 +1,115 @@
+
+
+import time
+import asyncio
+import argparse
+import statistics
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import joinedload
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from testai.config.config_reader import get_config
+from testai.src.interactors.database.structures import User, Mental, Assisstant
+from testai.src.interactors.database.gateways.user import UserDomain, UserGateWay
+from testai.src.interactors.database.repositories.user import UserRepo
+
+# far away from the real telegram ids, the rows are deleted after the run
+FIRST_TG_ID = -1_000_000
+
+
+async def load_joined(session: AsyncSession, tg_id: int):
+    # the read path before the aggregate, one row per assistant hydrated by the orm
+    stmt = select(User).where(User.tg_id == tg_id).options(
+        joinedload(User.assisstants),
+        joinedload(User.mental)
+    )
+
+    result = await session.scalar(stmt)
+
+    return UserRepo._build_user_model(UserDomain(
+        id=result.id,
+        tg_id=result.tg_id,
+        assistans=result.assisstants,
+        mental=result.mental
+    ))
+
+
+async def load_aggregate(session: AsyncSession, tg_id: int):
+    return await UserRepo(user_gateway=UserGateWay(session=session)).get_user_by_tg_id(tg_id)
+
+
+async def seed(sessionmaker: async_sessionmaker, tg_id: int, assistants: int) -> None:
+    async with sessionmaker() as session:
+        user_id = await session.scalar(insert(User).values(tg_id=tg_id).returning(User.id))
+
+        await session.execute(insert(Mental).values(user_id=user_id, temperament="calm", profession="developer"))
+
+        if assistants:
+            await session.execute(insert(Assisstant), [
+                {"user_id": user_id, "openai_id": f"asst_{index}", "name": f"assistant {index}"}
+                for index in range(assistants)
+            ])
+
+        await session.commit()
+
+
+async def cleanup(sessionmaker: async_sessionmaker, tg_ids: list[int]) -> None:
+    async with sessionmaker() as session:
+        user_ids = select(User.id).where(User.tg_id.in_(tg_ids))
+
+        await session.execute(delete(Assisstant).where(Assisstant.user_id.in_(user_ids)))
+        await session.execute(delete(Mental).where(Mental.user_id.in_(user_ids)))
+        await session.execute(delete(User).where(User.tg_id.in_(tg_ids)))
+        await session.commit()
+
+
+async def measure(sessionmaker: async_sessionmaker, load, tg_id: int, iterations: int) -> list[float]:
+    timings = []
+
+    async with sessionmaker() as session:
+        for _ in range(iterations):
+            started = time.perf_counter()
+            await load(session, tg_id)
+            timings.append(time.perf_counter() - started)
+
+            # no identity map reuse between the iterations
+            session.expunge_all()
+
+    return timings
+
+
+async def main(sizes: list[int], iterations: int) -> None:
+    engine = create_async_engine(get_config().get_sqlalchemy_database_url(), pool_size=1)
+    sessionmaker = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+    tg_ids = [FIRST_TG_ID - index for index in range(len(sizes))]
+
+    await cleanup(sessionmaker, tg_ids)
+    for tg_id, size in zip(tg_ids, sizes):
+        await seed(sessionmaker, tg_id, size)
+
+    print(f"{'assistants':>10} {'joined p50':>12} {'aggregate p50':>14} {'speedup':>8}")
+
+    try:
+        for tg_id, size in zip(tg_ids, sizes):
+            joined = await measure(sessionmaker, load_joined, tg_id, iterations)
+            aggregate = await measure(sessionmaker, load_aggregate, tg_id, iterations)
+
+            joined_p50 = statistics.median(joined) * 1000
+            aggregate_p50 = statistics.median(aggregate) * 1000
+
+            print(f"{size:>10} {joined_p50:>10.3f}ms {aggregate_p50:>12.3f}ms {joined_p50 / aggregate_p50:>7.2f}x")
+
+    finally:
+        await cleanup(sessionmaker, tg_ids)
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compares the joined and the json aggregate user reads")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[0, 1, 5, 20, 100, 500])
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.sizes, args.iterations))
@@ -0,0 +1,121 @@
+
+
+import time
+import asyncio
+import argparse
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from testai.config.config_reader import get_config
+from testai.src.interactors.database.structures import User, Mental, Assisstant
+from testai.src.interactors.database.gateways.user import LazyUserGateWay
+from testai.src.interactors.database.gateways.user_asyncpg import AsyncpgUserGateWay, create_user_pool
+
+# far away from the real telegram ids, the rows are deleted after the run
+FIRST_TG_ID = -2_000_000
+
+
+async def seed(sessionmaker: async_sessionmaker, tg_ids: list[int], assistants: int) -> None:
+    async with sessionmaker() as session:
+        user_ids = await session.scalars(
+            insert(User).returning(User.id), [{"tg_id": tg_id} for tg_id in tg_ids]
+        )
+        user_ids = list(user_ids)
+
+        await session.execute(insert(Mental), [
+            {"user_id": user_id, "temperament": "calm", "profession": "developer"} for user_id in user_ids
+        ])
+
+        if assistants:
+            await session.execute(insert(Assisstant), [
+                {"user_id": user_id, "openai_id": f"asst_{index}", "name": f"assistant {index}"}
+                for user_id in user_ids for index in range(assistants)
+            ])
+
+        await session.commit()
+
+
+async def cleanup(sessionmaker: async_sessionmaker, tg_ids: list[int]) -> None:
+    async with sessionmaker() as session:
+        user_ids = select(User.id).where(User.tg_id.in_(tg_ids))
+
+        await session.execute(delete(Assisstant).where(Assisstant.user_id.in_(user_ids)))
+        await session.execute(delete(Mental).where(Mental.user_id.in_(user_ids)))
+        await session.execute(delete(User).where(User.tg_id.in_(tg_ids)))
+        await session.commit()
+
+
+async def throughput(new_gateway, tg_ids: list[int], concurrency: int, duration: float) -> float:
+    done = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker(offset: int):
+        nonlocal done
+        index = offset
+
+        # a gateway per lookup, as the middleware creates one per update
+        while time.perf_counter() < deadline:
+            gateway = new_gateway()
+
+            try:
+                await gateway.get_user_by_tg_id(tg_ids[index % len(tg_ids)])
+
+            finally:
+                await gateway.close()
+
+            index += concurrency
+            done += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker(offset) for offset in range(concurrency)])
+
+    return done / (time.perf_counter() - started)
+
+
+async def main(users: int, assistants: int, concurrency: int, duration: float) -> None:
+    config = get_config()
+
+    engine = create_async_engine(
+        config.get_sqlalchemy_database_url(),
+        pool_size=concurrency,
+        connect_args={"server_settings": {"jit": "off"}}
+    )
+    sessionmaker = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+    pool = await create_user_pool(config.database_url, min_size=concurrency, max_size=concurrency)
+
+    tg_ids = [FIRST_TG_ID - index for index in range(users)]
+
+    await cleanup(sessionmaker, tg_ids)
+    await seed(sessionmaker, tg_ids, assistants)
+
+    try:
+        # one short round for each, so both pools are filled and the statements are prepared
+        await throughput(lambda: LazyUserGateWay(sessionmaker=sessionmaker), tg_ids, concurrency, 1.0)
+        await throughput(lambda: AsyncpgUserGateWay(pool=pool), tg_ids, concurrency, 1.0)
+
+        sqlalchemy_rate = await throughput(
+            lambda: LazyUserGateWay(sessionmaker=sessionmaker), tg_ids, concurrency, duration
+        )
+        asyncpg_rate = await throughput(lambda: AsyncpgUserGateWay(pool=pool), tg_ids, concurrency, duration)
+
+        print(f"{'gateway':>10} {'lookups/s':>12}")
+        print(f"{'sqlalchemy':>10} {sqlalchemy_rate:>12.0f}")
+        print(f"{'asyncpg':>10} {asyncpg_rate:>12.0f}")
+        print(f"speedup {asyncpg_rate / sqlalchemy_rate:.2f}x")
+
+    finally:
+        await cleanup(sessionmaker, tg_ids)
+        await pool.close()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compares the lookups per second of the user gateways")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--assistants", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.users, args.assistants, args.concurrency, args.duration))
@@ -0,0 +1,83 @@
+
+
+import json
+import asyncio
+import logging
+import argparse
+from dataclasses import asdict
+
+from loadtest.harness import LoadTest, Scenario
+from loadtest.latency import Latency
+from loadtest.openai_stub import OpenAILatencies
+from loadtest.report import render
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="drives the bot with scripted users against local openai and telegram stubs"
+    )
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--ramp-up", type=float, default=10.0)
+    parser.add_argument("--voice-turns", type=int, default=3)
+    parser.add_argument("--mental-turns", type=int, default=3)
+    parser.add_argument("--voice-seconds", type=int, default=10)
+    parser.add_argument("--think-time", type=float, default=1.0)
+    parser.add_argument("--reply-sentences", type=int, default=3)
+    parser.add_argument("--step-timeout", type=float, default=120.0)
+
+    # "median" or "median:p99" in seconds
+    defaults = OpenAILatencies()
+    for name in ("transcription", "speech_first_byte", "run_first_token", "run_token", "completion", "api"):
+        value = getattr(defaults, name)
+        parser.add_argument(
+            f"--{name.replace('_', '-')}-latency", type=Latency.parse, default=value, dest=name,
+            metavar="MEDIAN[:P99]"
+        )
+    parser.add_argument(
+        "--telegram-latency", type=Latency.parse, default=Latency(median=0.05, p99=0.3), metavar="MEDIAN[:P99]"
+    )
+
+    parser.add_argument("--coalesce-window", type=float, default=None)
+    parser.add_argument("--json", action="store_true", help="prints the result as json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    scenario = Scenario(
+        users=args.users,
+        ramp_up=args.ramp_up,
+        voice_turns=args.voice_turns,
+        mental_turns=args.mental_turns,
+        voice_seconds=args.voice_seconds,
+        think_time=args.think_time,
+        step_timeout=args.step_timeout,
+        reply_sentences=args.reply_sentences,
+        openai=OpenAILatencies(
+            transcription=args.transcription,
+            speech_first_byte=args.speech_first_byte,
+            run_first_token=args.run_first_token,
+            run_token=args.run_token,
+            completion=args.completion,
+            api=args.api
+        ),
+        telegram=args.telegram_latency
+    )
+
+    config = {}
+    if args.coalesce_window is not None:
+        config["voice_coalesce_window"] = args.coalesce_window
+
+    result = asyncio.run(LoadTest(scenario, config=config).run())
+
+    if args.json:
+        print(json.dumps(asdict(result), indent=2))
+        return
+
+    print(render(result.handlers, result.duration))
+    print(f"failed sessions: {result.failed_sessions} of {scenario.users}")
+    print("openai calls: " + ", ".join(f"{key}={value}" for key, value in sorted(result.openai_calls.items())))
+    print("telegram calls: " + ", ".join(f"{key}={value}" for key, value in sorted(result.telegram_calls.items())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+
+
+import struct
+
+from testai.src.interactors.processing.ogg import END_OF_STREAM, OPUS_RATE, OggPage
+
+# one opus frame of digital silence, the content does not matter to the stubs
+SILENT_FRAME = b"\xf8\xff\xfe"
+FRAMES_PER_PAGE = 50
+
+
+def _page(body: bytes, granule: int, sequence: int, header_type: int, lacing: bytes) -> bytes:
+    return OggPage(
+        header_type=header_type,
+        granule=granule,
+        serial=1,
+        sequence=sequence,
+        lacing=lacing,
+        body=memoryview(body)
+    ).render(sequence=sequence, granule=granule, header_type=header_type)
+
+
+def opus_voice(seconds: int) -> bytes:
+    # a valid ogg/opus stream with a page per second, so it can be split like a real voice
+    head = b"OpusHead" + bytes([1, 1]) + struct.pack("<HIhB", 312, 48000, 0, 0)
+    tags = b"OpusTags" + struct.pack("<I", 0) + struct.pack("<I", 0)
+
+    pages = [
+        _page(head, 0, 0, 0x02, bytes([len(head)])),
+        _page(tags, 0, 1, 0, bytes([len(tags)]))
+    ]
+
+    for second in range(max(1, seconds)):
+        header_type = END_OF_STREAM if second == max(1, seconds) - 1 else 0
+        pages.append(_page(
+            SILENT_FRAME * FRAMES_PER_PAGE,
+            (second + 1) * OPUS_RATE,
+            second + 2,
+            header_type,
+            bytes([len(SILENT_FRAME)] * FRAMES_PER_PAGE)
+        ))
+
+    return b"".join(pages)
@@ -0,0 +1,40 @@
+
+
+import math
+import random
+import asyncio
+from dataclasses import dataclass
+
+# the 99th percentile of the standard normal distribution
+Z_99 = 2.326
+
+
+@dataclass(slots=True, kw_only=True, frozen=True)
+class Latency:
+    # seconds, without a p99 the latency is fixed
+    median: float = 0.0
+    p99: float = 0.0
+
+    @classmethod
+    def parse(cls, value: str) -> "Latency":
+        # "0.5" is a fixed latency, "0.5:2" is lognormal with the median of 0.5 and the p99 of 2 seconds
+        median, _, p99 = value.partition(":")
+
+        return cls(median=float(median), p99=float(p99 or median))
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+
+        if self.p99 <= self.median:
+            return self.median
+
+        sigma = math.log(self.p99 / self.median) / Z_99
+
+        return random.lognormvariate(math.log(self.median), sigma)
+
+    async def sleep(self) -> None:
+        delay = self.sample()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
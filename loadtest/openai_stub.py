@@ -0,0 +1,256 @@
+
+
+import json
+import time
+import asyncio
+import itertools
+from collections import Counter
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+from loadtest.audio import opus_voice
+from loadtest.latency import Latency
+
+MENTAL_RESULT = {"profession": "developer", "temperament": "Sanguine"}
+
+
+@dataclass(slots=True, kw_only=True)
+class OpenAILatencies:
+    transcription: Latency = field(default_factory=lambda: Latency(median=0.8, p99=3.0))
+    speech_first_byte: Latency = field(default_factory=lambda: Latency(median=0.4, p99=1.5))
+    # the time to the first token of a run and then between its tokens
+    run_first_token: Latency = field(default_factory=lambda: Latency(median=1.0, p99=4.0))
+    run_token: Latency = field(default_factory=lambda: Latency(median=0.02, p99=0.1))
+    completion: Latency = field(default_factory=lambda: Latency(median=0.5, p99=2.0))
+    # assistants, threads, messages and cancels
+    api: Latency = field(default_factory=lambda: Latency(median=0.15, p99=0.6))
+
+
+def sse(event: str, data) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+class OpenAIStub:
+    __slots__ = ("_latencies", "_reply_sentences", "_mental_turns", "_ids", "_tool_assistants", "_runs", "calls")
+
+    def __init__(self, latencies: OpenAILatencies, reply_sentences: int = 3, mental_turns: int = 3):
+        self._latencies = latencies
+        self._reply_sentences = reply_sentences
+        # the psychologist calls its function on the answer number mental_turns, the greeting is not counted
+        self._mental_turns = mental_turns
+        self._ids = itertools.count(1)
+        self._tool_assistants: set[str] = set()
+        self._runs: Counter[str] = Counter()
+        self.calls: Counter[str] = Counter()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/audio/translations", self._transcription)
+        app.router.add_post("/v1/audio/transcriptions", self._transcription)
+        app.router.add_post("/v1/audio/speech", self._speech)
+        app.router.add_post("/v1/assistants", self._assistant)
+        app.router.add_post("/v1/threads", self._thread)
+        app.router.add_post("/v1/threads/{thread_id}/messages", self._message)
+        app.router.add_post("/v1/threads/{thread_id}/runs", self._run)
+        app.router.add_post("/v1/threads/{thread_id}/runs/{run_id}/cancel", self._cancel)
+        app.router.add_post("/v1/chat/completions", self._completion)
+
+        return app
+
+    def _id(self, prefix: str) -> str:
+        return f"{prefix}_{next(self._ids)}"
+
+    async def _transcription(self, request: web.Request) -> web.Response:
+        self.calls["transcription"] += 1
+
+        # the upload is read like the real api does before it answers
+        await request.read()
+        await self._latencies.transcription.sleep()
+
+        return web.json_response({"text": f"synthetic voice message {next(self._ids)}"})
+
+    async def _speech(self, request: web.Request) -> web.StreamResponse:
+        self.calls["speech"] += 1
+
+        body = await request.json()
+        await self._latencies.speech_first_byte.sleep()
+
+        response = web.StreamResponse(headers={"Content-Type": "audio/ogg"})
+        await response.prepare(request)
+
+        # about a second of audio per 15 characters, streamed in pages like the real endpoint
+        audio = opus_voice(max(1, len(body.get("input", "")) // 15))
+        for start in range(0, len(audio), 4096):
+            await response.write(audio[start:start + 4096])
+
+        await response.write_eof()
+
+        return response
+
+    async def _assistant(self, request: web.Request) -> web.Response:
+        self.calls["assistant"] += 1
+
+        body = await request.json()
+        await self._latencies.api.sleep()
+
+        assistant_id = self._id("asst")
+        if body.get("tools"):
+            self._tool_assistants.add(assistant_id)
+
+        return web.json_response({
+            "id": assistant_id,
+            "object": "assistant",
+            "created_at": int(time.time()),
+            "name": body.get("name"),
+            "model": body.get("model"),
+            "instructions": body.get("instructions"),
+            "tools": body.get("tools") or [],
+            "metadata": {}
+        })
+
+    async def _thread(self, request: web.Request) -> web.Response:
+        self.calls["thread"] += 1
+        await self._latencies.api.sleep()
+
+        return web.json_response({
+            "id": self._id("thread"),
+            "object": "thread",
+            "created_at": int(time.time()),
+            "metadata": {}
+        })
+
+    async def _message(self, request: web.Request) -> web.Response:
+        self.calls["message"] += 1
+
+        body = await request.json()
+        await self._latencies.api.sleep()
+
+        return web.json_response({
+            "id": self._id("msg"),
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": request.match_info["thread_id"],
+            "role": "user",
+            "content": [{"type": "text", "text": {"value": body.get("content", ""), "annotations": []}}],
+            "metadata": {}
+        })
+
+    def _reply(self, thread_id: str, run: int, psychologist: bool) -> str:
+        # the thread and the run are in the text, so the tts cache does not hide the load
+        if psychologist:
+            return f"Tell me a little more about yourself and your work for {thread_id} at step {run}, please? "
+
+        return "".join(
+            f"This is sentence number {index} of the synthetic answer in {thread_id} for run {run}. "
+            for index in range(1, self._reply_sentences + 1)
+        )
+
+    async def _run(self, request: web.Request) -> web.StreamResponse:
+        self.calls["run"] += 1
+
+        thread_id = request.match_info["thread_id"]
+        body = await request.json()
+
+        run_id = self._id("run")
+        psychologist = body.get("assistant_id") in self._tool_assistants
+        self._runs[thread_id] += 1
+
+        run = {
+            "id": run_id,
+            "object": "thread.run",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "assistant_id": body.get("assistant_id"),
+            "status": "queued",
+            "tools": [],
+            "metadata": {}
+        }
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(sse("thread.run.created", run))
+
+        await self._latencies.run_first_token.sleep()
+
+        if psychologist and self._runs[thread_id] > self._mental_turns:
+            await response.write(sse("thread.run.requires_action", {
+                **run,
+                "status": "requires_action",
+                "required_action": {
+                    "type": "submit_tool_outputs",
+                    "submit_tool_outputs": {
+                        "tool_calls": [{
+                            "id": self._id("call"),
+                            "type": "function",
+                            "function": {"name": "save_value", "arguments": json.dumps(MENTAL_RESULT)}
+                        }]
+                    }
+                }
+            }))
+
+        else:
+            message_id = self._id("msg")
+
+            for word in self._reply(thread_id, self._runs[thread_id], psychologist).split(" "):
+                await response.write(sse("thread.message.delta", {
+                    "id": message_id,
+                    "object": "thread.message.delta",
+                    "delta": {"content": [{"index": 0, "type": "text", "text": {"value": word + " "}}]}
+                }))
+                await self._latencies.run_token.sleep()
+
+            await response.write(sse("thread.run.completed", {**run, "status": "completed"}))
+
+        try:
+            await response.write(b"event: done\ndata: [DONE]\n\n")
+            await response.write_eof()
+
+        except ConnectionResetError:
+            # the client closes the stream right after the function call
+            pass
+
+        return response
+
+    async def _cancel(self, request: web.Request) -> web.Response:
+        self.calls["cancel"] += 1
+        await self._latencies.api.sleep()
+
+        return web.json_response({
+            "id": request.match_info["run_id"],
+            "object": "thread.run",
+            "created_at": int(time.time()),
+            "thread_id": request.match_info["thread_id"],
+            "status": "cancelling",
+            "tools": [],
+            "metadata": {}
+        })
+
+    async def _completion(self, request: web.Request) -> web.StreamResponse:
+        self.calls["completion"] += 1
+
+        body = await request.json()
+        await self._latencies.completion.sleep()
+
+        content = json.dumps({"is_confirm_to_format": True})
+        chunk = {
+            "id": self._id("chatcmpl"),
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model")
+        }
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        for start in range(0, len(content), 8):
+            delta = {"index": 0, "delta": {"role": "assistant", "content": content[start:start + 8]}, "finish_reason": None}
+            await response.write(f"data: {json.dumps({**chunk, 'choices': [delta]})}\n\n".encode())
+            await asyncio.sleep(0)
+
+        stop = {"index": 0, "delta": {}, "finish_reason": "stop"}
+        await response.write(f"data: {json.dumps({**chunk, 'choices': [stop]})}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+
+        return response
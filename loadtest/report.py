@@ -0,0 +1,72 @@
+
+
+import math
+from collections import defaultdict
+from dataclasses import dataclass
+
+
+@dataclass(slots=True, kw_only=True, frozen=True)
+class HandlerStats:
+    name: str
+    count: int
+    errors: int
+    throughput: float
+    p50: float
+    p95: float
+    p99: float
+
+
+def percentile(values: list[float], rank: float) -> float:
+    # nearest rank on sorted values
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, max(0, math.ceil(rank / 100 * len(values)) - 1))]
+
+
+class Recorder:
+    __slots__ = ("_latencies", "_errors")
+
+    def __init__(self):
+        self._latencies: defaultdict[str, list[float]] = defaultdict(list)
+        self._errors: defaultdict[str, int] = defaultdict(int)
+
+    def record(self, name: str, seconds: float) -> None:
+        self._latencies[name].append(seconds)
+
+    def error(self, name: str) -> None:
+        self._errors[name] += 1
+
+    def stats(self, duration: float) -> list[HandlerStats]:
+        stats = []
+
+        for name in sorted(set(self._latencies) | set(self._errors)):
+            values = sorted(self._latencies[name])
+
+            stats.append(HandlerStats(
+                name=name,
+                count=len(values),
+                errors=self._errors[name],
+                throughput=len(values) / duration if duration else 0.0,
+                p50=percentile(values, 50),
+                p95=percentile(values, 95),
+                p99=percentile(values, 99)
+            ))
+
+        return stats
+
+
+def render(stats: list[HandlerStats], duration: float) -> str:
+    lines = [
+        f"{'handler':<18} {'count':>7} {'errors':>7} {'per sec':>9} {'p50':>9} {'p95':>9} {'p99':>9}"
+    ]
+
+    for value in stats:
+        lines.append(
+            f"{value.name:<18} {value.count:>7} {value.errors:>7} {value.throughput:>9.2f} "
+            f"{value.p50:>8.3f}s {value.p95:>8.3f}s {value.p99:>8.3f}s"
+        )
+
+    lines.append(f"finished in {duration:.1f}s")
+
+    return "\n".join(lines)
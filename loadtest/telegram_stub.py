@@ -0,0 +1,132 @@
+
+
+import json
+import time
+import asyncio
+import itertools
+from collections import Counter, defaultdict
+from typing import Any, Callable, Optional
+from dataclasses import dataclass
+
+from aiohttp import web
+
+from loadtest.audio import opus_voice
+from loadtest.latency import Latency
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Load test", "username": "load_test_bot"}
+
+
+@dataclass(slots=True, kw_only=True, frozen=True)
+class TelegramCall:
+    method: str
+    chat_id: Optional[int]
+    params: dict[str, Any]
+    at: float
+    message_id: Optional[int] = None
+
+    @property
+    def text(self) -> str:
+        return self.params.get("text") or self.params.get("caption") or ""
+
+    def callback_data(self, prefix: str) -> list[str]:
+        markup = json.loads(self.params.get("reply_markup") or "{}")
+
+        return [
+            button["callback_data"]
+            for row in markup.get("inline_keyboard", [])
+            for button in row
+            if button.get("callback_data", "").startswith(prefix)
+        ]
+
+
+class TelegramStub:
+    __slots__ = ("_latency", "_voice_seconds", "_calls", "_message_ids", "calls")
+
+    def __init__(self, latency: Latency, voice_seconds: int = 10):
+        self._latency = latency
+        self._voice_seconds = voice_seconds
+        self._calls: defaultdict[int, asyncio.Queue[TelegramCall]] = defaultdict(asyncio.Queue)
+        self._message_ids = itertools.count(1)
+        self.calls: Counter[str] = Counter()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._file)
+
+        return app
+
+    async def expect(
+            self,
+            chat_id: int,
+            method: str,
+            predicate: Callable[[TelegramCall], bool] = lambda call: True,
+            timeout: float = 120.0
+    ) -> TelegramCall:
+        # the calls before the expected one, like the first voices of a reply, are skipped
+        async with asyncio.timeout(timeout):
+            while True:
+                call = await self._calls[chat_id].get()
+
+                if call.method == method and predicate(call):
+                    return call
+
+    def _message(self, chat_id: Optional[int], params: dict[str, Any]) -> dict[str, Any]:
+        message = {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER
+        }
+
+        if "text" in params:
+            message["text"] = params["text"]
+        if "caption" in params:
+            message["caption"] = params["caption"]
+
+        return message
+
+    async def _method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+
+        # both the urlencoded and the multipart requests, the uploaded files are read and dropped
+        form = await request.post()
+        params = {key: value for key, value in form.items() if isinstance(value, str)}
+
+        await self._latency.sleep()
+
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+
+        if method == "getMe":
+            result = BOT_USER
+
+        elif method == "getFile":
+            result = {
+                "file_id": params["file_id"],
+                "file_unique_id": params["file_id"],
+                "file_path": f"voice/{params['file_id']}.ogg"
+            }
+
+        elif method in ("sendMessage", "sendVoice", "editMessageText"):
+            result = self._message(chat_id, params)
+
+        else:
+            result = True
+
+        if chat_id is not None:
+            self._calls[chat_id].put_nowait(TelegramCall(
+                method=method,
+                chat_id=chat_id,
+                params=params,
+                at=time.monotonic(),
+                message_id=result["message_id"] if isinstance(result, dict) else None
+            ))
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def _file(self, request: web.Request) -> web.Response:
+        self.calls["download"] += 1
+        await self._latency.sleep()
+
+        return web.Response(body=opus_voice(self._voice_seconds), content_type="audio/ogg")
@@ -1,5 +1,7 @@
 
 
+from typing import Optional
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -9,6 +11,77 @@ class Config(BaseSettings):
     bot_token: str
     openai_key: str
     database_url: str
+    # other api servers, like a local bot api server or the stubs of the load tests
+    openai_base_url: Optional[str] = None
+    telegram_api_url: Optional[str] = None
+    # the budget of all the connections, split between the shards and between the pools of a shard
+    database_pool_size: int = 50
+    database_max_overflow: int = 30
+    # "sqlalchemy", "asyncpg" or "memory", the driver of the user gateway which serves most of the queries
+    database_driver: str = "sqlalchemy"
+    # the memory driver keeps the users only in the process, a snapshot survives the restarts
+    user_snapshot_path: Optional[str] = None
+    user_snapshot_interval: float = 60.0
+
+    # "polling" or "webhook"
+    bot_mode: str = "polling"
+    webhook_url: Optional[str] = None
+    webhook_path: str = "/webhook"
+    webhook_secret: Optional[str] = None
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    # more than one worker share the port with SO_REUSEPORT
+    webhook_workers: int = 1
+    webhook_max_concurrency: int = 256
+    webhook_max_pending: int = 10_000
+    webhook_max_connections: int = 100
+
+    # the supervisor entry point, updates are spread over the shards by the user id
+    shard_workers: int = 4
+    shard_max_concurrency: int = 256
+    shard_health_interval: float = 5.0
+    shard_health_timeout: float = 30.0
+    shard_polling_timeout: int = 30
+
+    # "postgres" or "memory", the memory storage loses the states on restart,
+    # the postgres one needs the fsm_states table from the migrations
+    fsm_storage: str = "memory"
+    fsm_flush_interval: float = 0.5
+    fsm_state_ttl: int = 7 * 24 * 60 * 60
+
+    stream_voice_replies: bool = True
+    progressive_text_replies: bool = True
+    # seconds of quiet after which the voices of a user are answered together
+    voice_coalesce_window: float = 1.5
+    # the coalesced replies answered at the same time, a new turn waits for a free one in its worker
+    voice_reply_concurrency: int = 64
+
+    # anything but opus is transcoded before it is sent as a voice
+    tts_response_format: str = "opus"
+    tts_cache_memory_bytes: int = 32 * 1024 * 1024
+    tts_cache_dir: Optional[str] = None
+    # the oldest files are removed above this size, every process keeps to it on its own
+    tts_cache_disk_bytes: int = 512 * 1024 * 1024
+
+    stt_cache_ttl: int = 24 * 60 * 60
+    stt_cache_size: int = 10_000
+    # voices longer than this many seconds are transcribed in parallel pieces
+    stt_chunk_threshold: int = 120
+    stt_chunk_length: int = 60
+    stt_max_parallel: int = 4
+
+    user_cache_ttl: int = 5 * 60
+    user_cache_size: int = 10_000
+    # concurrent get-or-create and mental upserts are written by one statement and one commit
+    user_write_batching: bool = False
+    user_write_batch_window: float = 0.005
+    user_write_batch_size: int = 100
+
+    thread_pool_min_size: int = 2
+    thread_pool_max_size: int = 50
+
+    openai_initial_concurrency: int = 8
+    openai_max_concurrency: int = 64
 
     def get_sqlalchemy_database_url(self) -> str:
         return self.database_url.replace("postgresql", "postgresql+asyncpg")
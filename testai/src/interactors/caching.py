@@ -0,0 +1,98 @@
+
+
+import time
+import asyncio
+from dataclasses import dataclass
+from collections import OrderedDict
+from typing import Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass(slots=True, kw_only=True)
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+
+        return self.hits / total if total else 0.0
+
+
+class SingleFlight(Generic[T]):
+    __slots__ = ("_calls", )
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        task = self._calls.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+
+        # shield, so a cancelled caller does not cancel the call for the others
+        return await asyncio.shield(task)
+
+
+class TTLCache(Generic[T]):
+    __slots__ = ("_items", "_ttl", "_max_size", "_stats")
+
+    def __init__(self, ttl: float, max_size: int, stats: Optional[CacheStats] = None):
+        self._items: OrderedDict[Hashable, tuple[float, T]] = OrderedDict()
+        self._ttl = ttl
+        self._max_size = max_size
+        # a subclass of the stats can be given, so the owner adds its own counters
+        self._stats = stats or CacheStats()
+
+    @property
+    def stats(self) -> CacheStats:
+        return self._stats
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: Hashable) -> Optional[T]:
+        item = self._items.get(key)
+
+        if item is None:
+            self._stats.misses += 1
+            return None
+
+        expires_at, value = item
+
+        if expires_at < time.monotonic():
+            del self._items[key]
+
+            self._stats.misses += 1
+            self._stats.evictions += 1
+            return None
+
+        self._items.move_to_end(key)
+        self._stats.hits += 1
+
+        return value
+
+    def set(self, key: Hashable, value: T) -> None:
+        self._items[key] = (time.monotonic() + self._ttl, value)
+        self._items.move_to_end(key)
+
+        while len(self._items) > self._max_size:
+            self._items.popitem(last=False)
+            self._stats.evictions += 1
+
+    def peek(self, key: Hashable) -> Optional[T]:
+        # no expiry check and no stats, for bookkeeping of the owner
+        item = self._items.get(key)
+
+        return item[1] if item is not None else None
+
+    def pop(self, key: Hashable) -> None:
+        self._items.pop(key, None)
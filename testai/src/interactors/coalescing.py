@@ -0,0 +1,95 @@
+
+
+import time
+import asyncio
+import logging
+from contextlib import suppress
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class Coalescer(Generic[T]):
+    __slots__ = ("_window", "_pending", "_deferred", "_last", "_workers", "_active", "_slots", "_closing")
+
+    def __init__(self, window: float = 1.5, max_workers: int = 64):
+        self._window = window
+        self._pending: dict[Hashable, list[T]] = {}
+        # the items of the workers which wait for a slot, they are created when it is taken
+        self._deferred: dict[Hashable, list[Callable[[], T]]] = {}
+        self._last: dict[Hashable, float] = {}
+        self._workers: dict[Hashable, asyncio.Task] = {}
+        self._active: set[Hashable] = set()
+        # the slot is taken by the worker and not by the handler, which holds the lock of the user's state
+        self._slots = asyncio.Semaphore(max_workers)
+        self._closing = asyncio.Event()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._workers
+
+    def submit(self, key: Hashable, create: Callable[[], T], process: Callable[[list[T]], Awaitable[None]]) -> bool:
+        self._last[key] = time.monotonic()
+
+        if key in self._active:
+            # the item starts its own work, like a transcription, right away
+            self._pending.setdefault(key, []).append(create())
+        else:
+            self._deferred.setdefault(key, []).append(create)
+
+        if key in self._workers:
+            # the item joins the batch of the turn which is still pending
+            return False
+
+        # the worker is detached, the handler has to return to let the next message of the user in
+        self._workers[key] = asyncio.create_task(self._work(key, process))
+
+        return True
+
+    async def _wait(self, key: Hashable) -> None:
+        # the batch is closed after the window passed without a new message, or at once on the shutdown
+        while not self._closing.is_set() and (delay := self._last[key] + self._window - time.monotonic()) > 0:
+            with suppress(TimeoutError):
+                await asyncio.wait_for(self._closing.wait(), delay)
+
+    async def _work(self, key: Hashable, process: Callable[[list[T]], Awaitable[None]]) -> None:
+        try:
+            async with self._slots:
+                self._active.add(key)
+                self._pending.setdefault(key, []).extend(create() for create in self._deferred.pop(key, []))
+
+                while True:
+                    await self._wait(key)
+
+                    batch = self._pending.pop(key, None)
+                    if not batch:
+                        return
+
+                    try:
+                        await process(batch)
+
+                    except Exception:
+                        logger.exception("Coalesced batch failed")
+
+        finally:
+            self._workers.pop(key, None)
+            self._active.discard(key)
+            self._last.pop(key, None)
+            self._pending.pop(key, None)
+            self._deferred.pop(key, None)
+
+    async def close(self, timeout: float = 30.0) -> None:
+        self._closing.set()
+
+        workers = list(self._workers.values())
+        if not workers:
+            return
+
+        # the turns in flight are answered, the ones which do not finish in time are cancelled
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+
+        for task in pending:
+            task.cancel()
+
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,113 @@
+
+
+from typing import AsyncIterator, Optional
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from contextlib import asynccontextmanager
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from testai.src.interactors.database.structures import OpenAIAssistant
+
+
+@dataclass(slots=True, kw_only=True)
+class OpenAIAssistantDomain:
+    digest: str
+    openai_id: str
+
+
+class BaseAssistantRegistryGateWay(ABC):
+    @abstractmethod
+    async def get_all(self) -> list[OpenAIAssistantDomain]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def get_by_digest(self, digest: str) -> Optional[OpenAIAssistantDomain]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def add(self, digest: str, openai_id: str) -> OpenAIAssistantDomain:
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def commit(self):
+        raise NotImplementedError()
+
+
+class MemoryAssistantRegistryGateWay(BaseAssistantRegistryGateWay):
+    __slots__ = ("_assistants", )
+
+    def __init__(self):
+        # the registry of the memory driver, one instance lives as long as the process
+        self._assistants: dict[str, OpenAIAssistantDomain] = {}
+
+    async def get_all(self) -> list[OpenAIAssistantDomain]:
+        return list(self._assistants.values())
+
+    async def get_by_digest(self, digest: str) -> Optional[OpenAIAssistantDomain]:
+        return self._assistants.get(digest, None)
+
+    async def add(self, digest: str, openai_id: str) -> OpenAIAssistantDomain:
+        return self._assistants.setdefault(digest, OpenAIAssistantDomain(digest=digest, openai_id=openai_id))
+
+    async def commit(self):
+        pass
+
+
+class AssistantRegistryGateWay(BaseAssistantRegistryGateWay):
+    __slots__ = ("_session", )
+
+    def __init__(self, session: AsyncSession):
+        self._session = session
+
+    async def get_all(self) -> list[OpenAIAssistantDomain]:
+        result = await self._session.scalars(select(OpenAIAssistant))
+
+        return [
+            OpenAIAssistantDomain(digest=value.digest, openai_id=value.openai_id) for value in result
+        ]
+
+    async def get_by_digest(self, digest: str) -> Optional[OpenAIAssistantDomain]:
+        result = await self._session.scalar(
+            select(OpenAIAssistant).where(OpenAIAssistant.digest == digest)
+        )
+
+        if not result:
+            return None
+
+        return OpenAIAssistantDomain(digest=result.digest, openai_id=result.openai_id)
+
+    async def add(self, digest: str, openai_id: str) -> OpenAIAssistantDomain:
+        stmt = insert(OpenAIAssistant).values(
+            digest=digest,
+            openai_id=openai_id
+        ).on_conflict_do_nothing(
+            index_elements=[OpenAIAssistant.digest]
+        ).returning(OpenAIAssistant)
+
+        result = await self._session.scalar(stmt)
+
+        if not result:
+            # another process has registered the same assistant first, its id wins
+            return await self.get_by_digest(digest)
+
+        return OpenAIAssistantDomain(digest=result.digest, openai_id=result.openai_id)
+
+    async def commit(self) -> None:
+        await self._session.commit()
+
+
+@asynccontextmanager
+async def assistant_registry_scope(sessionmaker: async_sessionmaker) -> AsyncIterator[AssistantRegistryGateWay]:
+    async with sessionmaker() as session:
+        yield AssistantRegistryGateWay(session=session)
+
+
+@asynccontextmanager
+async def memory_registry_scope(
+        gateway: MemoryAssistantRegistryGateWay
+) -> AsyncIterator[MemoryAssistantRegistryGateWay]:
+    # for the runs without a database, there is nothing to open or to close
+    yield gateway
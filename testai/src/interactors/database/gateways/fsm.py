@@ -0,0 +1,120 @@
+
+
+from typing import Any, AsyncIterator, Optional
+from abc import ABC, abstractmethod
+from datetime import timedelta
+from dataclasses import dataclass, field
+from contextlib import asynccontextmanager
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from testai.src.interactors.database.structures import FSMState
+
+
+@dataclass(slots=True, kw_only=True)
+class FSMStateDomain:
+    key: str
+    state: Optional[str] = None
+    data: dict[str, Any] = field(default_factory=dict)
+
+
+class BaseFSMGateWay(ABC):
+    @abstractmethod
+    async def get(self, key: str) -> Optional[FSMStateDomain]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def upsert_many(self, states: list[FSMStateDomain]) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def delete_many(self, keys: list[str]) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def delete_expired(self, ttl: float) -> int:
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def commit(self):
+        raise NotImplementedError()
+
+
+class FakeFSMGateWay(BaseFSMGateWay):
+    __slots__ = ("_states", )
+
+    def __init__(self):
+        self._states: dict[str, FSMStateDomain] = {}
+
+    async def get(self, key: str) -> Optional[FSMStateDomain]:
+        return self._states.get(key, None)
+
+    async def upsert_many(self, states: list[FSMStateDomain]) -> None:
+        for state in states:
+            self._states[state.key] = state
+
+    async def delete_many(self, keys: list[str]) -> None:
+        for key in keys:
+            self._states.pop(key, None)
+
+    async def delete_expired(self, ttl: float) -> int:
+        return 0
+
+    async def commit(self):
+        pass
+
+
+class FSMGateWay(BaseFSMGateWay):
+    __slots__ = ("_session", )
+
+    def __init__(self, session: AsyncSession):
+        self._session = session
+
+    async def get(self, key: str) -> Optional[FSMStateDomain]:
+        result = await self._session.scalar(
+            select(FSMState).where(FSMState.key == key)
+        )
+
+        if not result:
+            return None
+
+        return FSMStateDomain(key=result.key, state=result.state, data=result.data)
+
+    async def upsert_many(self, states: list[FSMStateDomain]) -> None:
+        # one multi-row statement for the whole batch
+        stmt = insert(FSMState).values([
+            {"key": state.key, "state": state.state, "data": state.data} for state in states
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[FSMState.key],
+            set_={
+                "state": stmt.excluded.state,
+                "data": stmt.excluded.data,
+                "updated_at": func.now()
+            }
+        )
+
+        await self._session.execute(stmt)
+
+    async def delete_many(self, keys: list[str]) -> None:
+        await self._session.execute(
+            delete(FSMState).where(FSMState.key.in_(keys))
+        )
+
+    async def delete_expired(self, ttl: float) -> int:
+        result = await self._session.execute(
+            delete(FSMState).where(FSMState.updated_at < func.now() - timedelta(seconds=ttl))
+        )
+
+        return result.rowcount
+
+    async def commit(self) -> None:
+        await self._session.commit()
+
+
+@asynccontextmanager
+async def fsm_gateway_scope(sessionmaker: async_sessionmaker) -> AsyncIterator[FSMGateWay]:
+    async with sessionmaker() as session:
+        yield FSMGateWay(session=session)
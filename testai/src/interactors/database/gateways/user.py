@@ -1,16 +1,19 @@
 
 
-from typing import Awaitable, Optional
+import asyncio
+from typing import Any, AsyncContextManager, AsyncIterator, Awaitable, Callable, Hashable, Optional, TypeVar
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from contextlib import asynccontextmanager
 
-from sqlalchemy import select
-from sqlalchemy.orm import joinedload
-from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import CTE, Row, Select, func, literal_column, select, union_all
+from sqlalchemy.dialects.postgresql import JSON, aggregate_order_by, insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
 from testai.src.interactors.database.structures import User, Mental, Assisstant
 
+T = TypeVar("T")
+
 
 @dataclass(slots=True, kw_only=True)
 class AssisstantDomain:
@@ -57,7 +60,7 @@ class BaseUserGateWay(ABC):
         raise NotImplementedError()
 
     @abstractmethod
-    async def add_user_assistants(self, user_id: int, assistant_id: str, assistant_name: str) -> None:
+    async def add_user_assistants(self, user_id: int, assistant_id: str, assistant_name: str) -> UserDomain:
         raise NotImplementedError()
 
     @abstractmethod
@@ -65,7 +68,11 @@ class BaseUserGateWay(ABC):
         raise NotImplementedError()
 
     @abstractmethod
-    async def upsert_user_mental(self, user_id: int, temperament: str, profession: str) -> Mental:
+    async def get_or_create_user(self, tg_id: int) -> UserDomain:
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def upsert_user_mental(self, user_id: int, temperament: str, profession: str) -> UserDomain:
         raise NotImplementedError()
 
     @abstractmethod
@@ -96,25 +103,32 @@ class FakeUserGateWay(BaseUserGateWay):
     async def get_user_assistants(self, user_id: int) -> list[AssisstantDomain]:
         return self._users[user_id].assistans
 
-    async def add_user_assistants(self, user_id: int, assistant_id: str, assistant_name: str) -> None:
+    async def add_user_assistants(self, user_id: int, assistant_id: str, assistant_name: str) -> UserDomain:
         user = self._users[user_id]
 
-        user.assistans.append(AssisstantDomain(id=1, openai_id=assistant_id, name=assistant_name, user_id=user_id))
+        user.assistans.append(AssisstantDomain(
+            id=len(user.assistans) + 1, openai_id=assistant_id, name=assistant_name, user_id=user_id
+        ))
+
+        return user
 
     async def upsert_user(self, tg_id: int) -> UserDomain:
-        if self._users.get(tg_id, None):
+        if not self._users.get(tg_id, None):
             self._users[tg_id] = UserDomain(id=tg_id, tg_id=tg_id, assistans=[])
 
         return self._users[tg_id]
 
-    async def upsert_user_mental(self, user_id: int, temperament: str, profession: str) -> MentalDataDomain:
+    async def get_or_create_user(self, tg_id: int) -> UserDomain:
+        return await self.upsert_user(tg_id)
+
+    async def upsert_user_mental(self, user_id: int, temperament: str, profession: str) -> UserDomain:
         mental = MentalDataDomain(
             id=1, user_id=user_id, temperament=temperament, profession=profession
         )
 
         self._users[user_id].mental = mental
 
-        return mental
+        return self._users[user_id]
 
     async def get_user_unsafe(self, tg_id: int) -> Optional[UserDomain]:
         for i in self._users.values():
@@ -131,58 +145,31 @@ class FakeUserGateWay(BaseUserGateWay):
 
 
 class UserGateWay(BaseUserGateWay):
-    __slots__ = ("_session", )
+    __slots__ = ("_session", "_batcher")
 
-    def __init__(self, session: AsyncSession):
+    def __init__(self, session: AsyncSession, batcher: Optional["UserWriteBatcher"] = None):
         self._session = session
+        # with a batcher the upserts are committed together with the concurrent ones, not in this session
+        self._batcher = batcher
 
     async def get_user_by_tg_id(self, tg_id: int) -> UserDomain:
-        stmt = select(User).where(User.tg_id == tg_id).options(
-            joinedload(User.assisstants),
-            joinedload(User.mental)
-        )
+        user = await self.get_user_unsafe(tg_id)
 
-        result = await self._session.scalar(stmt)
+        if user is None:
+            raise ValueError("Undefined user")
 
-        return UserDomain(
-            id=result.id,
-            tg_id=result.tg_id,
-            assistans=result.assisstants,
-            mental=result.mental
-        )
+        return user
 
     async def get_user_by_id(self, user_id: int) -> UserDomain:
-        stmt = select(User).where(User.id == user_id).options(
-            joinedload(User.assisstants),
-            joinedload(User.mental)
-        )
+        user = await self._aggregate(select(User.id, User.tg_id).where(User.id == user_id))
 
-        result = await self._session.scalar(stmt)
+        if user is None:
+            raise ValueError("Undefined user")
 
-        return UserDomain(
-            id=result.id,
-            tg_id=result.tg_id,
-            assistans=result.assisstants,
-            mental=result.mental
-        )
+        return user
 
     async def get_user_unsafe(self, tg_id: int) -> Optional[UserDomain]:
-        stmt = select(User).where(User.tg_id == tg_id).options(
-            joinedload(User.assisstants),
-            joinedload(User.mental)
-        )
-
-        result = await self._session.scalar(stmt)
-
-        if not result:
-            return None
-
-        return UserDomain(
-            id=result.id,
-            tg_id=result.tg_id,
-            assistans=result.assisstants,
-            mental=result.mental
-        )
+        return await self._aggregate(select(User.id, User.tg_id).where(User.tg_id == tg_id))
 
     async def get_user_assistants(self, user_id: int) -> list[AssisstantDomain]:
         stmt = select(Assisstant).where(Assisstant.user_id == user_id).options()
@@ -198,15 +185,120 @@ class UserGateWay(BaseUserGateWay):
             ) for value in result
         ]
 
-    async def add_user_assistants(self, user_id: int, assistant_id: str, assistant_name: str) -> None:
-        stmt = insert(Assisstant).values(user_id=user_id, openai_id=assistant_id, name=assistant_name)
+    @staticmethod
+    def _aggregate_statement(
+            users: Select,
+            assistants: Optional[CTE] = None,
+            mental: Optional[CTE] = None
+    ) -> Select:
+        # one row per user, a join would repeat the user and the mental for every assistant
+        users = users.subquery()
+
+        # the written rows are not visible to the other parts of the statement, they are taken from the ctes
+        assistant_rows = select(Assisstant.id, Assisstant.user_id, Assisstant.openai_id, Assisstant.name).where(
+            Assisstant.user_id == users.c.id
+        ).correlate(users)
+        if assistants is not None:
+            assistant_rows = union_all(
+                assistant_rows,
+                select(assistants.c.id, assistants.c.user_id, assistants.c.openai_id, assistants.c.name).where(
+                    assistants.c.user_id == users.c.id
+                ).correlate(users)
+            )
+        assistant_rows = assistant_rows.subquery()
+
+        if mental is None:
+            mental_rows = select(Mental.id, Mental.user_id, Mental.temperament, Mental.profession).where(
+                Mental.user_id == users.c.id
+            )
+        else:
+            mental_rows = select(mental.c.id, mental.c.user_id, mental.c.temperament, mental.c.profession).where(
+                mental.c.user_id == users.c.id
+            )
+        mental_rows = mental_rows.correlate(users).subquery()
+
+        return select(
+            users.c.id,
+            users.c.tg_id,
+            select(
+                func.coalesce(
+                    func.json_agg(
+                        aggregate_order_by(
+                            func.json_build_object(
+                                "id", assistant_rows.c.id,
+                                "user_id", assistant_rows.c.user_id,
+                                "openai_id", assistant_rows.c.openai_id,
+                                "name", assistant_rows.c.name
+                            ),
+                            assistant_rows.c.id
+                        )
+                    ),
+                    literal_column("'[]'::json"),
+                    type_=JSON
+                )
+            ).scalar_subquery().label("assistants"),
+            select(
+                func.json_build_object(
+                    "id", mental_rows.c.id,
+                    "user_id", mental_rows.c.user_id,
+                    "temperament", mental_rows.c.temperament,
+                    "profession", mental_rows.c.profession,
+                    type_=JSON
+                )
+            ).scalar_subquery().label("mental")
+        )
+
+    @staticmethod
+    def _user(row: Row) -> UserDomain:
+        return UserDomain(
+            id=row.id,
+            tg_id=row.tg_id,
+            assistans=[AssisstantDomain(**value) for value in row.assistants],
+            mental=MentalDataDomain(**row.mental) if row.mental else None
+        )
+
+    async def _aggregate(
+            self,
+            users: Select,
+            assistants: Optional[CTE] = None,
+            mental: Optional[CTE] = None
+    ) -> Optional[UserDomain]:
+        stmt = self._aggregate_statement(users, assistants=assistants, mental=mental)
 
-        await self._session.execute(stmt)
+        row = (await self._session.execute(stmt)).one_or_none()
+
+        if row is None:
+            return None
+
+        return self._user(row)
+
+    async def _aggregate_all(
+            self,
+            users: Select,
+            assistants: Optional[CTE] = None,
+            mental: Optional[CTE] = None
+    ) -> list[UserDomain]:
+        stmt = self._aggregate_statement(users, assistants=assistants, mental=mental)
+
+        return [self._user(row) for row in await self._session.execute(stmt)]
+
+    async def add_user_assistants(self, user_id: int, assistant_id: str, assistant_name: str) -> UserDomain:
+        assistants = insert(Assisstant).values(
+            user_id=user_id,
+            openai_id=assistant_id,
+            name=assistant_name
+        ).returning(Assisstant.id, Assisstant.user_id, Assisstant.openai_id, Assisstant.name).cte("new_assistant")
+
+        # the insert and the updated user in one round trip
+        return await self._aggregate(
+            select(User.id, User.tg_id).where(User.id == user_id),
+            assistants=assistants
+        )
 
     async def upsert_user(self, tg_id: int) -> UserDomain:
-        # since we have only one argument, do_update is not needed
+        # tg_id is the natural key, a conflict on it means the user exists
         stmt = insert(User).values(tg_id=tg_id).on_conflict_do_update(
-            index_elements=[User.id],
+            index_elements=[User.tg_id],
             set_={
                 "tg_id": tg_id
             }
@@ -219,27 +311,254 @@ class UserGateWay(BaseUserGateWay):
             tg_id=user.tg_id
         )
 
-    async def upsert_user_mental(self, user_id: int, temperament: str, profession: str) -> MentalDataDomain:
-        stmt = insert(Mental).values(
-            user_id=user_id,
-            temperament=temperament,
-            profession=profession
-        ).on_conflict_do_update(
+    async def get_or_create_users(self, tg_ids: list[int]) -> dict[int, UserDomain]:
+        created = insert(User).values([{"tg_id": tg_id} for tg_id in tg_ids]).on_conflict_do_nothing(
+            index_elements=[User.tg_id]
+        ).returning(User.id, User.tg_id).cte("created_users")
+
+        # either the insert returns a new user or the select finds the existing one, never both
+        users = union_all(
+            select(created.c.id, created.c.tg_id),
+            select(User.id, User.tg_id).where(User.tg_id.in_(tg_ids))
+        )
+        found = {user.tg_id: user for user in await self._aggregate_all(select(users.subquery()))}
+
+        for tg_id in tg_ids:
+            if tg_id not in found:
+                # a concurrent insert committed after the statement started, now it is visible
+                found[tg_id] = await self.get_user_by_tg_id(tg_id)
+
+        return found
+
+    async def get_or_create_user(self, tg_id: int) -> UserDomain:
+        if self._batcher is not None:
+            return await self._batcher.get_or_create_user(tg_id)
+
+        return (await self.get_or_create_users([tg_id]))[tg_id]
+
+    async def upsert_user_mentals(self, mentals: list[tuple[int, str, str]]) -> dict[int, UserDomain]:
+        stmt = insert(Mental).values([
+            {"user_id": user_id, "temperament": temperament, "profession": profession}
+            for user_id, temperament, profession in mentals
+        ])
+        mental = stmt.on_conflict_do_update(
             index_elements=[Mental.user_id],
             set_={
-                "temperament": temperament,
-                "profession": profession
+                "temperament": stmt.excluded.temperament,
+                "profession": stmt.excluded.profession
             }
-        ).returning(Mental)
-
-        mental = await self._session.scalar(stmt)
+        ).returning(Mental.id, Mental.user_id, Mental.temperament, Mental.profession).cte("new_mental")
 
-        return MentalDataDomain(
-            id=mental.id,
-            user_id=mental.user_id,
-            temperament=mental.temperament,
-            profession=mental.profession
+        users = await self._aggregate_all(
+            select(User.id, User.tg_id).where(User.id.in_([user_id for user_id, _, _ in mentals])),
+            mental=mental
         )
 
+        return {user.id: user for user in users}
+
+    async def upsert_user_mental(self, user_id: int, temperament: str, profession: str) -> UserDomain:
+        if self._batcher is not None:
+            return await self._batcher.upsert_user_mental(user_id, temperament, profession)
+
+        return (await self.upsert_user_mentals([(user_id, temperament, profession)]))[user_id]
+
     async def commit(self) -> None:
         await self._session.commit()
+
+
+class UserWriteBatcher:
+    __slots__ = ("_gateway_scope", "_window", "_max_rows", "_pending", "_timers", "_tasks")
+
+    def __init__(
+            self,
+            gateway_scope: Callable[[], AsyncContextManager["UserGateWay"]],
+            window: float = 0.005,
+            max_rows: int = 100
+    ):
+        self._gateway_scope = gateway_scope
+        self._window = window
+        self._max_rows = max_rows
+        # per kind of write, the values and the waiters of every key in the next batch
+        self._pending: dict[str, dict[Hashable, tuple[Any, asyncio.Future]]] = {}
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def get_or_create_user(self, tg_id: int) -> UserDomain:
+        return await self._submit("users", tg_id, tg_id)
+
+    async def upsert_user_mental(self, user_id: int, temperament: str, profession: str) -> UserDomain:
+        return await self._submit("mentals", user_id, (user_id, temperament, profession))
+
+    async def _submit(self, kind: str, key: Hashable, values: Any) -> UserDomain:
+        pending = self._pending.setdefault(kind, {})
+
+        if key in pending:
+            # one row can not be upserted twice by a statement, the later values win for both callers
+            future = pending[key][1]
+        else:
+            future = asyncio.get_running_loop().create_future()
+
+        pending[key] = (values, future)
+
+        if len(pending) >= self._max_rows:
+            self._flush(kind)
+
+        elif kind not in self._timers:
+            self._timers[kind] = asyncio.get_running_loop().call_later(self._window, self._flush, kind)
+
+        # shield, a cancelled caller does not take the result from the others
+        return await asyncio.shield(future)
+
+    def _flush(self, kind: str) -> None:
+        timer = self._timers.pop(kind, None)
+        if timer is not None:
+            timer.cancel()
+
+        batch = self._pending.pop(kind, None)
+        if not batch:
+            return
+
+        task = asyncio.create_task(self._write(kind, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write_rows(self, kind: str, values: list[Any]) -> dict[Hashable, UserDomain]:
+        # one transaction and one commit for the whole batch
+        async with self._gateway_scope() as gateway:
+            if kind == "users":
+                users = await gateway.get_or_create_users(values)
+            else:
+                users = await gateway.upsert_user_mentals(values)
+
+            await gateway.commit()
+
+        return users
+
+    async def _write(self, kind: str, batch: dict[Hashable, tuple[Any, asyncio.Future]]) -> None:
+        # the rows are locked in the order of their keys, so two batches in flight can not deadlock
+        items = sorted(batch.items(), key=lambda item: item[0])
+
+        try:
+            users = await self._write_rows(kind, [value for _, (value, _) in items])
+
+        except Exception as e:
+            if len(items) > 1:
+                # one bad row fails the statement, every row is written alone, so only its caller gets the error
+                for key, item in items:
+                    await self._write(kind, {key: item})
+                return
+
+            for _, (_, future) in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for key, (_, future) in items:
+            if not future.done():
+                future.set_result(users[key])
+
+    async def close(self) -> None:
+        for kind in list(self._pending):
+            self._flush(kind)
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class LazyUserGateWay(BaseUserGateWay):
+    __slots__ = ("_sessionmaker", "_batcher", "_session", "_pending", "_lock")
+
+    def __init__(self, sessionmaker: async_sessionmaker, batcher: Optional[UserWriteBatcher] = None):
+        self._sessionmaker = sessionmaker
+        self._batcher = batcher
+        self._session: Optional[AsyncSession] = None
+        # writes which are not committed yet keep the session
+        self._pending = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def active(self) -> bool:
+        return self._session is not None
+
+    async def _call(self, func: Callable[[UserGateWay], Awaitable[T]], write: bool = False) -> T:
+        async with self._lock:
+            # the session and its connection are taken only by the first database call
+            if self._session is None:
+                self._session = self._sessionmaker()
+
+            self._pending = self._pending or write
+
+            try:
+                return await func(UserGateWay(session=self._session))
+
+            finally:
+                if not self._pending:
+                    await self._close()
+
+    async def _close(self) -> None:
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()
+
+    async def get_user_by_tg_id(self, tg_id: int) -> UserDomain:
+        return await self._call(lambda gateway: gateway.get_user_by_tg_id(tg_id))
+
+    async def get_user_by_id(self, user_id: int) -> UserDomain:
+        return await self._call(lambda gateway: gateway.get_user_by_id(user_id))
+
+    async def get_user_unsafe(self, tg_id: int) -> Optional[UserDomain]:
+        return await self._call(lambda gateway: gateway.get_user_unsafe(tg_id))
+
+    async def get_user_assistants(self, user_id: int) -> list[AssisstantDomain]:
+        return await self._call(lambda gateway: gateway.get_user_assistants(user_id))
+
+    async def add_user_assistants(self, user_id: int, assistant_id: str, assistant_name: str) -> UserDomain:
+        return await self._call(
+            lambda gateway: gateway.add_user_assistants(user_id, assistant_id, assistant_name),
+            write=True
+        )
+
+    async def upsert_user(self, tg_id: int) -> UserDomain:
+        return await self._call(lambda gateway: gateway.upsert_user(tg_id), write=True)
+
+    async def get_or_create_user(self, tg_id: int) -> UserDomain:
+        if self._batcher is not None:
+            # the batch has its own connection, this one is not taken at all
+            return await self._batcher.get_or_create_user(tg_id)
+
+        return await self._call(lambda gateway: gateway.get_or_create_user(tg_id), write=True)
+
+    async def upsert_user_mental(self, user_id: int, temperament: str, profession: str) -> UserDomain:
+        if self._batcher is not None:
+            return await self._batcher.upsert_user_mental(user_id, temperament, profession)
+
+        return await self._call(
+            lambda gateway: gateway.upsert_user_mental(user_id, temperament, profession),
+            write=True
+        )
+
+    async def commit(self) -> None:
+        async with self._lock:
+            if self._session is None:
+                return
+
+            try:
+                await self._session.commit()
+
+            finally:
+                self._pending = False
+                await self._close()
+
+    async def close(self) -> None:
+        # uncommitted writes are rolled back by closing the session
+        async with self._lock:
+            self._pending = False
+            await self._close()
+
+
+@asynccontextmanager
+async def user_gateway_scope(
+        sessionmaker: async_sessionmaker,
+        batcher: Optional[UserWriteBatcher] = None
+) -> AsyncIterator[UserGateWay]:
+    async with sessionmaker() as session:
+        yield UserGateWay(session=session, batcher=batcher)
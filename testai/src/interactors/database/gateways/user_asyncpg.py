@@ -0,0 +1,250 @@
+
+
+import json
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+from contextlib import asynccontextmanager
+
+import asyncpg
+from asyncpg.transaction import Transaction
+
+from testai.src.interactors.database.gateways.user import (
+    AssisstantDomain,
+    BaseUserGateWay,
+    MentalDataDomain,
+    UserDomain
+)
+
+T = TypeVar("T")
+
+ASSISTANT_ROWS = "SELECT id, user_id, openai_id, name FROM assistants WHERE user_id = u.id"
+MENTAL_ROWS = "SELECT id, user_id, temperament, profession FROM mental_data WHERE user_id = u.id"
+
+
+def aggregate(users: str, assistants: str = ASSISTANT_ROWS, mental: str = MENTAL_ROWS) -> str:
+    # the same single row aggregate as UserGateWay._aggregate, written out for the prepared statements
+    return f"""
+        SELECT
+            u.id,
+            u.tg_id,
+            (
+                SELECT coalesce(
+                    json_agg(
+                        json_build_object('id', a.id, 'user_id', a.user_id, 'openai_id', a.openai_id, 'name', a.name)
+                        ORDER BY a.id
+                    ),
+                    '[]'::json
+                )
+                FROM ({assistants}) AS a
+            ) AS assistants,
+            (
+                SELECT json_build_object(
+                    'id', m.id, 'user_id', m.user_id, 'temperament', m.temperament, 'profession', m.profession
+                )
+                FROM ({mental}) AS m
+            ) AS mental
+        FROM ({users}) AS u
+    """
+
+
+USER_BY_TG_ID = aggregate("SELECT id, tg_id FROM users WHERE tg_id = $1")
+
+USER_BY_ID = aggregate("SELECT id, tg_id FROM users WHERE id = $1")
+
+USER_ASSISTANTS = "SELECT id, user_id, openai_id, name FROM assistants WHERE user_id = $1 ORDER BY id"
+
+ADD_USER_ASSISTANT = """
+    WITH new_assistant AS (
+        INSERT INTO assistants (user_id, openai_id, name) VALUES ($1, $2, $3)
+        RETURNING id, user_id, openai_id, name
+    )
+""" + aggregate(
+    "SELECT id, tg_id FROM users WHERE id = $1",
+    assistants=ASSISTANT_ROWS + " UNION ALL SELECT id, user_id, openai_id, name FROM new_assistant"
+)
+
+UPSERT_USER = """
+    INSERT INTO users (tg_id) VALUES ($1)
+    ON CONFLICT (tg_id) DO UPDATE SET tg_id = excluded.tg_id
+    RETURNING id, tg_id
+"""
+
+GET_OR_CREATE_USER = """
+    WITH created_user AS (
+        INSERT INTO users (tg_id) VALUES ($1)
+        ON CONFLICT (tg_id) DO NOTHING
+        RETURNING id, tg_id
+    )
+""" + aggregate(
+    "SELECT id, tg_id FROM created_user UNION ALL SELECT id, tg_id FROM users WHERE tg_id = $1"
+)
+
+UPSERT_USER_MENTAL = """
+    WITH new_mental AS (
+        INSERT INTO mental_data (user_id, temperament, profession) VALUES ($1, $2, $3)
+        ON CONFLICT (user_id) DO UPDATE SET temperament = excluded.temperament, profession = excluded.profession
+        RETURNING id, user_id, temperament, profession
+    )
+""" + aggregate(
+    "SELECT id, tg_id FROM users WHERE id = $1",
+    mental="SELECT id, user_id, temperament, profession FROM new_mental"
+)
+
+
+async def _init_connection(connection: asyncpg.Connection) -> None:
+    # the aggregates come as json, they are decoded by the driver and not by every caller
+    await connection.set_type_codec("json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+
+async def create_user_pool(dsn: str, min_size: int = 1, max_size: int = 10) -> asyncpg.Pool:
+    # every connection keeps the statements it has run prepared, so a gateway call is one bind and execute,
+    # the cache of the connection survives the release, the statement objects of asyncpg do not
+    return await asyncpg.create_pool(
+        dsn,
+        min_size=min_size,
+        max_size=max_size,
+        statement_cache_size=128,
+        max_inactive_connection_lifetime=1500,
+        init=_init_connection,
+        server_settings={"jit": "off"}
+    )
+
+
+def _user(record: Optional[asyncpg.Record]) -> Optional[UserDomain]:
+    if record is None:
+        return None
+
+    return UserDomain(
+        id=record["id"],
+        tg_id=record["tg_id"],
+        assistans=[AssisstantDomain(**value) for value in record["assistants"]],
+        mental=MentalDataDomain(**record["mental"]) if record["mental"] else None
+    )
+
+
+class AsyncpgUserGateWay(BaseUserGateWay):
+    __slots__ = ("_pool", "_connection", "_transaction", "_lock")
+
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+        self._connection: Optional[asyncpg.Connection] = None
+        # writes which are not committed yet keep the connection and its transaction
+        self._transaction: Optional[Transaction] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def active(self) -> bool:
+        return self._connection is not None
+
+    async def _call(self, func: Callable[[asyncpg.Connection], Awaitable[T]], write: bool = False) -> T:
+        async with self._lock:
+            # like LazyUserGateWay, a connection is taken only around the database calls
+            if self._connection is None:
+                self._connection = await self._pool.acquire()
+
+            try:
+                if write and self._transaction is None:
+                    self._transaction = self._connection.transaction()
+                    await self._transaction.start()
+
+                return await func(self._connection)
+
+            finally:
+                if self._transaction is None:
+                    await self._release()
+
+    async def _fetchrow(self, query: str, *args, write: bool = False) -> Optional[asyncpg.Record]:
+        return await self._call(lambda connection: connection.fetchrow(query, *args), write=write)
+
+    async def _release(self) -> None:
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            await self._pool.release(connection)
+
+    async def get_user_by_tg_id(self, tg_id: int) -> UserDomain:
+        user = await self.get_user_unsafe(tg_id)
+
+        if user is None:
+            raise ValueError("Undefined user")
+
+        return user
+
+    async def get_user_by_id(self, user_id: int) -> UserDomain:
+        user = _user(await self._fetchrow(USER_BY_ID, user_id))
+
+        if user is None:
+            raise ValueError("Undefined user")
+
+        return user
+
+    async def get_user_unsafe(self, tg_id: int) -> Optional[UserDomain]:
+        return _user(await self._fetchrow(USER_BY_TG_ID, tg_id))
+
+    async def get_user_assistants(self, user_id: int) -> list[AssisstantDomain]:
+        records = await self._call(lambda connection: connection.fetch(USER_ASSISTANTS, user_id))
+
+        return [
+            AssisstantDomain(
+                id=record["id"],
+                user_id=record["user_id"],
+                openai_id=record["openai_id"],
+                name=record["name"]
+            ) for record in records
+        ]
+
+    async def add_user_assistants(self, user_id: int, assistant_id: str, assistant_name: str) -> UserDomain:
+        return _user(await self._fetchrow(ADD_USER_ASSISTANT, user_id, assistant_id, assistant_name, write=True))
+
+    async def upsert_user(self, tg_id: int) -> UserDomain:
+        record = await self._fetchrow(UPSERT_USER, tg_id, write=True)
+
+        return UserDomain(
+            id=record["id"],
+            tg_id=record["tg_id"]
+        )
+
+    async def get_or_create_user(self, tg_id: int) -> UserDomain:
+        user = _user(await self._fetchrow(GET_OR_CREATE_USER, tg_id, write=True))
+
+        if user is None:
+            # a concurrent insert committed after the statement started, now it is visible
+            return await self.get_user_by_tg_id(tg_id)
+
+        return user
+
+    async def upsert_user_mental(self, user_id: int, temperament: str, profession: str) -> UserDomain:
+        return _user(await self._fetchrow(UPSERT_USER_MENTAL, user_id, temperament, profession, write=True))
+
+    async def commit(self) -> None:
+        async with self._lock:
+            if self._transaction is None:
+                return
+
+            try:
+                await self._transaction.commit()
+
+            finally:
+                self._transaction = None
+                await self._release()
+
+    async def close(self) -> None:
+        # uncommitted writes are rolled back
+        async with self._lock:
+            try:
+                if self._transaction is not None:
+                    await self._transaction.rollback()
+
+            finally:
+                self._transaction = None
+                await self._release()
+
+
+@asynccontextmanager
+async def asyncpg_user_gateway_scope(pool: asyncpg.Pool) -> AsyncIterator[AsyncpgUserGateWay]:
+    gateway = AsyncpgUserGateWay(pool=pool)
+
+    try:
+        yield gateway
+
+    finally:
+        await gateway.close()
@@ -0,0 +1,253 @@
+
+
+import json
+from typing import Any, Awaitable, Callable, Iterable, Optional
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass, field
+
+import asyncpg
+
+
+@dataclass(slots=True, kw_only=True)
+class AssistantRecordDomain:
+    openai_id: str
+    name: str
+
+
+@dataclass(slots=True, kw_only=True)
+class MentalRecordDomain:
+    temperament: str
+    profession: str
+
+
+@dataclass(slots=True, kw_only=True)
+class UserRecordDomain:
+    # the ids differ between the environments, the telegram id is the key of a user
+    tg_id: int
+
+    assistants: list[AssistantRecordDomain] = field(default_factory=list)
+    mental: Optional[MentalRecordDomain] = None
+
+
+@dataclass(slots=True, kw_only=True)
+class ImportStatsDomain:
+    records: int = 0
+    users: int = 0
+    assistants: int = 0
+    mentals: int = 0
+
+
+class BaseUserBulkGateWay(ABC):
+    @abstractmethod
+    async def copy_in(self, users: Iterable[UserRecordDomain]) -> ImportStatsDomain:
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def copy_out(self, output: Callable[[bytes], Awaitable[Any]], format: str) -> None:
+        raise NotImplementedError()
+
+
+class FakeUserBulkGateWay(BaseUserBulkGateWay):
+    __slots__ = ("_users", )
+
+    def __init__(self):
+        self._users: dict[int, UserRecordDomain] = {}
+
+    @property
+    def users(self) -> dict[int, UserRecordDomain]:
+        return self._users
+
+    async def copy_in(self, users: Iterable[UserRecordDomain]) -> ImportStatsDomain:
+        stats = ImportStatsDomain()
+
+        for record in users:
+            stats.records += 1
+
+            user = self._users.get(record.tg_id)
+            if user is None:
+                user = self._users[record.tg_id] = UserRecordDomain(tg_id=record.tg_id)
+                stats.users += 1
+
+            for assistant in record.assistants:
+                if all(value.openai_id != assistant.openai_id for value in user.assistants):
+                    user.assistants.append(assistant)
+                    stats.assistants += 1
+
+            if record.mental is not None:
+                user.mental = record.mental
+                stats.mentals += 1
+
+        return stats
+
+    async def copy_out(self, output: Callable[[bytes], Awaitable[Any]], format: str) -> None:
+        if format == "csv":
+            await output(b"tg_id,temperament,profession,openai_id,name\n")
+
+        for user in self._users.values():
+            mental = user.mental or MentalRecordDomain(temperament="", profession="")
+
+            if format == "ndjson":
+                line = json.dumps({
+                    "tg_id": user.tg_id,
+                    "mental": asdict(user.mental) if user.mental else None,
+                    "assistants": [asdict(value) for value in user.assistants]
+                })
+                await output(line.encode() + b"\n")
+                continue
+
+            for assistant in user.assistants or [AssistantRecordDomain(openai_id="", name="")]:
+                line = ",".join(
+                    (str(user.tg_id), mental.temperament, mental.profession, assistant.openai_id, assistant.name)
+                )
+                await output(line.encode() + b"\n")
+
+
+STAGING = """
+    CREATE TEMP TABLE users_staging (tg_id bigint NOT NULL) ON COMMIT DROP;
+    CREATE TEMP TABLE assistants_staging (
+        position bigint NOT NULL, tg_id bigint NOT NULL, openai_id varchar NOT NULL, name varchar NOT NULL
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE mental_staging (
+        position bigint NOT NULL, tg_id bigint NOT NULL, temperament varchar NOT NULL, profession varchar NOT NULL
+    ) ON COMMIT DROP;
+"""
+
+MERGE_USERS = """
+    WITH merged AS (
+        INSERT INTO users (tg_id)
+        SELECT DISTINCT tg_id FROM users_staging
+        ON CONFLICT (tg_id) DO NOTHING
+        RETURNING 1
+    )
+    SELECT count(*) FROM merged
+"""
+
+# assistants have no natural key in the schema, a user and an openai id are taken as one
+MERGE_ASSISTANTS = """
+    WITH latest AS (
+        SELECT DISTINCT ON (u.id, s.openai_id) u.id AS user_id, s.openai_id, s.name
+        FROM assistants_staging AS s
+        JOIN users AS u ON u.tg_id = s.tg_id
+        ORDER BY u.id, s.openai_id, s.position DESC
+    ),
+    renamed AS (
+        UPDATE assistants AS a SET name = latest.name
+        FROM latest
+        WHERE a.user_id = latest.user_id AND a.openai_id = latest.openai_id AND a.name <> latest.name
+        RETURNING 1
+    ),
+    merged AS (
+        INSERT INTO assistants (user_id, openai_id, name)
+        SELECT latest.user_id, latest.openai_id, latest.name
+        FROM latest
+        WHERE NOT EXISTS (
+            SELECT 1 FROM assistants AS a WHERE a.user_id = latest.user_id AND a.openai_id = latest.openai_id
+        )
+        RETURNING 1
+    )
+    SELECT count(*) FROM merged
+"""
+
+MERGE_MENTALS = """
+    WITH merged AS (
+        INSERT INTO mental_data (user_id, temperament, profession)
+        SELECT DISTINCT ON (u.id) u.id, s.temperament, s.profession
+        FROM mental_staging AS s
+        JOIN users AS u ON u.tg_id = s.tg_id
+        ORDER BY u.id, s.position DESC
+        ON CONFLICT (user_id) DO UPDATE SET temperament = excluded.temperament, profession = excluded.profession
+        RETURNING 1
+    )
+    SELECT count(*) FROM merged
+"""
+
+EXPORT_NDJSON = """
+    SELECT json_build_object(
+        'tg_id', u.tg_id,
+        'mental', (
+            SELECT json_build_object('temperament', m.temperament, 'profession', m.profession)
+            FROM mental_data AS m
+            WHERE m.user_id = u.id
+        ),
+        'assistants', coalesce(
+            (
+                SELECT json_agg(json_build_object('openai_id', a.openai_id, 'name', a.name) ORDER BY a.id)
+                FROM assistants AS a
+                WHERE a.user_id = u.id
+            ),
+            '[]'::json
+        )
+    )
+    FROM users AS u
+    ORDER BY u.id
+"""
+
+# one row per assistant with the user and the mental repeated, the layout which the import reads back
+EXPORT_CSV = """
+    SELECT u.tg_id, m.temperament, m.profession, a.openai_id, a.name
+    FROM users AS u
+    LEFT JOIN mental_data AS m ON m.user_id = u.id
+    LEFT JOIN assistants AS a ON a.user_id = u.id
+    ORDER BY u.id, a.id
+"""
+
+EXPORTS: dict[str, tuple[str, dict[str, Any]]] = {
+    # json has its control characters escaped, so this quote and delimiter never appear and a line is written verbatim
+    "ndjson": (EXPORT_NDJSON, {"format": "csv", "quote": "\x01", "delimiter": "\x02"}),
+    "csv": (EXPORT_CSV, {"format": "csv", "header": True})
+}
+
+
+class AsyncpgUserBulkGateWay(BaseUserBulkGateWay):
+    __slots__ = ("_connection", "_batch_size")
+
+    def __init__(self, connection: asyncpg.Connection, batch_size: int = 10_000):
+        self._connection = connection
+        self._batch_size = batch_size
+
+    async def _flush(self, table: str, records: list[tuple]) -> None:
+        if records:
+            await self._connection.copy_records_to_table(table, records=records)
+            records.clear()
+
+    async def copy_in(self, users: Iterable[UserRecordDomain]) -> ImportStatsDomain:
+        stats = ImportStatsDomain()
+        batches: dict[str, list[tuple]] = {"users_staging": [], "assistants_staging": [], "mental_staging": []}
+
+        async with self._connection.transaction():
+            await self._connection.execute(STAGING)
+
+            # the file goes to the staging tables with binary copy in batches, it is never in memory as a whole
+            for position, user in enumerate(users):
+                stats.records += 1
+
+                batches["users_staging"].append((user.tg_id, ))
+                batches["assistants_staging"].extend(
+                    (position, user.tg_id, assistant.openai_id, assistant.name) for assistant in user.assistants
+                )
+                if user.mental is not None:
+                    batches["mental_staging"].append(
+                        (position, user.tg_id, user.mental.temperament, user.mental.profession)
+                    )
+
+                for table, records in batches.items():
+                    if len(records) >= self._batch_size:
+                        await self._flush(table, records)
+
+            for table, records in batches.items():
+                await self._flush(table, records)
+
+            await self._connection.execute("ANALYZE users_staging, assistants_staging, mental_staging")
+
+            # set based merges, the later records of a user win
+            stats.users = await self._connection.fetchval(MERGE_USERS)
+            stats.assistants = await self._connection.fetchval(MERGE_ASSISTANTS)
+            stats.mentals = await self._connection.fetchval(MERGE_MENTALS)
+
+        return stats
+
+    async def copy_out(self, output: Callable[[bytes], Awaitable[Any]], format: str) -> None:
+        # the server streams the rows, they are passed on chunk by chunk
+        query, options = EXPORTS[format]
+
+        await self._connection.copy_from_query(query, output=output, **options)
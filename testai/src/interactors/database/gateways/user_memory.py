@@ -0,0 +1,373 @@
+
+
+import os
+import pickle
+import asyncio
+import logging
+from pathlib import Path
+from typing import AsyncIterator, Optional, Union
+from dataclasses import dataclass, replace
+from contextlib import asynccontextmanager
+
+from testai.src.interactors.database.gateways.user import (
+    AssisstantDomain,
+    BaseUserGateWay,
+    MentalDataDomain,
+    UserDomain
+)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+@dataclass(slots=True, kw_only=True)
+class StoredUser:
+    # the versions are replaced and never changed, so a reader or a snapshot can keep one without a copy,
+    # it is not frozen only because the frozen init is several times slower
+    id: int
+    tg_id: int
+
+    assistants: tuple[AssisstantDomain, ...] = ()
+    mental: Optional[MentalDataDomain] = None
+
+    def to_domain(self) -> UserDomain:
+        return UserDomain(
+            id=self.id,
+            tg_id=self.tg_id,
+            assistans=list(self.assistants),
+            mental=self.mental
+        )
+
+
+@dataclass(slots=True, kw_only=True)
+class CreateUser:
+    user: StoredUser
+
+
+@dataclass(slots=True, kw_only=True)
+class AddAssistant:
+    assistant: AssisstantDomain
+
+
+@dataclass(slots=True, kw_only=True)
+class SetMental:
+    mental: MentalDataDomain
+
+
+Operation = Union[CreateUser, AddAssistant, SetMental]
+
+
+class MemoryUserStore:
+    __slots__ = ("_users", "_by_tg_id", "_reserved", "_sequences", "_path", "_snapshotter", "_snapshot_lock")
+
+    def __init__(self, path: Optional[Union[str, Path]] = None):
+        self._users: dict[int, StoredUser] = {}
+        self._by_tg_id: dict[int, int] = {}
+        # the ids of the users which are created but not committed yet, by their telegram ids
+        self._reserved: dict[int, int] = {}
+        # like the database sequences, a taken id is not given back by a rollback
+        self._sequences = {"users": 0, "assistants": 0, "mental_data": 0}
+
+        self._path = Path(path) if path else None
+        self._snapshotter: Optional[asyncio.Task] = None
+        self._snapshot_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def next_id(self, sequence: str) -> int:
+        self._sequences[sequence] += 1
+
+        return self._sequences[sequence]
+
+    def reserve_user_id(self, tg_id: int) -> int:
+        # concurrent transactions which create the same user stage it with the same id,
+        # so the one committed later finds it created, like ON CONFLICT DO NOTHING in the database
+        user_id = self._reserved.get(tg_id)
+
+        if user_id is None:
+            user_id = self._reserved[tg_id] = self.next_id("users")
+
+        return user_id
+
+    def get(self, user_id: int) -> Optional[StoredUser]:
+        return self._users.get(user_id)
+
+    def get_by_tg_id(self, tg_id: int) -> Optional[StoredUser]:
+        user_id = self._by_tg_id.get(tg_id)
+
+        return self._users[user_id] if user_id is not None else None
+
+    def validate(self, operations: list[Operation]) -> None:
+        # the whole transaction is checked before the first change, so it is applied completely or not at all
+        created_tg_ids = set()
+        created_ids = set()
+
+        for operation in operations:
+            if isinstance(operation, CreateUser):
+                stored_id = self._by_tg_id.get(operation.user.tg_id)
+
+                if stored_id not in (None, operation.user.id) or operation.user.tg_id in created_tg_ids:
+                    raise ValueError(f"User with tg_id {operation.user.tg_id} already exists")
+
+                created_tg_ids.add(operation.user.tg_id)
+                created_ids.add(operation.user.id)
+                continue
+
+            user_id = operation.assistant.user_id if isinstance(operation, AddAssistant) else operation.mental.user_id
+            if user_id not in self._users and user_id not in created_ids:
+                raise ValueError("Undefined user")
+
+    def apply(self, operations: list[Operation]) -> None:
+        self.validate(operations)
+
+        for operation in operations:
+            # the operations are replayed on the newest versions, so concurrent transactions do not lose writes
+            if isinstance(operation, CreateUser):
+                self._reserved.pop(operation.user.tg_id, None)
+
+                if operation.user.tg_id in self._by_tg_id:
+                    # a concurrent transaction has created the same user, the writes below go to it
+                    continue
+
+                self._users[operation.user.id] = operation.user
+                self._by_tg_id[operation.user.tg_id] = operation.user.id
+
+            elif isinstance(operation, AddAssistant):
+                user = self._users[operation.assistant.user_id]
+                self._users[user.id] = StoredUser(
+                    id=user.id,
+                    tg_id=user.tg_id,
+                    assistants=user.assistants + (operation.assistant, ),
+                    mental=user.mental
+                )
+
+            else:
+                user = self._users[operation.mental.user_id]
+                mental = operation.mental
+
+                if user.mental is not None and user.mental.id != mental.id:
+                    # set by a concurrent transaction meanwhile, the row is updated and keeps its id
+                    mental = replace(mental, id=user.mental.id)
+
+                self._users[user.id] = StoredUser(
+                    id=user.id,
+                    tg_id=user.tg_id,
+                    assistants=user.assistants,
+                    mental=mental
+                )
+
+    async def snapshot(self) -> None:
+        if self._path is None:
+            return
+
+        # the list of immutable versions is taken at once, the slow part runs in a thread
+        users = list(self._users.values())
+        sequences = self._sequences.copy()
+
+        async with self._snapshot_lock:
+            await asyncio.to_thread(self._write, self._path, sequences, users)
+
+    @staticmethod
+    def _write(path: Path, sequences: dict[str, int], users: list[StoredUser]) -> None:
+        rows = [
+            (
+                user.id,
+                user.tg_id,
+                tuple((value.id, value.openai_id, value.name) for value in user.assistants),
+                (user.mental.id, user.mental.temperament, user.mental.profession) if user.mental else None
+            ) for user in users
+        ]
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # written aside and renamed, a crash during the write keeps the previous snapshot
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "wb") as file:
+            pickle.dump((SNAPSHOT_VERSION, sequences, rows), file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp, path)
+
+    def load(self) -> None:
+        if self._path is None or not self._path.exists():
+            return
+
+        with open(self._path, "rb") as file:
+            version, sequences, rows = pickle.load(file)
+
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unknown snapshot version {version}")
+
+        self._sequences.update(sequences)
+        self._users.clear()
+        self._by_tg_id.clear()
+
+        for user_id, tg_id, assistants, mental in rows:
+            self._users[user_id] = StoredUser(
+                id=user_id,
+                tg_id=tg_id,
+                assistants=tuple(
+                    AssisstantDomain(id=id, user_id=user_id, openai_id=openai_id, name=name)
+                    for id, openai_id, name in assistants
+                ),
+                mental=MentalDataDomain(
+                    id=mental[0], user_id=user_id, temperament=mental[1], profession=mental[2]
+                ) if mental else None
+            )
+            self._by_tg_id[tg_id] = user_id
+
+        logger.info("%s users are loaded from %s", len(self._users), self._path)
+
+    def start(self, interval: float) -> None:
+        if self._path is not None and self._snapshotter is None:
+            self._snapshotter = asyncio.create_task(self._snapshot_loop(interval))
+
+    async def _snapshot_loop(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                await self.snapshot()
+
+            except Exception:
+                logger.exception("Failed to write the users snapshot")
+
+    async def close(self) -> None:
+        if self._snapshotter is not None:
+            self._snapshotter.cancel()
+            self._snapshotter = None
+
+        # the writes since the last snapshot are kept on a graceful shutdown
+        await self.snapshot()
+
+
+class MemoryUserGateWay(BaseUserGateWay):
+    __slots__ = ("_store", "_operations", "_staged", "_staged_tg_ids")
+
+    def __init__(self, store: MemoryUserStore):
+        self._store = store
+        # the writes of the transaction, they are applied to the store by commit
+        self._operations: list[Operation] = []
+        # the versions this transaction sees, its own writes on top of the store
+        self._staged: dict[int, StoredUser] = {}
+        self._staged_tg_ids: dict[int, int] = {}
+
+    def _get(self, user_id: int) -> Optional[StoredUser]:
+        return self._staged.get(user_id) or self._store.get(user_id)
+
+    def _get_by_tg_id(self, tg_id: int) -> Optional[StoredUser]:
+        user_id = self._staged_tg_ids.get(tg_id)
+        if user_id is not None:
+            return self._staged[user_id]
+
+        user = self._store.get_by_tg_id(tg_id)
+        if user is None:
+            return None
+
+        return self._staged.get(user.id, user)
+
+    def _required(self, user_id: int) -> StoredUser:
+        user = self._get(user_id)
+
+        if user is None:
+            raise ValueError("Undefined user")
+
+        return user
+
+    def _stage(self, user: StoredUser, operation: Operation) -> StoredUser:
+        self._staged[user.id] = user
+        self._operations.append(operation)
+
+        return user
+
+    def _create(self, tg_id: int) -> StoredUser:
+        user = StoredUser(id=self._store.reserve_user_id(tg_id), tg_id=tg_id)
+        self._staged_tg_ids[tg_id] = user.id
+
+        return self._stage(user, CreateUser(user=user))
+
+    async def get_user_by_tg_id(self, tg_id: int) -> UserDomain:
+        user = self._get_by_tg_id(tg_id)
+
+        if user is None:
+            raise ValueError("Undefined user")
+
+        return user.to_domain()
+
+    async def get_user_by_id(self, user_id: int) -> UserDomain:
+        return self._required(user_id).to_domain()
+
+    async def get_user_unsafe(self, tg_id: int) -> Optional[UserDomain]:
+        user = self._get_by_tg_id(tg_id)
+
+        return user.to_domain() if user is not None else None
+
+    async def get_user_assistants(self, user_id: int) -> list[AssisstantDomain]:
+        user = self._get(user_id)
+
+        return list(user.assistants) if user is not None else []
+
+    async def add_user_assistants(self, user_id: int, assistant_id: str, assistant_name: str) -> UserDomain:
+        user = self._required(user_id)
+        assistant = AssisstantDomain(
+            id=self._store.next_id("assistants"),
+            user_id=user_id,
+            openai_id=assistant_id,
+            name=assistant_name
+        )
+
+        return self._stage(
+            StoredUser(id=user.id, tg_id=user.tg_id, assistants=user.assistants + (assistant, ), mental=user.mental),
+            AddAssistant(assistant=assistant)
+        ).to_domain()
+
+    async def upsert_user(self, tg_id: int) -> UserDomain:
+        user = self._get_by_tg_id(tg_id) or self._create(tg_id)
+
+        return UserDomain(id=user.id, tg_id=user.tg_id)
+
+    async def get_or_create_user(self, tg_id: int) -> UserDomain:
+        user = self._get_by_tg_id(tg_id) or self._create(tg_id)
+
+        return user.to_domain()
+
+    async def upsert_user_mental(self, user_id: int, temperament: str, profession: str) -> UserDomain:
+        user = self._required(user_id)
+        mental = MentalDataDomain(
+            id=user.mental.id if user.mental else self._store.next_id("mental_data"),
+            user_id=user_id,
+            temperament=temperament,
+            profession=profession
+        )
+
+        return self._stage(
+            StoredUser(id=user.id, tg_id=user.tg_id, assistants=user.assistants, mental=mental),
+            SetMental(mental=mental)
+        ).to_domain()
+
+    def _reset(self) -> None:
+        self._operations = []
+        self._staged = {}
+        self._staged_tg_ids = {}
+
+    async def commit(self) -> None:
+        operations = self._operations
+        self._reset()
+
+        self._store.apply(operations)
+
+    async def close(self) -> None:
+        # like closing a session, the uncommitted writes are dropped
+        self._reset()
+
+
+@asynccontextmanager
+async def memory_user_gateway_scope(store: MemoryUserStore) -> AsyncIterator[MemoryUserGateWay]:
+    gateway = MemoryUserGateWay(store=store)
+
+    try:
+        yield gateway
+
+    finally:
+        await gateway.close()
@@ -0,0 +1,65 @@
+
+
+import json
+import hashlib
+from typing import Any, AsyncContextManager, Awaitable, Callable, Optional
+
+from testai.src.interactors.caching import SingleFlight
+from testai.src.interactors.database.gateways.assistant import BaseAssistantRegistryGateWay
+
+
+class AssistantRegistry:
+    __slots__ = ("_gateway_scope", "_ids", "_flight")
+
+    def __init__(self, gateway_scope: Callable[[], AsyncContextManager[BaseAssistantRegistryGateWay]]):
+        self._gateway_scope = gateway_scope
+        self._ids: dict[str, str] = {}
+        self._flight: SingleFlight[str] = SingleFlight()
+
+    @staticmethod
+    def digest(model: str, instructions: str, tools: Optional[list[dict[str, Any]]] = None) -> str:
+        payload = json.dumps(
+            {"model": model, "instructions": instructions, "tools": tools or []},
+            sort_keys=True,
+            separators=(",", ":")
+        )
+
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def load(self) -> None:
+        async with self._gateway_scope() as gateway:
+            assistants = await gateway.get_all()
+
+        self._ids.update({value.digest: value.openai_id for value in assistants})
+
+    async def _register(self, digest: str, create: Callable[[], Awaitable[str]]) -> str:
+        async with self._gateway_scope() as gateway:
+            # the registry could be filled by another process after our load
+            existing = await gateway.get_by_digest(digest)
+
+        if existing is None:
+            # the connection is not held during the openai round trip
+            openai_id = await create()
+
+            async with self._gateway_scope() as gateway:
+                existing = await gateway.add(digest=digest, openai_id=openai_id)
+                await gateway.commit()
+
+        self._ids[digest] = existing.openai_id
+
+        return existing.openai_id
+
+    async def get_or_create(
+            self,
+            model: str,
+            instructions: str,
+            tools: Optional[list[dict[str, Any]]],
+            create: Callable[[], Awaitable[str]]
+    ) -> str:
+        digest = self.digest(model=model, instructions=instructions, tools=tools)
+
+        openai_id = self._ids.get(digest, None)
+        if openai_id:
+            return openai_id
+
+        return await self._flight.do(digest, lambda: self._register(digest, create))
@@ -1,9 +1,11 @@
 
 
-from typing import Optional
+import time
+from typing import Awaitable, Callable, Optional
 
 from dataclasses import dataclass
 
+from testai.src.interactors.caching import CacheStats, SingleFlight, TTLCache
 from testai.src.interactors.database.gateways.user import BaseUserGateWay, UserDomain
 
 
@@ -34,11 +36,98 @@ class User:
     mental: Optional[Mental] = None
 
 
+@dataclass(slots=True, kw_only=True)
+class UserCacheStats(CacheStats):
+    loads: int = 0
+    shared: int = 0
+    # moving average of a database load in seconds
+    load_latency: float = 0.0
+
+
+class UserCache:
+    __slots__ = ("_cache", "_pairs", "_max_size", "_flight", "_generation", "_stats")
+
+    def __init__(self, ttl: float = 5 * 60, max_size: int = 10_000):
+        self._stats = UserCacheStats()
+        # every user is stored twice, under its id and under its telegram id
+        self._cache: TTLCache[User] = TTLCache(ttl=ttl, max_size=max_size * 2, stats=self._stats)
+        # the other key of every cached user, the lru may evict one of the two entries and keep the other
+        self._pairs: dict[tuple[str, int], tuple[str, int]] = {}
+        self._max_size = max_size
+        self._flight: SingleFlight[User] = SingleFlight()
+        self._generation = 0
+
+    @property
+    def stats(self) -> UserCacheStats:
+        return self._stats
+
+    def _set(self, user: User) -> None:
+        self._cache.set(("id", user.id), user)
+        self._cache.set(("tg_id", user.tg_id), user)
+
+        # the pair of a user never changes, so a pair is only dropped when none of its entries is cached
+        self._pairs[("id", user.id)] = ("tg_id", user.tg_id)
+        self._pairs[("tg_id", user.tg_id)] = ("id", user.id)
+
+        if len(self._pairs) > self._max_size * 4:
+            self._pairs = {
+                key: other for key, other in self._pairs.items()
+                if self._cache.peek(key) is not None or self._cache.peek(other) is not None
+            }
+
+    async def _load(self, load: Callable[[], Awaitable[User]], generation: int) -> User:
+        started = time.monotonic()
+
+        user = await load()
+
+        self._stats.loads += 1
+        self._stats.load_latency = 0.8 * self._stats.load_latency + 0.2 * (time.monotonic() - started)
+
+        # a write during the load may have made the result stale, it is returned but not cached
+        if generation == self._generation:
+            self._set(user)
+
+        return user
+
+    async def get(self, key: tuple[str, int], load: Callable[[], Awaitable[User]]) -> User:
+        user = self._cache.get(key)
+        if user is not None:
+            return user
+
+        # a load which started before the last write must not be shared with the callers after it
+        generation = self._generation
+        flight_key = (key, generation)
+
+        if flight_key in self._flight:
+            self._stats.shared += 1
+
+        return await self._flight.do(flight_key, lambda: self._load(load, generation))
+
+    def put(self, user: User) -> None:
+        self.invalidate(user_id=user.id, tg_id=user.tg_id)
+        self._set(user)
+
+    def invalidate(self, user_id: Optional[int] = None, tg_id: Optional[int] = None) -> None:
+        self._generation += 1
+
+        for key in (("id", user_id), ("tg_id", tg_id)):
+            if key[1] is None:
+                continue
+
+            self._cache.pop(key)
+
+            other = self._pairs.pop(key, None)
+            if other is not None:
+                self._cache.pop(other)
+                self._pairs.pop(other, None)
+
+
 class UserRepo:
-    __slots__ = ("_user_gateway", )
+    __slots__ = ("_user_gateway", "_cache")
 
-    def __init__(self, user_gateway: BaseUserGateWay):
+    def __init__(self, user_gateway: BaseUserGateWay, cache: Optional[UserCache] = None):
         self._user_gateway = user_gateway
+        self._cache = cache
 
     @staticmethod
     def _build_user_model(
@@ -71,16 +160,39 @@ class UserRepo:
             mental=mental
         )
 
-    async def get_user_by_tg_id(self, user_tg_id: int) -> User:
+    async def _load_by_tg_id(self, user_tg_id: int) -> User:
         user = await self._user_gateway.get_user_by_tg_id(user_tg_id)
 
         return self._build_user_model(user)
 
-    async def get_user_by_id(self, user_id: int) -> User:
+    async def _load_by_id(self, user_id: int) -> User:
         user = await self._user_gateway.get_user_by_id(user_id)
 
         return self._build_user_model(user)
 
+    async def get_user_by_tg_id(self, user_tg_id: int) -> User:
+        if self._cache is None:
+            return await self._load_by_tg_id(user_tg_id)
+
+        return await self._cache.get(("tg_id", user_tg_id), lambda: self._load_by_tg_id(user_tg_id))
+
+    async def get_user_by_id(self, user_id: int) -> User:
+        if self._cache is None:
+            return await self._load_by_id(user_id)
+
+        return await self._cache.get(("id", user_id), lambda: self._load_by_id(user_id))
+
+    def _invalidate(self, user_id: Optional[int] = None, tg_id: Optional[int] = None) -> None:
+        if self._cache is not None:
+            self._cache.invalidate(user_id=user_id, tg_id=tg_id)
+
+    def _written(self, user: User) -> User:
+        # the statement returned the whole user, so it replaces the cached one without a reload
+        if self._cache is not None:
+            self._cache.put(user)
+
+        return user
+
     async def get_user_by_tg_id_unsafe(self, tg_id: int) -> Optional[User]:
         user = await self._user_gateway.get_user_unsafe(tg_id=tg_id)
 
@@ -90,7 +202,7 @@ class UserRepo:
         return self._build_user_model(user)
 
     async def add_assistant(self, user_id: int, openai_id: str, name: str) -> User:
-        await self._user_gateway.add_user_assistants(
+        user = await self._user_gateway.add_user_assistants(
             user_id=user_id,
             assistant_id=openai_id,
             assistant_name=name
@@ -98,10 +210,10 @@ class UserRepo:
 
         await self._user_gateway.commit()
 
-        return await self.get_user_by_id(user_id=user_id)
+        return self._written(self._build_user_model(user))
 
     async def upsert_user_mental(self, user_id: int, temperament: str, profession: str) -> User:
-        await self._user_gateway.upsert_user_mental(
+        user = await self._user_gateway.upsert_user_mental(
             user_id=user_id,
             temperament=temperament,
             profession=profession
@@ -109,7 +221,21 @@ class UserRepo:
 
         await self._user_gateway.commit()
 
-        return await self.get_user_by_id(user_id=user_id)
+        return self._written(self._build_user_model(user))
+
+    async def _create_user(self, tg_id: int) -> User:
+        user = await self._user_gateway.get_or_create_user(tg_id=tg_id)
+
+        await self._user_gateway.commit()
+
+        return self._build_user_model(user)
+
+    async def get_or_create_user(self, tg_id: int) -> User:
+        if self._cache is None:
+            return await self._create_user(tg_id)
+
+        # creating is idempotent, so it is cached like a load
+        return await self._cache.get(("tg_id", tg_id), lambda: self._create_user(tg_id))
 
     async def upsert_user(self, tg_id: int) -> User:
         user = await self._user_gateway.upsert_user(
@@ -117,5 +243,6 @@ class UserRepo:
         )
 
         await self._user_gateway.commit()
+        self._invalidate(user_id=user.id, tg_id=tg_id)
 
         return self._build_user_model(user)
@@ -0,0 +1,88 @@
+
+
+import csv
+import json
+from typing import Any, Awaitable, Callable, Iterable, Iterator
+
+from dataclasses import dataclass
+
+from testai.src.interactors.database.gateways.user_bulk import (
+    AssistantRecordDomain,
+    BaseUserBulkGateWay,
+    MentalRecordDomain,
+    UserRecordDomain
+)
+
+FORMATS = ("csv", "ndjson")
+
+
+@dataclass(slots=True, kw_only=True, frozen=True)
+class ImportStats:
+    records: int
+    users: int
+    assistants: int
+    mentals: int
+
+
+def parse_ndjson(lines: Iterable[str]) -> Iterator[UserRecordDomain]:
+    for line in lines:
+        if not line.strip():
+            continue
+
+        value = json.loads(line)
+        mental = value.get("mental")
+
+        yield UserRecordDomain(
+            tg_id=int(value["tg_id"]),
+            assistants=[
+                AssistantRecordDomain(openai_id=assistant["openai_id"], name=assistant["name"])
+                for assistant in value.get("assistants") or []
+            ],
+            mental=MentalRecordDomain(
+                temperament=mental["temperament"], profession=mental["profession"]
+            ) if mental else None
+        )
+
+
+def parse_csv(lines: Iterable[str]) -> Iterator[UserRecordDomain]:
+    # the export layout, a row per assistant and empty columns for a missing assistant or mental
+    for row in csv.DictReader(lines):
+        yield UserRecordDomain(
+            tg_id=int(row["tg_id"]),
+            assistants=[
+                AssistantRecordDomain(openai_id=row["openai_id"], name=row["name"])
+            ] if row.get("openai_id") else [],
+            mental=MentalRecordDomain(
+                temperament=row["temperament"], profession=row["profession"]
+            ) if row.get("temperament") else None
+        )
+
+
+PARSERS: dict[str, Callable[[Iterable[str]], Iterator[UserRecordDomain]]] = {
+    "csv": parse_csv,
+    "ndjson": parse_ndjson
+}
+
+
+class UserBulkRepo:
+    __slots__ = ("_gateway", )
+
+    def __init__(self, gateway: BaseUserBulkGateWay):
+        self._gateway = gateway
+
+    async def import_users(self, lines: Iterable[str], format: str) -> ImportStats:
+        # the lines are parsed lazily while the gateway copies them, so a file of any size is fine
+        stats = await self._gateway.copy_in(PARSERS[format](lines))
+
+        return ImportStats(
+            records=stats.records,
+            users=stats.users,
+            assistants=stats.assistants,
+            mentals=stats.mentals
+        )
+
+    async def export_users(self, output: Callable[[bytes], Awaitable[Any]], format: str) -> None:
+        if format not in FORMATS:
+            raise ValueError(f"Unknown format {format}")
+
+        await self._gateway.copy_out(output, format)
@@ -1,6 +1,10 @@
 
 
-from sqlalchemy import ForeignKey, BigInteger
+from typing import Any, Optional
+from datetime import datetime
+
+from sqlalchemy import ForeignKey, BigInteger, DateTime, func
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -24,7 +28,8 @@ class User(Base):
 class Assisstant(Base):
     __tablename__ = "assistants"
     id: Mapped[int] = mapped_column(autoincrement=True, primary_key=True)
-    openai_id: Mapped[str] = mapped_column(unique=True)
+    # the same openai assistant can be shared by several users, see OpenAIAssistant
+    openai_id: Mapped[str]
     name: Mapped[str]
 
     user_id: Mapped[int] = mapped_column(ForeignKey(User.id))
@@ -41,3 +46,19 @@ class Mental(Base):
 
     user_id: Mapped[int] = mapped_column(ForeignKey(User.id))
     user: Mapped[User] = relationship(foreign_keys=user_id, lazy='noload')
+
+
+class OpenAIAssistant(Base):
+    __tablename__ = "openai_assistants"
+    id: Mapped[int] = mapped_column(autoincrement=True, primary_key=True)
+    digest: Mapped[str] = mapped_column(unique=True)
+    openai_id: Mapped[str]
+
+
+class FSMState(Base):
+    __tablename__ = "fsm_states"
+    key: Mapped[str] = mapped_column(primary_key=True)
+    state: Mapped[Optional[str]]
+    data: Mapped[dict[str, Any]] = mapped_column(JSONB)
+    # only writes move it, states which are not written for a long time are deleted
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
@@ -1,12 +1,18 @@
 
 
+import asyncio
 from io import BytesIO
-from typing import BinaryIO
+from typing import Awaitable, BinaryIO, Callable, Optional
 from abc import ABC, abstractmethod
 
 from openai import AsyncClient
 
 from testai.src.interactors.processing.getname import GetUniqueNameProtocol
+from testai.src.interactors.processing.ogg import merge_transcripts, split_opus
+from testai.src.interactors.processing.codec import AudioCodec, AudioFormat, FLAC, MP3, OPUS, WAV, peek_format
+
+# telegram voices are ogg/opus, which whisper takes as is
+WHISPER_FORMATS = (OPUS, MP3, WAV, FLAC)
 
 
 class AudioToTextInteractor(ABC):
@@ -14,32 +20,104 @@ class AudioToTextInteractor(ABC):
     async def get_response(
             self,
             audio: BinaryIO,
-            getname: GetUniqueNameProtocol
+            getname: GetUniqueNameProtocol,
+            duration: Optional[int] = None
+    ) -> str:
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def get_response_by_id(
+            self,
+            file_unique_id: str,
+            download: Callable[[], Awaitable[BinaryIO]],
+            getname: GetUniqueNameProtocol,
+            duration: Optional[int] = None
     ) -> str:
         raise NotImplementedError()
 
 
 class WhisperAudioToTextInteractor(AudioToTextInteractor):
-    __slots__ = ("_client",)
+    __slots__ = (
+        "_client",
+        "_model",
+        "_codec",
+        "_chunk_threshold",
+        "_chunk_length",
+        "_chunk_overlap",
+        "_max_parallel"
+    )
 
-    def __init__(self, client: AsyncClient):
+    def __init__(
+            self,
+            client: AsyncClient,
+            model: str = "whisper-1",
+            codec: Optional[AudioCodec] = None,
+            chunk_threshold: int = 120,
+            chunk_length: float = 60.0,
+            chunk_overlap: float = 2.0,
+            max_parallel: int = 4
+    ):
         self._client = client
+        self._model = model
+        self._codec = codec
+        self._chunk_threshold = chunk_threshold
+        self._chunk_length = chunk_length
+        self._chunk_overlap = chunk_overlap
+        self._max_parallel = max_parallel
+
+    @property
+    def model(self) -> str:
+        return self._model
+
+    async def _translate(self, audio: BinaryIO, audio_format: AudioFormat, getname: GetUniqueNameProtocol) -> str:
+        # the downloaded buffer is uploaded as is, the tuple only gives it a name
+        translation = await self._client.audio.translations.create(
+            model=self._model,
+            file=(getname(audio_format.extension), audio)
+        )
+
+        return translation.text
+
+    async def _translate_chunked(self, audio: BinaryIO, getname: GetUniqueNameProtocol) -> str:
+        data = audio.getvalue() if isinstance(audio, BytesIO) else audio.read()
+
+        segments = await asyncio.to_thread(
+            split_opus, data, length=self._chunk_length, overlap=self._chunk_overlap
+        )
+        semaphore = asyncio.Semaphore(self._max_parallel)
+
+        async def translate(segment: bytes) -> str:
+            async with semaphore:
+                return await self._translate(BytesIO(segment), OPUS, getname=getname)
+
+        # gather keeps the order of the segments and cancels the rest on a failure
+        texts = await asyncio.gather(*[translate(segment) for segment in segments])
+
+        return merge_transcripts(texts)
 
     async def get_response(
             self,
             audio: BinaryIO,
-            getname: GetUniqueNameProtocol
+            getname: GetUniqueNameProtocol,
+            duration: Optional[int] = None
     ) -> str:
+        if self._codec:
+            audio, audio_format = await self._codec.negotiate(audio, accepted=WHISPER_FORMATS)
 
-        io = BytesIO()
-        io.name = getname(".mp3")
+        else:
+            audio_format = peek_format(audio) or OPUS
 
-        io.write(audio.read())
-        io.seek(0)
+        # one long upload is transcribed sequentially by whisper, page aligned pieces are done in parallel
+        if duration and duration > self._chunk_threshold and audio_format is OPUS:
+            return await self._translate_chunked(audio, getname=getname)
 
-        translation = await self._client.audio.translations.create(
-            model="whisper-1",
-            file=io
-        )
+        return await self._translate(audio, audio_format, getname=getname)
 
-        return translation.text
+    async def get_response_by_id(
+            self,
+            file_unique_id: str,
+            download: Callable[[], Awaitable[BinaryIO]],
+            getname: GetUniqueNameProtocol,
+            duration: Optional[int] = None
+    ) -> str:
+        return await self.get_response(await download(), getname=getname, duration=duration)
@@ -0,0 +1,124 @@
+
+
+import os
+import asyncio
+import subprocess
+from io import BytesIO
+from typing import BinaryIO, Optional
+from dataclasses import dataclass
+
+
+@dataclass(slots=True, kw_only=True, frozen=True)
+class AudioFormat:
+    name: str
+    extension: str
+    ffmpeg_args: tuple[str, ...]
+
+
+OPUS = AudioFormat(name="opus", extension=".ogg", ffmpeg_args=("-c:a", "libopus", "-f", "ogg"))
+MP3 = AudioFormat(name="mp3", extension=".mp3", ffmpeg_args=("-f", "mp3"))
+WAV = AudioFormat(name="wav", extension=".wav", ffmpeg_args=("-f", "wav"))
+FLAC = AudioFormat(name="flac", extension=".flac", ffmpeg_args=("-f", "flac"))
+AAC = AudioFormat(name="aac", extension=".aac", ffmpeg_args=("-f", "adts"))
+
+FORMATS = {value.name: value for value in (OPUS, MP3, WAV, FLAC, AAC)}
+
+
+def detect_format(header: bytes) -> Optional[AudioFormat]:
+    if header.startswith(b"OggS"):
+        return OPUS
+
+    if header.startswith(b"ID3") or header[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return MP3
+
+    if header.startswith(b"RIFF") and header[8:12] == b"WAVE":
+        return WAV
+
+    if header.startswith(b"fLaC"):
+        return FLAC
+
+    if header[:2] in (b"\xff\xf1", b"\xff\xf9"):
+        return AAC
+
+    return None
+
+
+def peek_format(audio: BinaryIO) -> Optional[AudioFormat]:
+    if isinstance(audio, BytesIO):
+        with audio.getbuffer() as view:
+            return detect_format(bytes(view[audio.tell():audio.tell() + 12]))
+
+    position = audio.tell()
+    header = audio.read(12)
+    audio.seek(position)
+
+    return detect_format(header)
+
+
+def ffmpeg_command(target: AudioFormat) -> list[str]:
+    # ffmpeg probes the source format itself
+    return [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-i", "pipe:0",
+        *target.ffmpeg_args,
+        "pipe:1"
+    ]
+
+
+class AudioCodec:
+    __slots__ = ("_semaphore", "_processes")
+
+    def __init__(self, max_processes: Optional[int] = None):
+        # ffmpeg is a process already, the loop only feeds its pipes, more of them than cores only queue up
+        self._semaphore = asyncio.Semaphore(max_processes or os.cpu_count() or 1)
+        self._processes: set[asyncio.subprocess.Process] = set()
+
+    async def transcode(self, data: bytes, target: AudioFormat) -> bytes:
+        command = ffmpeg_command(target)
+
+        async with self._semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            self._processes.add(process)
+
+            try:
+                stdout, stderr = await process.communicate(data)
+
+            finally:
+                self._processes.discard(process)
+
+                # a cancelled transcoding does not leave ffmpeg behind
+                if process.returncode is None:
+                    process.kill()
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, output=stdout, stderr=stderr)
+
+        return stdout
+
+    async def negotiate(
+            self,
+            audio: BinaryIO,
+            accepted: tuple[AudioFormat, ...],
+            default: AudioFormat = OPUS
+    ) -> tuple[BinaryIO, AudioFormat]:
+        current = peek_format(audio) or default
+
+        if current in accepted:
+            return audio, current
+
+        target = accepted[0]
+        data = await self.transcode(audio.read(), target)
+
+        return BytesIO(data), target
+
+    def shutdown(self) -> None:
+        for process in self._processes:
+            if process.returncode is None:
+                process.kill()
+
+        self._processes.clear()
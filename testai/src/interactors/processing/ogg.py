@@ -0,0 +1,199 @@
+
+
+import re
+import zlib
+import struct
+from typing import Union
+from dataclasses import dataclass
+
+# opus granule positions are always counted in 48 kHz samples
+OPUS_RATE = 48000
+
+CONTINUED = 0x01
+BEGIN_OF_STREAM = 0x02
+END_OF_STREAM = 0x04
+
+HEADER = struct.Struct("<4sBBqIIIB")
+
+
+# every byte with its bits in the reverse order
+REVERSED_BITS = bytes(int(f"{value:08b}"[::-1], 2) for value in range(256))
+
+
+def ogg_crc(data: Union[bytes, bytearray, memoryview]) -> int:
+    # the ogg crc is not the zlib one: not reflected, zero init and no final xor,
+    # on the reversed bits zlib computes the reflected one in c, which is the same crc with its bits reversed
+    crc = zlib.crc32(bytes(data).translate(REVERSED_BITS), 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+    return int.from_bytes(crc.to_bytes(4, "little").translate(REVERSED_BITS), "big")
+
+
+@dataclass(slots=True, kw_only=True)
+class OggPage:
+    header_type: int
+    granule: int
+    serial: int
+    sequence: int
+    lacing: bytes
+    body: memoryview
+
+    @property
+    def continued(self) -> bool:
+        return bool(self.header_type & CONTINUED)
+
+    @property
+    def packets_finished(self) -> int:
+        return sum(1 for value in self.lacing if value < 255)
+
+    def render(self, sequence: int, granule: int, header_type: int) -> bytes:
+        page = bytearray(HEADER.pack(
+            b"OggS", 0, header_type, granule, self.serial, sequence, 0, len(self.lacing)
+        ))
+        page += self.lacing
+        page += self.body
+
+        struct.pack_into("<I", page, 22, ogg_crc(page))
+
+        return bytes(page)
+
+
+def parse_pages(data: Union[bytes, memoryview]) -> list[OggPage]:
+    view = memoryview(data)
+    pages = []
+    offset = 0
+
+    while offset + HEADER.size <= len(view):
+        capture, _, header_type, granule, serial, sequence, _, count = HEADER.unpack_from(view, offset)
+
+        if capture != b"OggS":
+            raise ValueError("Broken ogg page")
+
+        lacing_start = offset + HEADER.size
+        lacing = bytes(view[lacing_start:lacing_start + count])
+
+        body_start = lacing_start + count
+        body_end = body_start + sum(lacing)
+
+        if body_end > len(view):
+            raise ValueError("Truncated ogg page")
+
+        pages.append(OggPage(
+            header_type=header_type,
+            granule=granule,
+            serial=serial,
+            sequence=sequence,
+            lacing=lacing,
+            body=view[body_start:body_end]
+        ))
+
+        offset = body_end
+
+    return pages
+
+
+def _split_headers(pages: list[OggPage]) -> int:
+    # OpusHead and OpusTags are the first two packets, the tags may take several pages
+    finished = 0
+
+    for index, page in enumerate(pages):
+        finished += page.packets_finished
+
+        if finished >= 2:
+            return index + 1
+
+    raise ValueError("Ogg stream without opus headers")
+
+
+def split_opus(data: Union[bytes, memoryview], length: float, overlap: float) -> list[bytes]:
+    pages = parse_pages(data)
+    headers_end = _split_headers(pages)
+
+    headers, audio = pages[:headers_end], pages[headers_end:]
+
+    if not audio:
+        return [bytes(data)]
+
+    pre_skip = struct.unpack_from("<H", headers[0].body, 10)[0]
+
+    # granule of the end of every page, pages without finished packets inherit the previous one
+    ends = []
+    last = 0
+    for page in audio:
+        last = page.granule if page.granule >= 0 else last
+        ends.append(last)
+
+    length_samples = int(length * OPUS_RATE)
+    overlap_samples = int(overlap * OPUS_RATE)
+
+    segments = []
+    start = 0
+
+    while start < len(audio):
+        base = ends[start - 1] if start else 0
+
+        # a segment ends where the next one can start with a whole packet
+        end = start
+        while end + 1 < len(audio) and (ends[end] - base < length_samples or audio[end + 1].continued):
+            end += 1
+
+        segments.append(_render_segment(headers, audio[start:end + 1], base=base, pre_skip=pre_skip))
+
+        if end + 1 >= len(audio):
+            break
+
+        # the next segment goes back by the overlap, but always moves forward
+        next_start = end + 1
+        while next_start > start + 1 and (
+                ends[end] - ends[next_start - 1] < overlap_samples or audio[next_start].continued
+        ):
+            next_start -= 1
+
+        start = next_start
+
+    return segments
+
+
+def _render_segment(headers: list[OggPage], pages: list[OggPage], base: int, pre_skip: int) -> bytes:
+    rendered = [
+        page.render(sequence=index, granule=page.granule, header_type=page.header_type)
+        for index, page in enumerate(headers)
+    ]
+
+    for index, page in enumerate(pages, start=len(headers)):
+        header_type = page.header_type & ~END_OF_STREAM
+        if index == len(headers) + len(pages) - 1:
+            header_type |= END_OF_STREAM
+
+        # the granules are moved to the start of the segment, the decoder drops pre_skip samples again
+        granule = page.granule - base + pre_skip if page.granule >= 0 and base else page.granule
+
+        rendered.append(page.render(sequence=index, granule=granule, header_type=header_type))
+
+    return b"".join(rendered)
+
+
+WORD = re.compile(r"\w+")
+
+
+def _normalize(word: str) -> str:
+    return "".join(WORD.findall(word.lower()))
+
+
+def merge_transcripts(texts: list[str], max_overlap: int = 30) -> str:
+    words: list[str] = []
+
+    for text in texts:
+        current = text.split()
+
+        # the overlapped audio is transcribed twice, the longest repeated run of words is dropped
+        tail = [_normalize(word) for word in words[-max_overlap:]]
+        head = [_normalize(word) for word in current[:max_overlap]]
+
+        for size in range(min(len(tail), len(head)), 0, -1):
+            if tail[-size:] == head[:size]:
+                current = current[size:]
+                break
+
+        words.extend(current)
+
+    return " ".join(words)
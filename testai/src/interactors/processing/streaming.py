@@ -0,0 +1,120 @@
+
+
+import re
+import asyncio
+from io import BytesIO
+from typing import AsyncIterable, Optional, Protocol
+
+from testai.src.interactors.processing.getname import GetUniqueNameProtocol
+from testai.src.interactors.processing.text_to_audio import TextToAudioInteractor
+
+# the whitespace after the punctuation is required, so "3.14" or "v1.2" are not cut
+SENTENCE_END = re.compile(r"[.!?…]+[\"')\]»]*\s+|\n+")
+
+
+class SendAudioProtocol(Protocol):
+    async def __call__(self, audio: BytesIO, text: str, last: bool) -> None:
+        raise NotImplementedError()
+
+
+class SentenceSplitter:
+    __slots__ = ("_buffer", "_min_length")
+
+    def __init__(self, min_length: int = 40):
+        self._buffer = ""
+        self._min_length = min_length
+
+    def feed(self, delta: str) -> list[str]:
+        self._buffer += delta
+
+        sentences = []
+        start = 0
+
+        for match in SENTENCE_END.finditer(self._buffer):
+            # too short sentences are glued with the next ones, one tts call per "Hi!" is a waste
+            if match.end() - start < self._min_length:
+                continue
+
+            sentence = self._buffer[start:match.end()].strip()
+            start = match.end()
+
+            if sentence:
+                sentences.append(sentence)
+
+        self._buffer = self._buffer[start:]
+
+        return sentences
+
+    def flush(self) -> Optional[str]:
+        sentence = self._buffer.strip()
+        self._buffer = ""
+
+        return sentence or None
+
+
+async def _send_in_order(queue: asyncio.Queue, send: SendAudioProtocol) -> None:
+    # one item is held back, so the sender knows which segment is the last one
+    previous = await queue.get()
+
+    while previous is not None:
+        current = await queue.get()
+
+        text, task = previous
+        await send(await task, text, current is None)
+
+        previous = current
+
+
+async def stream_speech(
+        deltas: AsyncIterable[str],
+        text_to_audio: TextToAudioInteractor,
+        getname: GetUniqueNameProtocol,
+        send: SendAudioProtocol,
+        splitter: Optional[SentenceSplitter] = None,
+        max_parallel: int = 3
+) -> str:
+    splitter = splitter or SentenceSplitter()
+    semaphore = asyncio.Semaphore(max_parallel)
+
+    async def synthesize(sentence: str) -> BytesIO:
+        async with semaphore:
+            return await text_to_audio.get_response(sentence, getname=getname)
+
+    queue: asyncio.Queue[Optional[tuple[str, asyncio.Task]]] = asyncio.Queue()
+    tasks: list[asyncio.Task] = []
+    sender = asyncio.create_task(_send_in_order(queue, send))
+
+    def schedule(sentence: str) -> None:
+        task = asyncio.create_task(synthesize(sentence))
+        tasks.append(task)
+
+        queue.put_nowait((sentence, task))
+
+    parts = []
+
+    try:
+        async for delta in deltas:
+            parts.append(delta)
+
+            for sentence in splitter.feed(delta):
+                schedule(sentence)
+
+            if sender.done():
+                # the sender failed, there is no reason to keep generating
+                break
+
+        tail = splitter.flush()
+        if tail:
+            schedule(tail)
+
+        queue.put_nowait(None)
+
+        await sender
+
+    finally:
+        sender.cancel()
+
+        for task in tasks:
+            task.cancel()
+
+    return "".join(parts)
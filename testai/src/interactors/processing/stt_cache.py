@@ -0,0 +1,56 @@
+
+
+from typing import Awaitable, BinaryIO, Callable, Optional
+
+from testai.src.interactors.caching import CacheStats, SingleFlight, TTLCache
+from testai.src.interactors.processing.getname import GetUniqueNameProtocol
+from testai.src.interactors.processing.audio_to_text import AudioToTextInteractor, WhisperAudioToTextInteractor
+
+
+class CachedAudioToText(AudioToTextInteractor):
+    __slots__ = ("_inner", "_cache", "_flight")
+
+    def __init__(self, inner: WhisperAudioToTextInteractor, ttl: float = 24 * 60 * 60, max_size: int = 10_000):
+        self._inner = inner
+        self._cache: TTLCache[str] = TTLCache(ttl=ttl, max_size=max_size)
+        self._flight: SingleFlight[str] = SingleFlight()
+
+    @property
+    def stats(self) -> CacheStats:
+        return self._cache.stats
+
+    async def get_response(
+            self,
+            audio: BinaryIO,
+            getname: GetUniqueNameProtocol,
+            duration: Optional[int] = None
+    ) -> str:
+        return await self._inner.get_response(audio, getname=getname, duration=duration)
+
+    async def _fetch(
+            self,
+            key: tuple[str, str],
+            download: Callable[[], Awaitable[BinaryIO]],
+            getname: GetUniqueNameProtocol,
+            duration: Optional[int]
+    ) -> str:
+        text = await self._inner.get_response(await download(), getname=getname, duration=duration)
+        self._cache.set(key, text)
+
+        return text
+
+    async def get_response_by_id(
+            self,
+            file_unique_id: str,
+            download: Callable[[], Awaitable[BinaryIO]],
+            getname: GetUniqueNameProtocol,
+            duration: Optional[int] = None
+    ) -> str:
+        # forwarded voices keep their file_unique_id, so a hit skips both the download and whisper
+        key = (file_unique_id, self._inner.model)
+
+        text = self._cache.get(key)
+        if text is not None:
+            return text
+
+        return await self._flight.do(key, lambda: self._fetch(key, download, getname, duration))
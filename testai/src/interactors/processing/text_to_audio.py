@@ -1,35 +1,103 @@
 
 from io import BytesIO
+from typing import AsyncIterator, Optional
 from abc import ABC, abstractmethod
 
 from openai import AsyncClient
 
 from testai.src.interactors.processing.getname import GetUniqueNameProtocol
+from testai.src.interactors.processing.codec import AudioCodec, AudioFormat, OPUS
 
 
 class TextToAudioInteractor(ABC):
+    @property
+    @abstractmethod
+    def audio_format(self) -> AudioFormat:
+        raise NotImplementedError()
+
     @abstractmethod
     async def get_response(self, text: str, getname: GetUniqueNameProtocol) -> BytesIO:
         raise NotImplementedError()
 
+    @abstractmethod
+    def stream_response(self, text: str) -> AsyncIterator[bytes]:
+        raise NotImplementedError()
+
 
 class TTSTextToAudio(TextToAudioInteractor):
-    __slots__ = ("_client",)
+    __slots__ = ("_client", "_chunk_size", "_model", "_voice", "_response_format", "_codec")
 
-    def __init__(self, client: AsyncClient):
+    def __init__(
+            self,
+            client: AsyncClient,
+            chunk_size: int = 64 * 1024,
+            model: str = "tts-1",
+            voice: str = "alloy",
+            response_format: AudioFormat = OPUS,
+            codec: Optional[AudioCodec] = None
+    ):
         self._client = client
+        self._chunk_size = chunk_size
+        self._model = model
+        self._voice = voice
+        self._response_format = response_format
+        self._codec = codec
+
+    @property
+    def model(self) -> str:
+        return self._model
+
+    @property
+    def voice(self) -> str:
+        return self._voice
+
+    @property
+    def response_format(self) -> AudioFormat:
+        return self._response_format
+
+    @property
+    def audio_format(self) -> AudioFormat:
+        # ogg/opus is the only format telegram shows as a voice message
+        if self._codec and self._response_format != OPUS:
+            return OPUS
+
+        return self._response_format
+
+    def _transcoded(self) -> bool:
+        return self.audio_format != self._response_format
 
     async def get_response(self, text: str, getname: GetUniqueNameProtocol) -> BytesIO:
         io = BytesIO()
-        io.name = getname(".mp3")
 
+        async for chunk in self._stream_speech(text):
+            io.write(chunk)
+
+        if self._transcoded():
+            io = BytesIO(await self._codec.transcode(io.getvalue(), self.audio_format))
+
+        io.name = getname(self.audio_format.extension)
+        io.seek(0)
+
+        return io
+
+    async def _stream_speech(self, text: str) -> AsyncIterator[bytes]:
         async with self._client.audio.speech.with_streaming_response.create(
-                model="tts-1",
-                voice="alloy",
+                model=self._model,
+                voice=self._voice,
                 input=text,
+                response_format=self._response_format.name,
         ) as response:
-            io.write(await response.read())
+            async for chunk in response.iter_bytes(self._chunk_size):
+                yield chunk
 
-        io.seek(0)
+    async def stream_response(self, text: str) -> AsyncIterator[bytes]:
+        if not self._transcoded():
+            async for chunk in self._stream_speech(text):
+                yield chunk
 
-        return io
+            return
+
+        # the transcoder needs the whole input, so this path can't be streamed
+        data = b"".join([chunk async for chunk in self._stream_speech(text)])
+
+        yield await self._codec.transcode(data, self.audio_format)
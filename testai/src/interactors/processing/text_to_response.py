@@ -1,13 +1,135 @@
 
 
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Optional, Protocol, Union
 from dataclasses import dataclass
 
-from openai import AsyncClient
-from openai.types.beta.assistant_stream_event import ThreadRunRequiresAction
+from openai import AsyncClient, AsyncStream
+from openai.types.beta.assistant_stream_event import AssistantStreamEvent
 from pydantic import BaseModel
 
+from testai.src.interactors.processing.thread_pool import ThreadPrefetcher
+
+
+class AssistantRegistryProtocol(Protocol):
+    async def get_or_create(
+            self,
+            model: str,
+            instructions: str,
+            tools: Optional[list[dict[str, Any]]],
+            create: Callable[[], Awaitable[str]]
+    ) -> str:
+        raise NotImplementedError()
+
+
+ASSISTANT_MODEL = "gpt-4-1106-preview"
+
+PSYCHOLOGIST_MODEL = "gpt-4o"
+PSYCHOLOGIST_INSTRUCTIONS = (
+    "You are a psychologist bot. "
+    "Your task is ASK ONE QUESTION PER MESSAGE and THEN call the function. "
+    "You don't have to ask questions directly. "
+    "You can give several messages to one question for accuracy and "
+    "in order to set up the user in a friendly way."
+)
+PSYCHOLOGIST_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "save_value",
+            "description":
+                (
+                    "This function determines the psychological representation of the user "
+                    "with whom it communicates. It is called only after ALL the necessary answers "
+                    "to the questions from the function parameters."
+                ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "profession": {
+                        "type": "string",
+                        "description": (
+                            "The user's job, or the job the user is studying for or planning to work for"
+                        )
+                    },
+                    "temperament": {
+                        "type": "string",
+                        "enum": ["Phlegmatic", "Sanguine", "Melancholic", "Choleric"],
+                        "description": (
+                            "The basis of a person's character, "
+                            "his standard reactions to others and situations"
+                        )
+                    }
+                },
+                "required": ["profession", "temperament"],
+                "additionalProperties": False},
+            "strict": True
+        },
+    },
+]
+
+
+@dataclass(slots=True, kw_only=True, frozen=True)
+class TextDelta:
+    text: str
+
+
+@dataclass(slots=True, kw_only=True, frozen=True)
+class ToolCall:
+    run_id: str
+    name: str
+    arguments: str
+
+
+ResponseEvent = Union[TextDelta, ToolCall]
+
+
+async def read_run_stream(
+        client: AsyncClient,
+        thread_id: str,
+        stream: AsyncStream[AssistantStreamEvent]
+) -> AsyncIterator[ResponseEvent]:
+    async with stream:
+        async for event in stream:
+            if event.event == "thread.message.delta":
+                for part in event.data.delta.content or ():
+                    if part.type == "text" and part.text and part.text.value:
+                        yield TextDelta(text=part.text.value)
+
+            elif event.event == "thread.run.requires_action":
+                await client.beta.threads.runs.cancel(
+                    thread_id=thread_id,
+                    run_id=event.data.id
+                )
+
+                for call in event.data.required_action.submit_tool_outputs.tool_calls:
+                    yield ToolCall(
+                        run_id=event.data.id,
+                        name=call.function.name,
+                        arguments=call.function.arguments
+                    )
+
+                # the run is cancelled, the rest of the stream is only its shutdown
+                return
+
+
+async def create_thread(client: AsyncClient) -> str:
+    thread = await client.beta.threads.create()
+
+    return thread.id
+
+
+async def iter_text(
+        events: AsyncIterable[ResponseEvent],
+        container: Optional["ContextBasedResponseContainer"] = None
+) -> AsyncIterator[str]:
+    async for event in events:
+        if isinstance(event, TextDelta):
+            yield event.text
+
+        elif container is not None and container.context is None:
+            container.context = event.arguments
+
 
 class TextToResponseInteractor(ABC):
     @abstractmethod
@@ -34,14 +156,31 @@ class TextToResponseInteractor(ABC):
     ) -> str:
         raise NotImplementedError()
 
+    @abstractmethod
+    def stream_response(
+            self,
+            request: str,
+            thread_id: str,
+            assistant_id: str,
+            instructions: Optional[str] = None,
+    ) -> AsyncIterator[ResponseEvent]:
+        raise NotImplementedError()
+
 
 class AssistantTextToResponseInteractor(TextToResponseInteractor):
-    __slots__ = ("_client",)
+    __slots__ = ("_client", "_registry", "_thread_pool")
 
-    def __init__(self, client: AsyncClient):
+    def __init__(
+            self,
+            client: AsyncClient,
+            registry: Optional[AssistantRegistryProtocol] = None,
+            thread_pool: Optional[ThreadPrefetcher] = None
+    ):
         self._client = client
+        self._registry = registry
+        self._thread_pool = thread_pool
 
-    async def new_assistant(
+    async def _create_assistant(
             self,
             name: str,
             instructions: str
@@ -49,14 +188,33 @@ class AssistantTextToResponseInteractor(TextToResponseInteractor):
         assistant = await self._client.beta.assistants.create(
             name=name,
             instructions=instructions,
-            model="gpt-4-1106-preview",
+            model=ASSISTANT_MODEL,
         )
 
         return assistant.id
 
+    async def new_assistant(
+            self,
+            name: str,
+            instructions: str
+    ) -> str:
+        if not self._registry:
+            return await self._create_assistant(name=name, instructions=instructions)
+
+        # the name is shown from our database only, so assistants which differ by name are shared
+        return await self._registry.get_or_create(
+            model=ASSISTANT_MODEL,
+            instructions=instructions,
+            tools=None,
+            create=lambda: self._create_assistant(name=name, instructions=instructions)
+        )
+
     async def new_thread(
             self
     ) -> str:
+        if self._thread_pool:
+            return await self._thread_pool.acquire()
+
         thread = await self._client.beta.threads.create()
 
         return thread.id
@@ -68,6 +226,22 @@ class AssistantTextToResponseInteractor(TextToResponseInteractor):
             assistant_id: str,
             instructions: Optional[str] = None
     ) -> str:
+        stream = self.stream_response(
+            request=request,
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            instructions=instructions
+        )
+
+        return "".join([text async for text in iter_text(stream)])
+
+    async def stream_response(
+            self,
+            request: str,
+            thread_id: str,
+            assistant_id: str,
+            instructions: Optional[str] = None
+    ) -> AsyncIterator[ResponseEvent]:
         await self._client.beta.threads.messages.create(
             thread_id=thread_id,
             role="user",
@@ -81,16 +255,8 @@ class AssistantTextToResponseInteractor(TextToResponseInteractor):
             stream=True,
         )
 
-        text = ""
-
-        async for event in stream:
-            try:
-                text += event.data.delta.content[0].text.value
-
-            except AttributeError:
-                pass
-
-        return text
+        async for event in read_run_stream(self._client, thread_id=thread_id, stream=stream):
+            yield event
 
 
 @dataclass(slots=True, kw_only=True)
@@ -121,13 +287,29 @@ class ContextBasedInteractor(ABC):
     ) -> ContextBasedResponseContainer:
         raise NotImplementedError()
 
+    @abstractmethod
+    def stream_response(
+            self,
+            request: str,
+            thread_id: str,
+            assistant_id: str
+    ) -> AsyncIterator[ResponseEvent]:
+        raise NotImplementedError()
 
-class AssistantFunctionInteractor(ContextBasedResponseContainer):
-    __slots__ = ("_client", "_cached")
 
-    def __init__(self, client: AsyncClient):
+class AssistantFunctionInteractor(ContextBasedInteractor):
+    __slots__ = ("_client", "_cached", "_registry", "_thread_pool")
+
+    def __init__(
+            self,
+            client: AsyncClient,
+            registry: Optional[AssistantRegistryProtocol] = None,
+            thread_pool: Optional[ThreadPrefetcher] = None
+    ):
         self._client = client
         self._cached = None
+        self._registry = registry
+        self._thread_pool = thread_pool
 
     async def get_response(
             self,
@@ -137,6 +319,21 @@ class AssistantFunctionInteractor(ContextBasedResponseContainer):
     ) -> ContextBasedResponseContainer:
         context = ContextBasedResponseContainer()
 
+        stream = self.stream_response(
+            request=request,
+            thread_id=thread_id,
+            assistant_id=assistant_id
+        )
+
+        context.text = "".join([text async for text in iter_text(stream, container=context)])
+        return context
+
+    async def stream_response(
+            self,
+            request: str,
+            thread_id: str,
+            assistant_id: str
+    ) -> AsyncIterator[ResponseEvent]:
         await self._client.beta.threads.messages.create(
             thread_id=thread_id,
             role="user",
@@ -149,86 +346,40 @@ class AssistantFunctionInteractor(ContextBasedResponseContainer):
             stream=True,
         )
 
-        text = ""
-
-        async for event in stream:
-            if isinstance(event, ThreadRunRequiresAction):
-                context.context = (
-                    event.data.required_action
-                    .submit_tool_outputs.tool_calls[0]
-                    .function.arguments
-                )
-
-                await self._client.beta.threads.runs.cancel(
-                    thread_id=thread_id,
-                    run_id=event.data.id
-                )
-
-            try:
-                text += event.data.delta.content[0].text.value
-
-            except AttributeError:
-                pass
-
-        context.text = text
-        return context
+        async for event in read_run_stream(self._client, thread_id=thread_id, stream=stream):
+            yield event
 
     async def new_thread(self) -> str:
+        if self._thread_pool:
+            return await self._thread_pool.acquire()
+
         thread = await self._client.beta.threads.create()
 
         return thread.id
 
+    async def _create_assistant(self) -> str:
+        assistant = await self._client.beta.assistants.create(
+            instructions=PSYCHOLOGIST_INSTRUCTIONS,
+            model=PSYCHOLOGIST_MODEL,
+            tools=PSYCHOLOGIST_TOOLS
+        )
+
+        return assistant.id
+
     async def new_assistant(self) -> str:
         if self._cached:
             return self._cached
 
-        assistant = await self._client.beta.assistants.create(
-            instructions=(
-                "You are a psychologist bot. "
-                "Your task is ASK ONE QUESTION PER MESSAGE and THEN call the function. "
-                "You don't have to ask questions directly. "
-                "You can give several messages to one question for accuracy and "
-                "in order to set up the user in a friendly way."
-            ),
-            model="gpt-4o",
-            tools=[
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "save_value",
-                        "description":
-                            (
-                                "This function determines the psychological representation of the user "
-                                "with whom it communicates. It is called only after ALL the necessary answers "
-                                "to the questions from the function parameters."
-                            ),
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "profession": {
-                                    "type": "string",
-                                    "description": (
-                                        "The user's job, or the job the user is studying for or planning to work for"
-                                    )
-                                },
-                                "temperament": {
-                                    "type": "string",
-                                    "enum": ["Phlegmatic", "Sanguine", "Melancholic", "Choleric"],
-                                    "description": (
-                                        "The basis of a person's character, "
-                                        "his standard reactions to others and situations"
-                                    )
-                                }
-                            },
-                            "required": ["profession", "temperament"],
-                            "additionalProperties": False},
-                        "strict": True
-                    },
-                },
-            ]
-        )
+        if self._registry:
+            self._cached = await self._registry.get_or_create(
+                model=PSYCHOLOGIST_MODEL,
+                instructions=PSYCHOLOGIST_INSTRUCTIONS,
+                tools=PSYCHOLOGIST_TOOLS,
+                create=self._create_assistant
+            )
 
-        self._cached = assistant.id
+        else:
+            self._cached = await self._create_assistant()
 
         return self._cached
 
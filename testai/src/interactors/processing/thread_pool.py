@@ -0,0 +1,129 @@
+
+
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True, kw_only=True)
+class ThreadPoolStats:
+    hits: int = 0
+    misses: int = 0
+    created: int = 0
+    failures: int = 0
+    # moving average of the time from taking a thread to having its replacement ready
+    refill_lag: float = 0.0
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+
+        return self.hits / total if total else 0.0
+
+
+class ThreadPrefetcher:
+    __slots__ = (
+        "_create",
+        "_min_size",
+        "_max_size",
+        "_window",
+        "_ready",
+        "_taken",
+        "_demand",
+        "_creation_time",
+        "_refill",
+        "_stats"
+    )
+
+    def __init__(
+            self,
+            create: Callable[[], Awaitable[str]],
+            min_size: int = 2,
+            max_size: int = 50,
+            window: float = 60.0
+    ):
+        self._create = create
+        self._min_size = min_size
+        self._max_size = max_size
+        self._window = window
+
+        self._ready: deque[str] = deque()
+        self._taken: deque[float] = deque(maxlen=max_size)
+        self._demand: deque[float] = deque()
+        self._creation_time = 0.5
+        self._refill: Optional[asyncio.Task] = None
+        self._stats = ThreadPoolStats()
+
+    @property
+    def stats(self) -> ThreadPoolStats:
+        return self._stats
+
+    def __len__(self) -> int:
+        return len(self._ready)
+
+    def target_size(self) -> int:
+        now = time.monotonic()
+
+        while self._demand and self._demand[0] < now - self._window:
+            self._demand.popleft()
+
+        # enough threads to cover the demand during two refill round trips
+        rate = len(self._demand) / self._window
+        target = math.ceil(rate * self._creation_time * 2)
+
+        return max(self._min_size, min(self._max_size, target))
+
+    def fill(self) -> None:
+        if self._refill is None or self._refill.done():
+            self._refill = asyncio.create_task(self._fill())
+
+    async def _create_one(self) -> None:
+        started = time.monotonic()
+
+        try:
+            thread_id = await self._create()
+
+        except Exception:
+            self._stats.failures += 1
+            logger.exception("Thread prefetch failed")
+            return
+
+        now = time.monotonic()
+        self._creation_time = 0.8 * self._creation_time + 0.2 * (now - started)
+
+        self._ready.append(thread_id)
+        self._stats.created += 1
+
+        if self._taken:
+            self._stats.refill_lag = 0.8 * self._stats.refill_lag + 0.2 * (now - self._taken.popleft())
+
+    async def _fill(self) -> None:
+        while (missing := self.target_size() - len(self._ready)) > 0:
+            failures = self._stats.failures
+
+            await asyncio.gather(*[self._create_one() for _ in range(missing)])
+
+            if self._stats.failures != failures:
+                # the api is not healthy, the next acquire will try again
+                return
+
+    async def acquire(self) -> str:
+        now = time.monotonic()
+        self._demand.append(now)
+
+        if self._ready:
+            self._stats.hits += 1
+            self._taken.append(now)
+            self.fill()
+
+            return self._ready.popleft()
+
+        self._stats.misses += 1
+        self.fill()
+
+        return await self._create()
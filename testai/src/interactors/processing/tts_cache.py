@@ -0,0 +1,251 @@
+
+
+import os
+import time
+import asyncio
+import hashlib
+from io import BytesIO
+from pathlib import Path
+from dataclasses import dataclass
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
+
+from testai.src.interactors.caching import CacheStats, SingleFlight
+from testai.src.interactors.processing.codec import AudioFormat
+from testai.src.interactors.processing.getname import GetUniqueNameProtocol
+from testai.src.interactors.processing.text_to_audio import TextToAudioInteractor, TTSTextToAudio
+
+
+@dataclass(slots=True, kw_only=True)
+class TTSCacheStats(CacheStats):
+    disk_hits: int = 0
+    shared: int = 0
+    memory_bytes: int = 0
+    disk_bytes: int = 0
+    disk_evictions: int = 0
+
+
+# a temporary file older than this was left by a crashed write, if its process is gone
+STALE_TMP_AGE = 60 * 60
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+
+    except ProcessLookupError:
+        return False
+
+    except PermissionError:
+        return True
+
+    return True
+
+
+class CachedTextToAudio(TextToAudioInteractor):
+    __slots__ = (
+        "_inner",
+        "_memory",
+        "_max_memory_bytes",
+        "_max_text_length",
+        "_directory",
+        "_disk",
+        "_max_disk_bytes",
+        "_chunk_size",
+        "_flight",
+        "_stats"
+    )
+
+    def __init__(
+            self,
+            inner: TTSTextToAudio,
+            max_memory_bytes: int = 32 * 1024 * 1024,
+            directory: Optional[str] = None,
+            max_disk_bytes: int = 512 * 1024 * 1024,
+            max_text_length: int = 500,
+            chunk_size: int = 64 * 1024
+    ):
+        self._inner = inner
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._max_memory_bytes = max_memory_bytes
+        self._max_text_length = max_text_length
+        self._directory = Path(directory) if directory else None
+        # the sizes of the files on disk, the least recently used first,
+        # every process counts the files it found at the start and its own writes, so the limit is per process
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._max_disk_bytes = max_disk_bytes
+        self._chunk_size = chunk_size
+        self._flight: SingleFlight[bytes] = SingleFlight()
+        self._stats = TTSCacheStats()
+
+        if self._directory:
+            self._directory.mkdir(parents=True, exist_ok=True)
+            self._scan_disk()
+
+    @property
+    def stats(self) -> TTSCacheStats:
+        return self._stats
+
+    @property
+    def audio_format(self) -> AudioFormat:
+        return self._inner.audio_format
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(
+            f"{self._inner.model}\0{self._inner.voice}\0{self._inner.audio_format.name}\0{text}".encode()
+        ).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self._directory / key[:2] / key
+
+    def _memory_get(self, key: str) -> Optional[bytes]:
+        data = self._memory.get(key)
+
+        if data is not None:
+            self._memory.move_to_end(key)
+
+        return data
+
+    def _memory_put(self, key: str, data: bytes) -> None:
+        if len(data) > self._max_memory_bytes or key in self._memory:
+            return
+
+        self._memory[key] = data
+        self._stats.memory_bytes += len(data)
+
+        while self._stats.memory_bytes > self._max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+
+            self._stats.memory_bytes -= len(evicted)
+            self._stats.evictions += 1
+
+    def _scan_disk(self) -> None:
+        # the files left by the previous runs, the modification time is the time of the last use
+        files = []
+
+        for path in self._directory.glob("*/*"):
+            try:
+                stat = path.stat()
+
+            except FileNotFoundError:
+                # renamed or removed by another process meanwhile
+                continue
+
+            if path.suffix:
+                # a temporary file, another process may be writing it right now
+                _, pid, _ = path.name.split(".")
+
+                if time.time() - stat.st_mtime > STALE_TMP_AGE and not process_alive(int(pid)):
+                    path.unlink(missing_ok=True)
+
+                continue
+
+            files.append((stat.st_mtime, path.name, stat.st_size))
+
+        for _, key, size in sorted(files):
+            self._disk[key] = size
+            self._stats.disk_bytes += size
+
+    def _disk_get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+
+        except FileNotFoundError:
+            # evicted by another worker which shares the directory
+            return None
+
+        return data
+
+    def _disk_put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+
+        # write and rename, so a crash never leaves a half written entry
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def _disk_remove(self, keys: list[str]) -> None:
+        for key in keys:
+            self._path(key).unlink(missing_ok=True)
+
+    async def _disk_store(self, key: str, data: bytes) -> None:
+        if len(data) > self._max_disk_bytes:
+            return
+
+        await asyncio.to_thread(self._disk_put, key, data)
+
+        self._stats.disk_bytes += len(data) - self._disk.pop(key, 0)
+        self._disk[key] = len(data)
+
+        evicted = []
+        while self._stats.disk_bytes > self._max_disk_bytes:
+            key, size = self._disk.popitem(last=False)
+            evicted.append(key)
+
+            self._stats.disk_bytes -= size
+            self._stats.disk_evictions += 1
+
+        if evicted:
+            await asyncio.to_thread(self._disk_remove, evicted)
+
+    async def _fetch(self, key: str, text: str) -> bytes:
+        if self._directory:
+            data = await asyncio.to_thread(self._disk_get, key)
+
+            if data is not None:
+                self._stats.disk_hits += 1
+                self._memory_put(key, data)
+
+                if key in self._disk:
+                    self._disk.move_to_end(key)
+
+                return data
+
+        self._stats.misses += 1
+
+        data = b"".join([chunk async for chunk in self._inner.stream_response(text)])
+        self._memory_put(key, data)
+
+        if self._directory:
+            await self._disk_store(key, data)
+
+        return data
+
+    async def _load(self, text: str) -> bytes:
+        key = self._key(text)
+
+        data = self._memory_get(key)
+        if data is not None:
+            self._stats.hits += 1
+            return data
+
+        if key in self._flight:
+            self._stats.shared += 1
+
+        return await self._flight.do(key, lambda: self._fetch(key, text))
+
+    async def get_response(self, text: str, getname: GetUniqueNameProtocol) -> BytesIO:
+        if len(text) > self._max_text_length:
+            return await self._inner.get_response(text, getname=getname)
+
+        io = BytesIO(await self._load(text))
+        io.name = getname(self.audio_format.extension)
+
+        return io
+
+    async def stream_response(self, text: str) -> AsyncIterator[bytes]:
+        # long answers almost never repeat, they would only wash the short ones out of memory
+        if len(text) > self._max_text_length:
+            async for chunk in self._inner.stream_response(text):
+                yield chunk
+
+            return
+
+        view = memoryview(await self._load(text))
+
+        for start in range(0, len(view), self._chunk_size):
+            yield view[start:start + self._chunk_size]
@@ -0,0 +1,297 @@
+
+
+import re
+import time
+import heapq
+import asyncio
+import itertools
+from enum import IntEnum
+from contextvars import ContextVar
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Iterator, Optional, TypeVar
+
+import httpx
+
+T = TypeVar("T")
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    NORMAL = 1
+    BACKGROUND = 2
+
+
+current_priority: ContextVar[Priority] = ContextVar("current_priority", default=Priority.NORMAL)
+current_user: ContextVar[Optional[Hashable]] = ContextVar("current_user", default=None)
+
+
+@contextmanager
+def scheduling(priority: Optional[Priority] = None, user: Optional[Hashable] = None) -> Iterator[None]:
+    tokens = []
+
+    if priority is not None:
+        tokens.append((current_priority, current_priority.set(priority)))
+
+    if user is not None:
+        tokens.append((current_user, current_user.set(user)))
+
+    try:
+        yield
+
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def in_background(func: Callable[[], Awaitable[T]]) -> Callable[[], Awaitable[T]]:
+    async def wrapper() -> T:
+        with scheduling(priority=Priority.BACKGROUND):
+            return await func()
+
+    return wrapper
+
+
+@dataclass(slots=True, kw_only=True)
+class EndpointStats:
+    limit: float
+    in_flight: int = 0
+    queued: int = 0
+    max_queued: int = 0
+    completed: int = 0
+    throttled: int = 0
+    failures: int = 0
+    # moving averages in seconds
+    latency: float = 0.0
+    queue_time: float = 0.0
+
+
+@dataclass(slots=True, order=True)
+class _Waiter:
+    priority: int
+    tag: float
+    sequence: int
+    future: asyncio.Future = field(compare=False)
+    enqueued_at: float = field(compare=False)
+
+
+class EndpointLimiter:
+    __slots__ = (
+        "_min_limit",
+        "_max_limit",
+        "_tolerance",
+        "_baseline",
+        "_queue",
+        "_virtual_time",
+        "_user_tags",
+        "_sequence",
+        "_stats"
+    )
+
+    def __init__(
+            self,
+            initial_limit: int = 8,
+            min_limit: int = 1,
+            max_limit: int = 64,
+            tolerance: float = 2.0
+    ):
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._tolerance = tolerance
+        self._baseline: Optional[float] = None
+
+        self._queue: list[_Waiter] = []
+        self._virtual_time = 0.0
+        self._user_tags: dict[Hashable, float] = {}
+        self._sequence = itertools.count()
+        self._stats = EndpointStats(limit=initial_limit)
+
+    @property
+    def stats(self) -> EndpointStats:
+        return self._stats
+
+    def _tag(self, user: Optional[Hashable]) -> float:
+        # start time fair queuing, a user with many waiting calls only delays their own calls
+        if user is None:
+            return self._virtual_time
+
+        tag = max(self._virtual_time, self._user_tags.get(user, 0.0)) + 1
+        self._user_tags[user] = tag
+
+        return tag
+
+    async def acquire(self, priority: Priority, user: Optional[Hashable]) -> None:
+        if not self._queue and self._stats.in_flight < self._stats.limit:
+            self._stats.in_flight += 1
+            return
+
+        waiter = _Waiter(
+            priority=priority,
+            tag=self._tag(user),
+            sequence=next(self._sequence),
+            future=asyncio.get_running_loop().create_future(),
+            enqueued_at=time.monotonic()
+        )
+        heapq.heappush(self._queue, waiter)
+
+        self._stats.queued += 1
+        self._stats.max_queued = max(self._stats.max_queued, self._stats.queued)
+
+        try:
+            await waiter.future
+
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # the slot was handed over right before the cancellation, no request was sent with it
+                self._free()
+
+            else:
+                waiter.future.cancel()
+                self._stats.queued -= 1
+
+            raise
+
+    def _dispatch(self) -> None:
+        while self._queue and self._stats.in_flight < self._stats.limit:
+            waiter = heapq.heappop(self._queue)
+
+            if waiter.future.done():
+                # cancelled while waiting, it is already not counted
+                continue
+
+            self._stats.queued -= 1
+            self._virtual_time = max(self._virtual_time, waiter.tag)
+            self._stats.queue_time = 0.8 * self._stats.queue_time + 0.2 * (time.monotonic() - waiter.enqueued_at)
+            self._stats.in_flight += 1
+
+            waiter.future.set_result(None)
+
+        if not self._queue:
+            # nobody waits, the fairness history is not needed anymore
+            self._user_tags.clear()
+
+    def _free(self) -> None:
+        self._stats.in_flight -= 1
+        self._dispatch()
+
+    def release(self, latency: Optional[float], throttled: bool) -> None:
+        stats = self._stats
+
+        if throttled:
+            stats.throttled += 1
+            stats.limit = max(self._min_limit, stats.limit / 2)
+
+        elif latency is None:
+            stats.failures += 1
+
+        else:
+            stats.completed += 1
+            stats.latency = 0.8 * stats.latency + 0.2 * latency if stats.completed > 1 else latency
+
+            # the baseline slowly forgets, so a permanently slower api is not punished forever
+            self._baseline = latency if self._baseline is None else min(latency, self._baseline * 1.01)
+
+            if latency > self._baseline * self._tolerance:
+                stats.limit = max(self._min_limit, stats.limit * 0.9)
+
+            else:
+                stats.limit = min(self._max_limit, stats.limit + 1 / stats.limit)
+
+        self._free()
+
+
+# ids in the paths, like thread_abc or asst_abc, are not part of the endpoint
+ID_SEGMENT = re.compile(r"^[a-z]+_[A-Za-z0-9]+$")
+
+
+def endpoint_of(path: str) -> str:
+    return "/".join("{id}" if ID_SEGMENT.match(segment) else segment for segment in path.split("/"))
+
+
+class OpenAIScheduler:
+    __slots__ = ("_limiters", "_initial_limit", "_min_limit", "_max_limit")
+
+    def __init__(self, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 64):
+        self._limiters: dict[str, EndpointLimiter] = {}
+        self._initial_limit = initial_limit
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+
+    def limiter(self, endpoint: str) -> EndpointLimiter:
+        limiter = self._limiters.get(endpoint)
+
+        if limiter is None:
+            limiter = EndpointLimiter(
+                initial_limit=self._initial_limit,
+                min_limit=self._min_limit,
+                max_limit=self._max_limit
+            )
+            self._limiters[endpoint] = limiter
+
+        return limiter
+
+    def stats(self) -> dict[str, EndpointStats]:
+        return {endpoint: limiter.stats for endpoint, limiter in self._limiters.items()}
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    __slots__ = ("_stream", "_release")
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+
+        finally:
+            self._release()
+
+
+class ScheduledTransport(httpx.AsyncBaseTransport):
+    __slots__ = ("_scheduler", "_inner")
+
+    def __init__(self, scheduler: OpenAIScheduler, inner: Optional[httpx.AsyncBaseTransport] = None):
+        self._scheduler = scheduler
+        self._inner = inner or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        limiter = self._scheduler.limiter(f"{request.method} {endpoint_of(request.url.path)}")
+
+        await limiter.acquire(priority=current_priority.get(), user=current_user.get())
+        started = time.monotonic()
+
+        try:
+            response = await self._inner.handle_async_request(request)
+
+        except BaseException:
+            limiter.release(latency=None, throttled=False)
+            raise
+
+        # the latency is the time to the headers, streamed runs and speech would distort it
+        latency = time.monotonic() - started
+        throttled = response.status_code == 429
+        released = False
+
+        def release() -> None:
+            nonlocal released
+
+            if not released:
+                released = True
+                limiter.release(latency=None if response.status_code >= 500 else latency, throttled=throttled)
+
+        # the slot is held until the body is read, a streamed run is one long call for the api
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, release),
+            extensions=response.extensions
+        )
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
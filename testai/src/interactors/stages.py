@@ -0,0 +1,52 @@
+
+
+import asyncio
+from typing import Any, Awaitable, Callable
+
+
+class StageGraph:
+    __slots__ = ("_stages", )
+
+    def __init__(self):
+        self._stages: dict[str, tuple[Callable[..., Awaitable[Any]], tuple[str, ...]]] = {}
+
+    def add(self, name: str, func: Callable[..., Awaitable[Any]], *dependencies: str) -> "StageGraph":
+        if name in self._stages:
+            raise ValueError(f"Stage {name} is already defined")
+
+        # dependencies have to be added first, so the graph can't have cycles
+        for dependency in dependencies:
+            if dependency not in self._stages:
+                raise ValueError(f"Undefined stage {dependency}")
+
+        self._stages[name] = (func, dependencies)
+
+        return self
+
+    async def run(self) -> dict[str, Any]:
+        tasks: dict[str, asyncio.Task] = {}
+
+        async def run_stage(name: str) -> Any:
+            func, dependencies = self._stages[name]
+
+            # results of the dependencies are passed by their stage names
+            kwargs = {dependency: await tasks[dependency] for dependency in dependencies}
+
+            return await func(**kwargs)
+
+        for name in self._stages:
+            tasks[name] = asyncio.create_task(run_stage(name))
+
+        try:
+            done, _ = await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+
+            for task in done:
+                if not task.cancelled() and task.exception():
+                    raise task.exception()
+
+        finally:
+            # on a failure the stages which are still running are useless
+            for task in tasks.values():
+                task.cancel()
+
+        return {name: task.result() for name, task in tasks.items()}
@@ -0,0 +1,72 @@
+
+
+import asyncio
+import argparse
+from typing import Optional
+from pathlib import Path
+
+import asyncpg
+
+from testai.config.config_reader import get_config
+from testai.src.interactors.database.gateways.user_bulk import AsyncpgUserBulkGateWay
+from testai.src.interactors.database.repositories.user_bulk import FORMATS, UserBulkRepo
+
+
+def format_of(path: Path, format: Optional[str]) -> str:
+    format = format or path.suffix.lstrip(".").lower()
+
+    if format not in FORMATS:
+        raise SystemExit(f"can not tell the format of {path}, pass --format {' or '.join(FORMATS)}")
+
+    return format
+
+
+async def import_users(repo: UserBulkRepo, path: Path, format: str) -> None:
+    with path.open("r", encoding="utf-8", newline="") as file:
+        stats = await repo.import_users(file, format)
+
+    print(
+        f"{stats.records} records, {stats.users} new users, "
+        f"{stats.assistants} new assistants, {stats.mentals} mental profiles written"
+    )
+
+
+async def export_users(repo: UserBulkRepo, path: Path, format: str) -> None:
+    with path.open("wb") as file:
+        async def write(chunk: bytes) -> None:
+            file.write(chunk)
+
+        await repo.export_users(write, format)
+
+
+async def run(args: argparse.Namespace) -> None:
+    path = Path(args.path)
+    format = format_of(path, args.format)
+
+    connection = await asyncpg.connect(get_config().database_url)
+
+    try:
+        repo = UserBulkRepo(gateway=AsyncpgUserBulkGateWay(connection=connection, batch_size=args.batch_size))
+
+        if args.command == "import":
+            await import_users(repo, path, format)
+
+        else:
+            await export_users(repo, path, format)
+
+    finally:
+        await connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="moves users, assistants and mental profiles between databases")
+    parser.add_argument("command", choices=("import", "export"))
+    parser.add_argument("path", help="a .csv or .ndjson file")
+    parser.add_argument("--format", choices=FORMATS, help="taken from the file extension by default")
+    parser.add_argument("--batch-size", type=int, default=10_000)
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
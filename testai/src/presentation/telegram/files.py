@@ -0,0 +1,47 @@
+
+
+from io import BytesIO
+from typing import AsyncIterator, Callable, Optional
+
+from aiogram import Bot
+from aiogram.types import InputFile
+from aiogram.types.input_file import DEFAULT_CHUNK_SIZE
+
+
+class BytesIOInputFile(InputFile):
+    __slots__ = ("_file", )
+
+    def __init__(self, file: BytesIO, filename: Optional[str] = None, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        super().__init__(filename=filename or getattr(file, "name", None), chunk_size=chunk_size)
+
+        self._file = file
+
+    async def read(self, bot: Bot) -> AsyncIterator[memoryview]:
+        # slices of the buffer itself, BufferedInputFile(file.read()) would copy the whole audio
+        view = self._file.getbuffer()
+
+        try:
+            for start in range(0, len(view), self.chunk_size):
+                yield view[start:start + self.chunk_size]
+
+        finally:
+            view.release()
+
+
+class StreamInputFile(InputFile):
+    __slots__ = ("_factory", )
+
+    def __init__(
+            self,
+            factory: Callable[[], AsyncIterator[bytes]],
+            filename: str,
+            chunk_size: int = DEFAULT_CHUNK_SIZE
+    ):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+
+        self._factory = factory
+
+    async def read(self, bot: Bot) -> AsyncIterator[bytes]:
+        # the source is opened only when the upload starts, chunks are passed to telegram as they arrive
+        async for chunk in self._factory():
+            yield chunk
@@ -1,34 +1,81 @@
-
-
+import os
+import signal
 import asyncio
+import multiprocessing
+from functools import partial
 
+import httpx
 from aiogram import Dispatcher, Bot
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import SimpleEventIsolation, MemoryStorage
-from openai import AsyncClient
+from openai import AsyncClient, DEFAULT_CONNECTION_LIMITS, DefaultAsyncHttpxClient
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 
-from testai.config.config_reader import get_config
+from testai.config.config_reader import Config, get_config
+from testai.src.interactors.coalescing import Coalescer
+from testai.src.interactors.database.gateways.fsm import fsm_gateway_scope
+from testai.src.interactors.database.gateways.user_asyncpg import create_user_pool
+from testai.src.interactors.database.gateways.user_memory import MemoryUserStore
+from testai.src.interactors.scheduling import OpenAIScheduler, ScheduledTransport
 from testai.src.presentation.telegram.routers import audio
 from testai.src.presentation.telegram.middlewares.di import DIMiddleware
+from testai.src.presentation.telegram.progressive import ChatEditLimiter
+from testai.src.presentation.telegram.storage import PostgresStorage
+from testai.src.presentation.telegram.webhook import create_webhook_app, serve_webhook_app
 
 
-async def main():
-    config = get_config()
+def build_bot(config: Config) -> Bot:
+    session = None
+    if config.telegram_api_url:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(config.telegram_api_url))
+
+    return Bot(token=config.bot_token, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 
-    bot = Bot(token=config.bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher(storage=MemoryStorage(), events_isolation=SimpleEventIsolation())
 
-    openai = AsyncClient(api_key=config.openai_key)
+async def build_dispatcher(config: Config, shards: int = 1) -> Dispatcher:
+    # more than one process handles the updates, a copy kept by one of them is not invalidated by the others
+    shared = config.webhook_workers > 1 or shards > 1
+
+    if config.database_driver == "memory" and shared:
+        # every process would have users of its own, created with the same ids
+        raise ValueError("the memory database driver runs in a single process only")
+
+    # every openai call goes through the scheduler, so bursts queue up instead of hitting 429s
+    scheduler = OpenAIScheduler(
+        initial_limit=config.openai_initial_concurrency,
+        max_limit=config.openai_max_concurrency
+    )
+    openai = AsyncClient(
+        api_key=config.openai_key,
+        base_url=config.openai_base_url,
+        # with a transport given httpx ignores the limits of the client, so the sending transport gets openai's
+        http_client=DefaultAsyncHttpxClient(transport=ScheduledTransport(
+            scheduler,
+            inner=httpx.AsyncHTTPTransport(limits=DEFAULT_CONNECTION_LIMITS)
+        ))
+    )
+
+    # every shard has its own pools, together they keep to the configured size
+    pool_size = max(1, config.database_pool_size // shards)
+    max_overflow = config.database_max_overflow // shards
+
+    user_pool_size = 0
+    if config.database_driver == "asyncpg":
+        # the users have a pool of their own, it takes half of the budget and sqlalchemy keeps the rest
+        user_pool_size = max(1, (pool_size + max_overflow) // 2)
+        pool_size = max(1, pool_size - pool_size // 2)
+        max_overflow -= max_overflow // 2
 
     engine = create_async_engine(
         config.get_sqlalchemy_database_url(),
-        pool_size=50,
+        pool_size=pool_size,
         pool_timeout=15,
         pool_recycle=1500,
         pool_pre_ping=True,
-        max_overflow=30,
+        max_overflow=max_overflow,
         connect_args={
             "server_settings": {"jit": "off"}
         }
@@ -36,12 +83,161 @@ async def main():
 
     sessionmaker = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 
-    dp.message.middleware(DIMiddleware(client=openai, sessionmaker=sessionmaker))
-    dp.callback_query.middleware(DIMiddleware(client=openai, sessionmaker=sessionmaker))
+    if config.fsm_storage == "postgres":
+        # the states survive restarts and are shared by all the bot processes
+        storage = PostgresStorage(
+            gateway_scope=partial(fsm_gateway_scope, sessionmaker),
+            flush_interval=config.fsm_flush_interval,
+            state_ttl=config.fsm_state_ttl,
+            shared=shared
+        )
+
+    else:
+        storage = MemoryStorage()
+
+    events_isolation = SimpleEventIsolation()
+
+    dp = Dispatcher(storage=storage, events_isolation=events_isolation)
+    dp["stream_voice_replies"] = config.stream_voice_replies
+    dp["progressive_text_replies"] = config.progressive_text_replies
+    dp["edit_limiter"] = ChatEditLimiter()
+    # the detached replies lock the state of their user like the dispatcher does for an update
+    dp["events_isolation"] = events_isolation
+
+    voice_coalescer = Coalescer(window=config.voice_coalesce_window, max_workers=config.voice_reply_concurrency)
+    dp["voice_coalescer"] = voice_coalescer
+    # the replies in flight are finished first, they still use the database and the storage
+    dp.shutdown.register(voice_coalescer.close)
+
+    user_pool = None
+    if config.database_driver == "asyncpg":
+        user_pool = await create_user_pool(config.database_url, max_size=user_pool_size)
+        dp.shutdown.register(user_pool.close)
+
+    user_store = None
+    if config.database_driver == "memory":
+        user_store = MemoryUserStore(path=config.user_snapshot_path)
+        user_store.load()
+        user_store.start(config.user_snapshot_interval)
+        dp.shutdown.register(user_store.close)
+
+    # one instance for both, so the caches inside are shared
+    di = DIMiddleware(
+        client=openai,
+        sessionmaker=sessionmaker,
+        config=config,
+        user_pool=user_pool,
+        user_store=user_store,
+        shared=shared
+    )
+
+    dp.message.middleware(di)
+    dp.callback_query.middleware(di)
+    dp.shutdown.register(di.close)
+    # the dispatcher registers the storage close first, it is moved after the replies are finished
+    dp.shutdown.handlers.sort(key=lambda handler: handler.callback == dp.fsm.close)
+
+    await di.warm_up()
 
     dp.include_router(audio.router)
 
+    return dp
+
+
+async def run_polling(config: Config):
+    bot = build_bot(config)
+    dp = await build_dispatcher(config)
+
+    # telegram does not give updates to getUpdates while a webhook is set
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
 
-asyncio.run(main())
+async def run_webhook_worker(config: Config):
+    bot = build_bot(config)
+    dp = await build_dispatcher(config)
+
+    app = create_webhook_app(
+        dispatcher=dp,
+        bot=bot,
+        path=config.webhook_path,
+        secret_token=config.webhook_secret,
+        max_concurrency=config.webhook_max_concurrency,
+        max_pending=config.webhook_max_pending
+    )
+
+    await serve_webhook_app(
+        app,
+        host=config.webhook_host,
+        port=config.webhook_port,
+        reuse_port=config.webhook_workers > 1
+    )
+
+
+def webhook_worker():
+    asyncio.run(run_webhook_worker(get_config()))
+
+
+async def set_webhook(config: Config):
+    if not config.webhook_url:
+        raise ValueError("webhook_url is required in the webhook mode")
+
+    bot = build_bot(config)
+
+    async with bot.session:
+        await bot.set_webhook(
+            url=config.webhook_url.rstrip("/") + config.webhook_path,
+            secret_token=config.webhook_secret,
+            max_connections=config.webhook_max_connections
+        )
+
+
+def serve_webhook(config: Config):
+    # the webhook is registered once, not by every worker
+    asyncio.run(set_webhook(config))
+
+    if config.webhook_workers <= 1:
+        webhook_worker()
+        return
+
+    workers = [
+        multiprocessing.Process(target=webhook_worker, name=f"webhook-worker-{index}")
+        for index in range(config.webhook_workers)
+    ]
+
+    for worker in workers:
+        worker.start()
+
+    # a stop is passed to the workers, they finish their updates and the parent waits for them
+    def forward(signum: int, frame) -> None:
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    # set after the start, so the workers do not inherit it
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    try:
+        for worker in workers:
+            worker.join()
+
+    finally:
+        # only the workers which are still alive after an error of the parent
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+
+def main():
+    config = get_config()
+
+    if config.bot_mode == "webhook":
+        serve_webhook(config)
+
+    else:
+        asyncio.run(run_polling(config))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,43 @@
 
 
-from typing import Callable, Any
+from typing import AsyncIterator, Callable, Any, Optional
+from functools import partial
+from contextlib import asynccontextmanager
 
+import asyncpg
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
 from openai import AsyncClient
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
-from testai.src.interactors.database.gateways.user import UserGateWay
-from testai.src.interactors.database.repositories.user import UserRepo
+from testai.config.config_reader import Config
+from testai.src.interactors.database.gateways.user import LazyUserGateWay, UserWriteBatcher, user_gateway_scope
+from testai.src.interactors.database.gateways.user_asyncpg import AsyncpgUserGateWay, asyncpg_user_gateway_scope
+from testai.src.interactors.database.gateways.user_memory import (
+    MemoryUserGateWay,
+    MemoryUserStore,
+    memory_user_gateway_scope
+)
+from testai.src.interactors.database.gateways.assistant import (
+    MemoryAssistantRegistryGateWay,
+    assistant_registry_scope,
+    memory_registry_scope
+)
+from testai.src.interactors.database.repositories.user import UserCache, UserRepo
+from testai.src.interactors.database.repositories.assistant import AssistantRegistry
 from testai.src.interactors.processing.text_to_response import (
     AssistantTextToResponseInteractor,
     CompletitionsBasedConfirmTextFormat,
-    AssistantFunctionInteractor
+    AssistantFunctionInteractor,
+    create_thread
 )
 from testai.src.interactors.processing.audio_to_text import WhisperAudioToTextInteractor
 from testai.src.interactors.processing.text_to_audio import TTSTextToAudio
+from testai.src.interactors.processing.tts_cache import CachedTextToAudio
+from testai.src.interactors.processing.stt_cache import CachedAudioToText
+from testai.src.interactors.processing.thread_pool import ThreadPrefetcher
+from testai.src.interactors.processing.codec import AudioCodec, FORMATS
+from testai.src.interactors.scheduling import Priority, in_background, scheduling
 
 
 class DIMiddleware(BaseMiddleware):
@@ -26,17 +48,116 @@ class DIMiddleware(BaseMiddleware):
         "_audio_to_text",
         "_confirm_text",
         "_context_based_assistant",
-        "_sessionmaker"
+        "_codec",
+        "_assistant_registry",
+        "_thread_pool",
+        "_user_cache",
+        "_sessionmaker",
+        "_user_pool",
+        "_user_store",
+        "_user_batcher"
     )
 
-    def __init__(self, client: AsyncClient, sessionmaker: async_sessionmaker):
+    def __init__(
+            self,
+            client: AsyncClient,
+            sessionmaker: async_sessionmaker,
+            config: Config,
+            user_pool: Optional[asyncpg.Pool] = None,
+            user_store: Optional[MemoryUserStore] = None,
+            shared: bool = False
+    ):
         self._client = client
-        self._text_to_response = AssistantTextToResponseInteractor(client=self._client)
-        self._text_to_audio = TTSTextToAudio(client=self._client)
-        self._audio_to_text = WhisperAudioToTextInteractor(client=self._client)
+        self._codec = AudioCodec()
+
+        registry_scope = partial(assistant_registry_scope, sessionmaker)
+        if user_store is not None:
+            # with the users in memory nothing is left in the database
+            registry_scope = partial(memory_registry_scope, MemoryAssistantRegistryGateWay())
+
+        self._assistant_registry = AssistantRegistry(gateway_scope=registry_scope)
+        # threads do not depend on the assistant, so both interactors take them from one pool
+        self._thread_pool = ThreadPrefetcher(
+            create=in_background(partial(create_thread, self._client)),
+            min_size=config.thread_pool_min_size,
+            max_size=config.thread_pool_max_size
+        )
+        self._text_to_response = AssistantTextToResponseInteractor(
+            client=self._client,
+            registry=self._assistant_registry,
+            thread_pool=self._thread_pool
+        )
+        self._text_to_audio = CachedTextToAudio(
+            inner=TTSTextToAudio(
+                client=self._client,
+                response_format=FORMATS[config.tts_response_format],
+                codec=self._codec
+            ),
+            max_memory_bytes=config.tts_cache_memory_bytes,
+            directory=config.tts_cache_dir,
+            max_disk_bytes=config.tts_cache_disk_bytes
+        )
+        self._audio_to_text = CachedAudioToText(
+            inner=WhisperAudioToTextInteractor(
+                client=self._client,
+                codec=self._codec,
+                chunk_threshold=config.stt_chunk_threshold,
+                chunk_length=config.stt_chunk_length,
+                max_parallel=config.stt_max_parallel
+            ),
+            ttl=config.stt_cache_ttl,
+            max_size=config.stt_cache_size
+        )
         self._confirm_text = CompletitionsBasedConfirmTextFormat(client=self._client)
-        self._context_based_assistant = AssistantFunctionInteractor(client=self._client)
+        self._context_based_assistant = AssistantFunctionInteractor(
+            client=self._client,
+            registry=self._assistant_registry,
+            thread_pool=self._thread_pool
+        )
         self._sessionmaker = sessionmaker
+        # with a pool the user gateway runs on asyncpg directly, the rest stays on sqlalchemy
+        self._user_pool = user_pool
+        self._user_store = user_store
+        self._user_batcher = None
+        if config.user_write_batching and user_pool is None and user_store is None:
+            self._user_batcher = UserWriteBatcher(
+                gateway_scope=partial(user_gateway_scope, sessionmaker),
+                window=config.user_write_batch_window,
+                max_rows=config.user_write_batch_size
+            )
+        # shared by the repositories of all the updates, they are created per update,
+        # the writes invalidate it only in this process, so with several of them the users are always loaded
+        self._user_cache = (
+            None if shared else UserCache(ttl=config.user_cache_ttl, max_size=config.user_cache_size)
+        )
+
+    async def warm_up(self) -> None:
+        self._thread_pool.fill()
+
+        await self._assistant_registry.load()
+
+        # the psychologist assistant is resolved before the first /mental, not during it
+        with scheduling(priority=Priority.BACKGROUND):
+            await self._context_based_assistant.new_assistant()
+
+    async def close(self) -> None:
+        # the writes waiting for their batch are done before the shutdown
+        if self._user_batcher is not None:
+            await self._user_batcher.close()
+
+        self._codec.shutdown()
+
+    @asynccontextmanager
+    async def _user_repo_scope(self) -> AsyncIterator[UserRepo]:
+        if self._user_store is not None:
+            scope = memory_user_gateway_scope(self._user_store)
+        elif self._user_pool is not None:
+            scope = asyncpg_user_gateway_scope(self._user_pool)
+        else:
+            scope = user_gateway_scope(self._sessionmaker, batcher=self._user_batcher)
+
+        async with scope as gateway:
+            yield UserRepo(user_gateway=gateway, cache=self._user_cache)
 
     async def __call__(
             self,
@@ -50,11 +171,24 @@ class DIMiddleware(BaseMiddleware):
         data["audio_to_text"] = self._audio_to_text
         data["confirm_text"] = self._confirm_text
         data["context_based_assistant"] = self._context_based_assistant
+        # for work which outlives the handler, like the coalesced voice replies
+        data["user_repo_scope"] = self._user_repo_scope
 
-        async with self._sessionmaker() as session:
-            repo = UserRepo(
-                user_gateway=UserGateWay(session=session)
-            )
-            data["user_repo"] = repo
+        user = data.get("event_from_user")
+
+        # openai calls made for the update are interactive and queued fairly per user
+        with scheduling(priority=Priority.INTERACTIVE, user=user.id if user else None):
+            # a connection is only taken around the database calls, not for the whole openai pipeline
+            if self._user_store is not None:
+                gateway = MemoryUserGateWay(store=self._user_store)
+            elif self._user_pool is not None:
+                gateway = AsyncpgUserGateWay(pool=self._user_pool)
+            else:
+                gateway = LazyUserGateWay(sessionmaker=self._sessionmaker, batcher=self._user_batcher)
+            data["user_repo"] = UserRepo(user_gateway=gateway, cache=self._user_cache)
+
+            try:
+                await handler(event, data)
 
-            await handler(event, data)
+            finally:
+                await gateway.close()
@@ -0,0 +1,172 @@
+
+
+import time
+import asyncio
+from collections import OrderedDict
+from typing import AsyncIterable, Optional
+
+from aiogram.types import Message
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+# telegram rejects longer messages, the rest goes into the next one
+MESSAGE_LIMIT = 4096
+
+
+class ChatEditLimiter:
+    __slots__ = ("_chats", "_min_interval", "_max_interval", "_max_chats")
+
+    def __init__(self, min_interval: float = 1.0, max_interval: float = 30.0, max_chats: int = 100_000):
+        # chat_id -> (interval, the time of the next allowed edit)
+        self._chats: OrderedDict[int, tuple[float, float]] = OrderedDict()
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._max_chats = max_chats
+
+    def interval(self, chat_id: int) -> float:
+        return self._chats.get(chat_id, (self._min_interval, 0.0))[0]
+
+    def _set(self, chat_id: int, interval: float, next_at: float) -> None:
+        self._chats[chat_id] = (interval, next_at)
+        self._chats.move_to_end(chat_id)
+
+        while len(self._chats) > self._max_chats:
+            self._chats.popitem(last=False)
+
+    async def wait(self, chat_id: int) -> None:
+        interval, next_at = self._chats.get(chat_id, (self._min_interval, 0.0))
+
+        now = time.monotonic()
+        self._set(chat_id, interval, max(now, next_at) + interval)
+
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+
+    def success(self, chat_id: int) -> None:
+        interval, next_at = self._chats.get(chat_id, (self._min_interval, 0.0))
+
+        # slowly back to the fast rate after a flood
+        self._set(chat_id, max(self._min_interval, interval * 0.9), next_at)
+
+    def flood(self, chat_id: int, retry_after: float) -> None:
+        interval, _ = self._chats.get(chat_id, (self._min_interval, 0.0))
+
+        self._set(
+            chat_id,
+            min(self._max_interval, max(interval * 2, retry_after)),
+            time.monotonic() + retry_after
+        )
+
+
+class ProgressiveMessage:
+    __slots__ = (
+        "_message",
+        "_limiter",
+        "_placeholder",
+        "_reply",
+        "_parts",
+        "_offset",
+        "_sent",
+        "_changed",
+        "_done"
+    )
+
+    def __init__(self, message: Message, limiter: ChatEditLimiter, placeholder: str = "…"):
+        self._message = message
+        self._limiter = limiter
+        self._placeholder = placeholder
+
+        self._reply: Optional[Message] = None
+        self._parts: list[str] = []
+        self._offset = 0
+        self._sent = placeholder
+        self._changed = asyncio.Event()
+        self._done = False
+
+    async def _edit(self, text: str, waited: bool = False) -> None:
+        chat_id = self._message.chat.id
+
+        while True:
+            if not waited:
+                await self._limiter.wait(chat_id)
+
+            try:
+                await self._reply.edit_text(text, parse_mode=None)
+
+            except TelegramRetryAfter as e:
+                self._limiter.flood(chat_id, e.retry_after)
+                waited = False
+                continue
+
+            except TelegramBadRequest as e:
+                if "message is not modified" not in e.message:
+                    raise
+
+            self._limiter.success(chat_id)
+            self._sent = text
+
+            return
+
+    async def _sync(self, text: str) -> None:
+        # the caller has waited for the first edit only
+        waited = True
+
+        # the finished part of a too long answer is fixed in its message and a new one is started
+        while len(text) - self._offset > MESSAGE_LIMIT:
+            end = self._offset + MESSAGE_LIMIT
+
+            await self._edit(text[self._offset:end], waited=waited)
+            waited = False
+
+            self._reply = await self._message.answer(self._placeholder, parse_mode=None)
+            self._sent = self._placeholder
+            self._offset = end
+
+        current = text[self._offset:]
+
+        # identical content is never sent twice, telegram counts such edits too
+        if current and current != self._sent:
+            await self._edit(current, waited=waited)
+
+    async def _edit_loop(self) -> None:
+        while True:
+            await self._changed.wait()
+
+            # deltas that arrive during the wait are coalesced into this edit
+            await self._limiter.wait(self._message.chat.id)
+
+            self._changed.clear()
+            done = self._done
+
+            # the parts are joined once per edit, not once per delta
+            await self._sync("".join(self._parts))
+
+            if done:
+                return
+
+    async def stream(self, deltas: AsyncIterable[str]) -> str:
+        self._reply = await self._message.answer(self._placeholder, parse_mode=None)
+
+        editor = asyncio.create_task(self._edit_loop())
+
+        try:
+            async for delta in deltas:
+                self._parts.append(delta)
+                self._changed.set()
+
+                if editor.done():
+                    break
+
+            self._done = True
+            self._changed.set()
+
+            await editor
+
+        finally:
+            editor.cancel()
+
+        text = "".join(self._parts)
+
+        if not text.strip():
+            await self._reply.delete()
+
+        return text
@@ -1,30 +1,47 @@
 
 
 import json
+import asyncio
+import logging
 from io import BytesIO
-from typing import Optional
+from functools import partial
+from dataclasses import dataclass
+from contextlib import nullcontext
+from typing import AsyncContextManager, Awaitable, BinaryIO, Callable, Optional
 
 from aiogram import Router, F, Bot
 from aiogram.filters.command import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputFile, Voice
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseEventIsolation
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.filters.callback_data import CallbackData
 
+from testai.src.interactors.stages import StageGraph
+from testai.src.interactors.coalescing import Coalescer
+from testai.src.interactors.scheduling import Priority, scheduling
 from testai.src.interactors.database.repositories.user import User, UserRepo
 from testai.src.interactors.processing.text_to_response import (
     TextToResponseInteractor,
     ContextBasedInteractor,
     ContextBasedResponseContainer,
-    ConfirmTextFormat
+    ConfirmTextFormat,
+    iter_text
 )
 from testai.src.interactors.processing.audio_to_text import AudioToTextInteractor
 from testai.src.interactors.processing.text_to_audio import TextToAudioInteractor
-from testai.src.interactors.processing.getname import SimpleGetUniqueName
+from testai.src.interactors.processing.getname import GetUniqueNameProtocol, SimpleGetUniqueName
+from testai.src.interactors.processing.streaming import SendAudioProtocol, stream_speech
+from testai.src.presentation.telegram.files import BytesIOInputFile, StreamInputFile
+from testai.src.presentation.telegram.progressive import ChatEditLimiter, ProgressiveMessage
+
+logger = logging.getLogger(__name__)
 
 router = Router()
 
+SHORT_VOICE_DURATION = 30
+
 
 class AudioState(StatesGroup):
     write_assis_name = State()
@@ -67,10 +84,7 @@ def render_user_menu(user: User) -> [str, InlineKeyboardMarkup]:
 async def on_start(message: Message, user_repo: UserRepo, state: FSMContext):
     await state.clear()
 
-    user = await user_repo.get_user_by_tg_id_unsafe(message.from_user.id)
-
-    if not user:
-        user = await user_repo.upsert_user(message.from_user.id)
+    user = await user_repo.get_or_create_user(message.from_user.id)
 
     render = render_user_menu(user)
 
@@ -104,18 +118,29 @@ async def on_start(
         context_based_assistant: ContextBasedInteractor,
         text_to_audio: TextToAudioInteractor,
         audio_to_text: AudioToTextInteractor,
-        state: FSMContext
+        state: FSMContext,
+        stream_voice_replies: bool
 ):
     await state.clear()
 
-    user = await user_repo.get_user_by_tg_id(message.from_user.id)
+    # the user is checked first, an unknown one must not cost a thread and an assistant
+    user = await user_repo.get_user_by_tg_id_unsafe(message.from_user.id)
 
     if not user:
         await message.answer("Text the /start first")
         return
 
-    new_thread = await context_based_assistant.new_thread()
-    assistant = await context_based_assistant.new_assistant()
+    # none of them depends on the other, so they run at the same time
+    graph = StageGraph()
+    graph.add("thread_id", context_based_assistant.new_thread)
+    graph.add("assistant_id", context_based_assistant.new_assistant)
+
+    stages = await graph.run()
+
+    new_thread = stages["thread_id"]
+    assistant = stages["assistant_id"]
+
+    getname = SimpleGetUniqueName(user_id=user.id)
 
     await state.update_data(
         thread_id=new_thread,
@@ -123,15 +148,31 @@ async def on_start(
     )
     await state.set_state(AudioState.write_mental)
 
-    input_file, audio, context = await get_mental_audio_response(
-        bot=bot,
-        user_id=user.id,
-        thread_id=new_thread,
-        assistant_id=assistant,
+    if stream_voice_replies:
+        async def send(audio: BytesIO, text: str, last: bool):
+            await message.answer_voice(
+                BytesIOInputFile(audio),
+                caption="You can continue the conversation by sending another voice or text message" if last else None
+            )
+
+        await stream_mental_audio_response(
+            context_based_assistant=context_based_assistant,
+            text_to_audio=text_to_audio,
+            text="Hello!",
+            getname=getname,
+            thread_id=new_thread,
+            assistant_id=assistant,
+            send=send
+        )
+        return
+
+    input_file, context = await get_mental_audio_response(
         context_based_assistant=context_based_assistant,
         text_to_audio=text_to_audio,
-        audio_to_text=audio_to_text,
-        text="Hello!"
+        text="Hello!",
+        getname=getname,
+        thread_id=new_thread,
+        assistant_id=assistant
     )
 
     await message.answer_voice(
@@ -139,8 +180,6 @@ async def on_start(
         caption="You can continue the conversation by sending another voice or text message"
     )
 
-    del input_file, audio
-
 
 @router.callback_query(F.data == "add_new_assistants")
 async def on_new_assistant_click(callback: CallbackQuery, state: FSMContext):
@@ -157,8 +196,7 @@ async def on_start(message: Message, user_repo: UserRepo, text_to_response: Text
     )
 
     user = await user_repo.get_user_by_tg_id(message.from_user.id)
-    await user_repo.add_assistant(user_id=user.id, openai_id=assistant_id, name=message.text)
-    user = await user_repo.get_user_by_id(user_id=user.id)
+    user = await user_repo.add_assistant(user_id=user.id, openai_id=assistant_id, name=message.text)
 
     render = render_user_menu(user)
 
@@ -178,35 +216,139 @@ async def on_new_assistant_click(
     await callback.message.edit_text("Send me your voice message with your cool request:")
 
 
-async def get_audio_response(
+async def transcribe_voice(
         bot: Bot,
-        text_to_response: TextToResponseInteractor,
         audio_to_text: AudioToTextInteractor,
+        voice: Voice,
+        getname: GetUniqueNameProtocol
+) -> str:
+    async def download() -> BinaryIO:
+        audio = await bot.download(voice.file_id)
+        if not audio:
+            raise ValueError("Audio undefined")
+
+        return audio
+
+    # long voices take long anyway, short ones go first when openai is busy
+    priority = Priority.NORMAL if voice.duration > SHORT_VOICE_DURATION else Priority.INTERACTIVE
+
+    # the download is lazy, it is skipped when the voice was transcribed already
+    with scheduling(priority=priority):
+        return await audio_to_text.get_response_by_id(
+            file_unique_id=voice.file_unique_id,
+            download=download,
+            getname=getname,
+            duration=voice.duration
+        )
+
+
+async def get_audio_response(
+        text_to_response: TextToResponseInteractor,
         text_to_audio: TextToAudioInteractor,
-        voice_file_id: str,
-        user_id: int,
+        text: str,
+        getname: GetUniqueNameProtocol,
         assistant_id: str,
         thread_id: str
-) -> tuple[BufferedInputFile, BytesIO]:
-    audio = await bot.download(voice_file_id)
-    if not audio:
-        raise ValueError("Audio undefined")
+) -> InputFile:
+    response = await text_to_response.get_response(
+        request=text,
+        assistant_id=assistant_id,
+        thread_id=thread_id
+    )
 
-    getname = SimpleGetUniqueName(user_id=user_id)
+    # tts is requested only when the upload starts and its chunks go straight to telegram
+    return StreamInputFile(
+        lambda: text_to_audio.stream_response(response),
+        filename=getname(text_to_audio.audio_format.extension)
+    )
 
-    text = await audio_to_text.get_response(audio, getname=getname)
-    del audio
 
-    response = await text_to_response.get_response(
-        request=text,
+async def stream_audio_response(
+        text_to_response: TextToResponseInteractor,
+        text_to_audio: TextToAudioInteractor,
+        text: str,
+        getname: GetUniqueNameProtocol,
+        assistant_id: str,
+        thread_id: str,
+        send: SendAudioProtocol
+) -> str:
+    # tts starts on every finished sentence while the assistant is still generating
+    return await stream_speech(
+        iter_text(text_to_response.stream_response(
+            request=text,
+            assistant_id=assistant_id,
+            thread_id=thread_id
+        )),
+        text_to_audio=text_to_audio,
+        getname=getname,
+        send=send
+    )
+
+
+@dataclass(slots=True, kw_only=True)
+class PendingMessage:
+    message: Message
+    text: asyncio.Task
+    # the state when the message came, the handler has returned when the batch is answered
+    assistant_id: str
+    thread_id: Optional[str]
+
+
+def pend_message(
+        bot: Bot,
+        audio_to_text: AudioToTextInteractor,
+        message: Message,
+        getname: GetUniqueNameProtocol,
+        assistant_id: str,
+        thread_id: Optional[str]
+) -> PendingMessage:
+    async def get_text() -> str:
+        if message.voice:
+            return await transcribe_voice(bot=bot, audio_to_text=audio_to_text, voice=message.voice, getname=getname)
+
+        return message.text
+
+    # the voice is transcribed right away, while the window waits for the next messages
+    return PendingMessage(
+        message=message,
+        text=asyncio.create_task(get_text()),
         assistant_id=assistant_id,
         thread_id=thread_id
     )
 
-    # getname context based so getname() != getname()
-    new_audio = await text_to_audio.get_response(response, getname=getname)
 
-    return BufferedInputFile(file=new_audio.read(), filename=getname(".mp3")), new_audio
+async def join_pending(batch: list[PendingMessage]) -> str:
+    texts = await asyncio.gather(*[item.text for item in batch], return_exceptions=True)
+
+    for text in texts:
+        if isinstance(text, BaseException):
+            raise text
+
+    return "\n".join(texts)
+
+
+def coalescing_key(message: Message, flow: str) -> tuple[int, int, str]:
+    return message.chat.id, message.from_user.id, flow
+
+
+def report_failure(
+        reply: Callable[..., Awaitable[None]]
+) -> Callable[..., Awaitable[None]]:
+    # a detached batch has nobody to show its error to, so the user is told to send the messages again
+    async def wrapper(batch: list[PendingMessage], *args, **kwargs) -> None:
+        try:
+            await reply(batch, *args, **kwargs)
+
+        except Exception:
+            try:
+                await batch[-1].message.answer("Something went wrong, please send it again")
+
+            except Exception:
+                logger.exception("Failed to report a failed reply")
+
+            raise
+
+    return wrapper
 
 
 @router.message(AudioState.write_audio)
@@ -216,7 +358,10 @@ async def on_start(
         text_to_response: TextToResponseInteractor,
         audio_to_text: AudioToTextInteractor,
         text_to_audio: TextToAudioInteractor,
-        state: FSMContext
+        state: FSMContext,
+        events_isolation: BaseEventIsolation,
+        stream_voice_replies: bool,
+        voice_coalescer: Coalescer[PendingMessage]
 ):
 
     if not message.voice:
@@ -225,54 +370,97 @@ async def on_start(
 
     data = await state.get_data()
 
-    assistant_id = data["assistant_id"]
-
-    if data.get("thread_id", None):
-        thread_id = data["thread_id"]
+    if not data.get("assistant_id"):
+        await message.answer("Choose your assistant first: /start")
+        return
 
-    else:
-        thread_id = await text_to_response.new_thread()
-        await state.update_data(thread_id=thread_id)
+    getname = SimpleGetUniqueName(user_id=message.from_user.id)
+
+    # quick voices of one user are merged into one request, so they produce one run and one reply
+    @report_failure
+    async def reply(batch: list[PendingMessage]):
+        assistant_id = batch[-1].assistant_id
+        last_message = batch[-1].message
+
+        async def get_thread_id() -> str:
+            if batch[-1].thread_id:
+                return batch[-1].thread_id
+
+            # the handler has returned, the state is locked like the dispatcher does, so the next update is ordered
+            async with events_isolation.lock(state.key):
+                # the previous batch of the user may have created it after these messages came
+                if thread_id := (await state.get_data()).get("thread_id"):
+                    return thread_id
+
+            thread_id = await text_to_response.new_thread()
+
+            async with events_isolation.lock(state.key):
+                await state.update_data(thread_id=thread_id)
+
+            return thread_id
+
+        # the thread does not depend on the audio, so it is acquired during the download and whisper
+        graph = StageGraph()
+        graph.add("thread_id", get_thread_id)
+        graph.add("text", partial(join_pending, batch))
+
+        stages = await graph.run()
+
+        if stream_voice_replies:
+            async def send(audio: BytesIO, text: str, last: bool):
+                await last_message.answer_voice(
+                    BytesIOInputFile(audio),
+                    caption="You can continue the conversation by sending another voice message" if last else None
+                )
+
+            await stream_audio_response(
+                text_to_response=text_to_response,
+                text_to_audio=text_to_audio,
+                text=stages["text"],
+                getname=getname,
+                assistant_id=assistant_id,
+                thread_id=stages["thread_id"],
+                send=send
+            )
+            return
+
+        input_file = await get_audio_response(
+            text_to_response=text_to_response,
+            text_to_audio=text_to_audio,
+            text=stages["text"],
+            getname=getname,
+            assistant_id=assistant_id,
+            thread_id=stages["thread_id"]
+        )
 
-    input_file, audio = await get_audio_response(
-        bot=bot,
-        text_to_response=text_to_response,
-        audio_to_text=audio_to_text,
-        text_to_audio=text_to_audio,
-        voice_file_id=message.voice.file_id,
-        user_id=message.from_user.id,
-        assistant_id=assistant_id,
-        thread_id=thread_id
-    )
+        await last_message.answer_voice(
+            input_file,
+            caption="You can continue the conversation by sending another voice message"
+        )
 
-    await message.answer_voice(
-        input_file,
-        caption="You can continue the conversation by sending another voice message"
+    voice_coalescer.submit(
+        coalescing_key(message, "audio"),
+        partial(
+            pend_message,
+            bot=bot,
+            audio_to_text=audio_to_text,
+            message=message,
+            getname=getname,
+            assistant_id=data["assistant_id"],
+            thread_id=data.get("thread_id")
+        ),
+        reply
     )
 
-    del input_file, audio
-
 
 async def get_mental_audio_response(
-        bot: Bot,
-        user_id: int,
-        thread_id: str,
-        assistant_id: str,
         context_based_assistant: ContextBasedInteractor,
         text_to_audio: TextToAudioInteractor,
-        audio_to_text: AudioToTextInteractor,
-        text: Optional[str] = None,
-        voice_file_id: Optional[str] = None
-) -> tuple[Optional[BufferedInputFile], Optional[BytesIO], ContextBasedResponseContainer]:
-    if voice_file_id:
-        audio = await bot.download(voice_file_id)
-        if not audio:
-            raise ValueError("Audio undefined")
-
-        getname = SimpleGetUniqueName(user_id=user_id)
-
-        text = await audio_to_text.get_response(audio, getname=getname)
-
+        text: str,
+        getname: GetUniqueNameProtocol,
+        thread_id: str,
+        assistant_id: str
+) -> tuple[Optional[InputFile], ContextBasedResponseContainer]:
     if not text:
         raise ValueError("Undefined text")
 
@@ -283,85 +471,193 @@ async def get_mental_audio_response(
     )
 
     if not response.text.strip():
-        return None, None, response
+        return None, response
 
-    getname = SimpleGetUniqueName(user_id=user_id)
+    input_file = StreamInputFile(
+        lambda: text_to_audio.stream_response(response.text),
+        filename=getname(text_to_audio.audio_format.extension)
+    )
 
-    # getname context based so getname() != getname()
-    new_audio = await text_to_audio.get_response(response.text, getname=getname)
+    return input_file, response
+
+
+async def stream_mental_audio_response(
+        context_based_assistant: ContextBasedInteractor,
+        text_to_audio: TextToAudioInteractor,
+        text: str,
+        getname: GetUniqueNameProtocol,
+        thread_id: str,
+        assistant_id: str,
+        send: SendAudioProtocol
+) -> ContextBasedResponseContainer:
+    if not text:
+        raise ValueError("Undefined text")
+
+    container = ContextBasedResponseContainer()
+
+    container.text = await stream_speech(
+        iter_text(
+            context_based_assistant.stream_response(
+                request=text,
+                thread_id=thread_id,
+                assistant_id=assistant_id
+            ),
+            container=container
+        ),
+        text_to_audio=text_to_audio,
+        getname=getname,
+        send=send
+    )
 
-    return BufferedInputFile(file=new_audio.read(), filename=getname(".mp3")), new_audio, response
+    return container
 
 
 @router.message(AudioState.write_mental)
 async def on_start(
         message: Message,
         bot: Bot,
-        user_repo: UserRepo,
+        user_repo_scope: Callable[[], AsyncContextManager[UserRepo]],
         context_based_assistant: ContextBasedInteractor,
         text_to_audio: TextToAudioInteractor,
         audio_to_text: AudioToTextInteractor,
         confirm_text: ConfirmTextFormat,
-        state: FSMContext
+        state: FSMContext,
+        events_isolation: BaseEventIsolation,
+        stream_voice_replies: bool,
+        progressive_text_replies: bool,
+        edit_limiter: ChatEditLimiter,
+        voice_coalescer: Coalescer[PendingMessage]
 ):
 
     if not message.voice and not message.text:
         await message.answer("It's not a voice message or text message")
         return
 
-    voice_file_id = None
-    if message.voice:
-        voice_file_id = message.voice.file_id
-
     data = await state.get_data()
 
-    assistant_id = data["assistant_id"]
-    thread_id = data["thread_id"]
+    if not data.get("assistant_id") or not data.get("thread_id"):
+        await message.answer("Start the test with /mental")
+        return
 
-    user = await user_repo.get_user_by_tg_id(message.from_user.id)
+    getname = SimpleGetUniqueName(user_id=message.from_user.id)
 
-    input_file, audio, context = await get_mental_audio_response(
-        bot=bot,
-        user_id=user.id,
-        thread_id=thread_id,
-        assistant_id=assistant_id,
-        context_based_assistant=context_based_assistant,
-        text_to_audio=text_to_audio,
-        audio_to_text=audio_to_text,
-        text=message.text,
-        voice_file_id=voice_file_id
-    )
+    async def get_user() -> User:
+        async with user_repo_scope() as user_repo:
+            return await user_repo.get_user_by_tg_id(message.from_user.id)
 
-    if context.text:
-        caption = context.text or None
+    # the handler may return before the answer, so the database is used through short scopes
+    @report_failure
+    async def reply(batch: list[PendingMessage], fsm_lock: Callable[[], AsyncContextManager]):
+        assistant_id = batch[-1].assistant_id
+        thread_id = batch[-1].thread_id
 
-        await message.answer_voice(
-            input_file,
-            caption=caption
-        )
+        last_message = batch[-1].message
 
-    if context.context:
-        confirm_result = await confirm_text.confirm(
-            system_text=(
-                "You only have to answer whether the user's messages match the format: "
-                "profession: string, temperament: string "
-                "and does not contain humorous or strange formulas"
-            ),
-            text=context.context
-        )
+        # the user is loaded while the voices are downloaded and transcribed
+        graph = StageGraph()
+        graph.add("user", get_user)
+        graph.add("text", partial(join_pending, batch))
+
+        stages = await graph.run()
 
-        if confirm_result:
-            result_data = json.loads(context.context)
-            await user_repo.upsert_user_mental(
-                user_id=user.id,
-                temperament=result_data["temperament"],
-                profession=result_data["profession"]
+        user = stages["user"]
+        text = stages["text"]
+
+        if progressive_text_replies and not any(item.message.voice for item in batch):
+            # a text question gets a text answer, which is edited in place while it is generated
+            context = ContextBasedResponseContainer()
+
+            context.text = await ProgressiveMessage(last_message, limiter=edit_limiter).stream(
+                iter_text(
+                    context_based_assistant.stream_response(
+                        request=text,
+                        thread_id=thread_id,
+                        assistant_id=assistant_id
+                    ),
+                    container=context
+                )
+            )
+
+        elif stream_voice_replies:
+            async def send(audio: BytesIO, text: str, last: bool):
+                await last_message.answer_voice(
+                    BytesIOInputFile(audio),
+                    caption=text
+                )
+
+            context = await stream_mental_audio_response(
+                context_based_assistant=context_based_assistant,
+                text_to_audio=text_to_audio,
+                text=text,
+                getname=getname,
+                thread_id=thread_id,
+                assistant_id=assistant_id,
+                send=send
             )
-            await message.answer("Success! Check your result in /profile")
 
         else:
-            await message.answer("The mental test failed! Try it again /mental")
+            input_file, context = await get_mental_audio_response(
+                context_based_assistant=context_based_assistant,
+                text_to_audio=text_to_audio,
+                text=text,
+                getname=getname,
+                thread_id=thread_id,
+                assistant_id=assistant_id
+            )
+
+            if context.text:
+                caption = context.text or None
+
+                await last_message.answer_voice(
+                    input_file,
+                    caption=caption
+                )
+
+        if context.context:
+            confirm_result = await confirm_text.confirm(
+                system_text=(
+                    "You only have to answer whether the user's messages match the format: "
+                    "profession: string, temperament: string "
+                    "and does not contain humorous or strange formulas"
+                ),
+                text=context.context
+            )
+
+            if confirm_result:
+                result_data = json.loads(context.context)
+
+                async with user_repo_scope() as user_repo:
+                    await user_repo.upsert_user_mental(
+                        user_id=user.id,
+                        temperament=result_data["temperament"],
+                        profession=result_data["profession"]
+                    )
 
-        await state.clear()
+                await last_message.answer("Success! Check your result in /profile")
+
+            else:
+                await last_message.answer("The mental test failed! Try it again /mental")
+
+            async with fsm_lock():
+                # a /mental sent meanwhile has started a new test, its state is kept
+                if (await state.get_data()).get("thread_id") == thread_id:
+                    await state.clear()
+
+    key = coalescing_key(message, "mental")
+    create = partial(
+        pend_message,
+        bot=bot,
+        audio_to_text=audio_to_text,
+        message=message,
+        getname=getname,
+        assistant_id=data["assistant_id"],
+        thread_id=data["thread_id"]
+    )
+
+    if message.voice or key in voice_coalescer:
+        # the handler has returned when the batch is answered, so the state is locked like the dispatcher does
+        voice_coalescer.submit(key, create, partial(reply, fsm_lock=partial(events_isolation.lock, state.key)))
+        return
 
-    del input_file, audio
+    # a text is answered at once, with the lock the dispatcher holds for this handler
+    await reply([create()], fsm_lock=nullcontext)
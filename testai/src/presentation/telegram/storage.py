@@ -0,0 +1,210 @@
+
+
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, AsyncContextManager, Callable, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from testai.src.interactors.caching import SingleFlight, TTLCache
+from testai.src.interactors.database.gateways.fsm import BaseFSMGateWay, FSMStateDomain
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True, kw_only=True, frozen=True)
+class FSMRecord:
+    state: Optional[str] = None
+    data: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+class PostgresStorage(BaseStorage):
+    __slots__ = (
+        "_gateway_scope",
+        "_key_builder",
+        "_cache",
+        "_flight",
+        "_dirty",
+        "_flushing",
+        "_flush_lock",
+        "_full",
+        "_flusher",
+        "_flush_interval",
+        "_batch_size",
+        "_state_ttl",
+        "_cleanup_interval",
+        "_cleaned_at",
+        "_shared"
+    )
+
+    def __init__(
+            self,
+            gateway_scope: Callable[[], AsyncContextManager[BaseFSMGateWay]],
+            key_builder: Optional[KeyBuilder] = None,
+            flush_interval: float = 0.5,
+            batch_size: int = 500,
+            cache_ttl: float = 60.0,
+            cache_size: int = 100_000,
+            state_ttl: float = 7 * 24 * 60 * 60,
+            cleanup_interval: float = 60 * 60,
+            shared: bool = False
+    ):
+        self._gateway_scope = gateway_scope
+        self._key_builder = key_builder or DefaultKeyBuilder(
+            with_bot_id=True,
+            with_business_connection_id=True,
+            with_destiny=True
+        )
+
+        # the updates of a user may go to any of the processes which share the table,
+        # a copy kept by one of them is stale as soon as another one writes, so they read and write the database
+        self._shared = shared
+        self._cache: Optional[TTLCache[FSMRecord]] = (
+            None if shared else TTLCache(ttl=cache_ttl, max_size=cache_size)
+        )
+        self._flight: SingleFlight[FSMRecord] = SingleFlight()
+
+        # written but not yet flushed records, they are the newest version of the state
+        self._dirty: dict[str, FSMRecord] = {}
+        self._flushing: dict[str, FSMRecord] = {}
+        self._flush_lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._state_ttl = state_ttl
+        self._cleanup_interval = cleanup_interval
+        self._cleaned_at = time.monotonic()
+
+    async def _fetch(self, key: str) -> FSMRecord:
+        async with self._gateway_scope() as gateway:
+            result = await gateway.get(key)
+
+        record = FSMRecord(state=result.state, data=result.data) if result else FSMRecord()
+
+        # a write may have happened during the read, it is newer
+        record = self._dirty.get(key) or self._flushing.get(key) or record
+        if self._cache is not None:
+            self._cache.set(key, record)
+
+        return record
+
+    async def _load(self, key: str) -> FSMRecord:
+        record = self._dirty.get(key) or self._flushing.get(key)
+        if record is None and self._cache is not None:
+            record = self._cache.get(key)
+
+        if record is not None:
+            return record
+
+        return await self._flight.do(key, lambda: self._fetch(key))
+
+    async def _write(self, key: str, record: FSMRecord) -> None:
+        self._dirty[key] = record
+
+        if self._shared:
+            # the next update of the user may be read by another process, the write is in the database before
+            await self.flush()
+            return
+
+        self._cache.set(key, record)
+
+        if len(self._dirty) >= self._batch_size:
+            self._full.set()
+
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while self._dirty:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self._flush_interval)
+
+            except asyncio.TimeoutError:
+                pass
+
+            self._full.clear()
+
+            try:
+                await self.flush()
+
+            except Exception:
+                # the records are kept and the next round retries them
+                logger.exception("FSM flush failed")
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+
+            self._flushing, self._dirty = self._dirty, {}
+
+            try:
+                deleted = [key for key, record in self._flushing.items() if record.empty]
+                upserted = [
+                    FSMStateDomain(key=key, state=record.state, data=record.data)
+                    for key, record in self._flushing.items() if not record.empty
+                ]
+
+                async with self._gateway_scope() as gateway:
+                    if deleted:
+                        await gateway.delete_many(deleted)
+
+                    if upserted:
+                        await gateway.upsert_many(upserted)
+
+                    if time.monotonic() - self._cleaned_at > self._cleanup_interval:
+                        self._cleaned_at = time.monotonic()
+
+                        removed = await gateway.delete_expired(self._state_ttl)
+                        logger.info("Removed %s abandoned FSM states", removed)
+
+                    await gateway.commit()
+
+            except BaseException:
+                # records written during the flush are newer than the failed ones
+                for key, record in self._flushing.items():
+                    self._dirty.setdefault(key, record)
+
+                raise
+
+            finally:
+                self._flushing = {}
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        built = self._key_builder.build(key)
+        record = await self._load(built)
+
+        state = state.state if isinstance(state, State) else state
+        await self._write(built, FSMRecord(state=state, data=record.data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._load(self._key_builder.build(key))
+
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        built = self._key_builder.build(key)
+        record = await self._load(built)
+
+        await self._write(built, FSMRecord(state=record.state, data=data.copy()))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        record = await self._load(self._key_builder.build(key))
+
+        return record.data.copy()
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+
+        # the last writes must not be lost on a graceful shutdown
+        await self.flush()
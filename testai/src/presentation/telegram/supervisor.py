@@ -0,0 +1,268 @@
+
+
+import time
+import zlib
+import asyncio
+import logging
+import multiprocessing
+from queue import Empty
+from typing import Any, Callable, Optional
+from multiprocessing.queues import Queue
+from multiprocessing.reduction import ForkingPickler
+from multiprocessing.sharedctypes import Synchronized
+
+from aiogram.types import Update
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+
+from testai.config.config_reader import Config, get_config
+from testai.src.presentation.telegram.main import build_bot, build_dispatcher
+
+logger = logging.getLogger(__name__)
+
+WorkerTarget = Callable[[int, int, Queue, Synchronized], None]
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    return zlib.crc32(user_id.to_bytes(8, "little", signed=True)) % shards
+
+
+def routing_id(update: Update) -> int:
+    try:
+        event = update.event
+
+    except Exception:
+        # an unknown update type, any shard can take it
+        return update.update_id
+
+    user = getattr(event, "from_user", None)
+    if user:
+        return user.id
+
+    chat = getattr(event, "chat", None)
+    if chat:
+        return chat.id
+
+    return update.update_id
+
+
+async def run_shard(config: Config, shard: int, shards: int, updates: Queue, heartbeat: Synchronized):
+    bot = build_bot(config)
+    dp = await build_dispatcher(config, shards=shards)
+
+    semaphore = asyncio.Semaphore(config.shard_max_concurrency)
+    tasks: set[asyncio.Task] = set()
+
+    async def feed(update: dict[str, Any]):
+        # the semaphore is fifo and the isolation lock is too, so the updates of a user stay in order
+        async with semaphore:
+            await dp.feed_raw_update(bot=bot, update=update)
+
+    async def beat():
+        while True:
+            heartbeat.value = time.monotonic()
+            await asyncio.sleep(1)
+
+    beating = asyncio.create_task(beat())
+    await dp.emit_startup(bot=bot)
+
+    try:
+        while True:
+            try:
+                # a timeout, so a crash of the shard never waits for a thread blocked on the queue
+                update = await asyncio.to_thread(updates.get, timeout=1)
+
+            except Empty:
+                continue
+
+            if update is None:
+                break
+
+            task = asyncio.create_task(feed(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
+
+    finally:
+        beating.cancel()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+    logger.info("Shard %s stopped", shard)
+
+
+def shard_worker(shard: int, shards: int, updates: Queue, heartbeat: Synchronized):
+    asyncio.run(run_shard(get_config(), shard, shards, updates, heartbeat))
+
+
+class Supervisor:
+    __slots__ = (
+        "_target",
+        "_shards",
+        "_health_timeout",
+        "_context",
+        "_queues",
+        "_heartbeats",
+        "_workers",
+        "_restarts"
+    )
+
+    def __init__(self, target: WorkerTarget, shards: int, health_timeout: float = 30.0):
+        self._target = target
+        self._shards = shards
+        self._health_timeout = health_timeout
+        self._context = multiprocessing.get_context()
+
+        # every incarnation of a shard gets its own queue, a killed worker may keep the lock of its queue forever
+        self._queues: list[Queue] = [self._context.Queue() for _ in range(shards)]
+        self._heartbeats: list[Synchronized] = [self._context.Value("d", 0.0) for _ in range(shards)]
+        self._workers: list[Optional[multiprocessing.Process]] = [None] * shards
+        self._restarts = 0
+
+    @property
+    def restarts(self) -> int:
+        return self._restarts
+
+    def _start(self, shard: int) -> None:
+        self._heartbeats[shard].value = time.monotonic()
+
+        worker = self._context.Process(
+            target=self._target,
+            args=(shard, self._shards, self._queues[shard], self._heartbeats[shard]),
+            name=f"shard-{shard}",
+            daemon=True
+        )
+        worker.start()
+
+        self._workers[shard] = worker
+
+    def _drain(self, updates: Queue, timeout: float = 5.0) -> list[Any]:
+        # the worker is dead and nobody else reads the queue, so its pipe is read without the lock,
+        # the stop marker comes after the updates which the feeder may still be flushing
+        updates.put(None)
+
+        moved = []
+
+        try:
+            while updates._reader.poll(timeout):
+                update = ForkingPickler.loads(updates._reader.recv_bytes())
+
+                if update is None:
+                    break
+
+                moved.append(update)
+
+            else:
+                logger.warning("The queue of a dead shard was not drained in time, %s moved", len(moved))
+
+        except Exception:
+            # the worker was killed in the middle of a read, the rest of the pipe is garbage
+            logger.exception("Failed to move the updates of a dead shard, %s moved", len(moved))
+
+        updates.cancel_join_thread()
+        updates.close()
+
+        return moved
+
+    def _restart(self, shard: int) -> None:
+        retired = self._queues[shard]
+        self._queues[shard] = self._context.Queue()
+
+        # the waiting updates continue in the new queue, only the ones the worker was handling are lost
+        for update in self._drain(retired):
+            self._queues[shard].put(update)
+
+        self._restarts += 1
+        self._start(shard)
+
+    def start(self) -> None:
+        for shard in range(self._shards):
+            self._start(shard)
+
+    def check(self) -> None:
+        now = time.monotonic()
+
+        for shard, worker in enumerate(self._workers):
+            alive = worker is not None and worker.is_alive()
+
+            # a worker is also dead when its event loop hangs and the heartbeat stops
+            if alive and now - self._heartbeats[shard].value < self._health_timeout:
+                continue
+
+            logger.warning("Shard %s is unhealthy, restarting it", shard)
+
+            if alive:
+                worker.kill()
+                worker.join()
+
+            self._restart(shard)
+
+    def route(self, update: Update) -> int:
+        shard = shard_of(routing_id(update), self._shards)
+
+        self._queues[shard].put(
+            update.model_dump(mode="json", by_alias=True, exclude_unset=True)
+        )
+
+        return shard
+
+    def stop(self, timeout: float = 30.0) -> None:
+        for updates in self._queues:
+            updates.put(None)
+
+        deadline = time.monotonic() + timeout
+
+        for worker in self._workers:
+            if worker is None:
+                continue
+
+            worker.join(max(0.0, deadline - time.monotonic()))
+
+            if worker.is_alive():
+                worker.kill()
+
+
+async def supervise(config: Config, target: WorkerTarget = shard_worker):
+    supervisor = Supervisor(target, shards=config.shard_workers, health_timeout=config.shard_health_timeout)
+    supervisor.start()
+
+    bot = build_bot(config)
+    # the updates are taken from telegram only here, the workers only get them from their queue
+    await bot.delete_webhook()
+
+    async def monitor():
+        while True:
+            await asyncio.sleep(config.shard_health_interval)
+            supervisor.check()
+
+    monitoring = asyncio.create_task(monitor())
+    offset: Optional[int] = None
+
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=config.shard_polling_timeout)
+
+            except (TelegramNetworkError, TelegramServerError):
+                logger.exception("Polling failed")
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                supervisor.route(update)
+                # the update is acknowledged once it is queued, a crashed worker loses what it was handling
+                offset = update.update_id + 1
+
+    finally:
+        monitoring.cancel()
+        supervisor.stop()
+        await bot.session.close()
+
+
+def main():
+    asyncio.run(supervise(get_config()))
+
+
+if __name__ == "__main__":
+    main()
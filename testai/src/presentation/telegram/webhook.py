@@ -0,0 +1,113 @@
+
+
+import signal
+import asyncio
+import logging
+from typing import Any, Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    def __init__(
+            self,
+            dispatcher: Dispatcher,
+            bot: Bot,
+            secret_token: Optional[str] = None,
+            max_concurrency: int = 256,
+            max_pending: int = 10_000,
+            shutdown_timeout: float = 30.0,
+            **data: Any
+    ):
+        # telegram is answered right away, the update is handled afterwards
+        super().__init__(
+            dispatcher=dispatcher,
+            bot=bot,
+            handle_in_background=True,
+            secret_token=secret_token,
+            **data
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._max_pending = max_pending
+        self._shutdown_timeout = shutdown_timeout
+
+    @property
+    def pending(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def _background_feed_update(self, bot: Bot, update: dict[str, Any]) -> None:
+        async with self._semaphore:
+            await super()._background_feed_update(bot=bot, update=update)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if self.pending >= self._max_pending:
+            # telegram delivers the update again later, which is better than an unbounded backlog
+            return web.Response(status=503)
+
+        return await super()._handle_request_background(bot=bot, request=request)
+
+    async def close(self) -> None:
+        if self._background_feed_update_tasks:
+            _, running = await asyncio.wait(
+                self._background_feed_update_tasks,
+                timeout=self._shutdown_timeout
+            )
+
+            if running:
+                logger.warning("%s updates were not handled before the shutdown", len(running))
+
+        await super().close()
+
+
+def create_webhook_app(
+        dispatcher: Dispatcher,
+        bot: Bot,
+        path: str,
+        secret_token: Optional[str] = None,
+        max_concurrency: int = 256,
+        max_pending: int = 10_000
+) -> web.Application:
+    app = web.Application()
+
+    handler = BoundedRequestHandler(
+        dispatcher=dispatcher,
+        bot=bot,
+        secret_token=secret_token,
+        max_concurrency=max_concurrency,
+        max_pending=max_pending
+    )
+    handler.register(app, path=path)
+
+    # startup and shutdown of the dispatcher are bound to the application
+    setup_application(app, dispatcher, bot=bot)
+
+    return app
+
+
+async def serve_webhook_app(app: web.Application, host: str, port: int, reuse_port: bool = False) -> None:
+    runner = web.AppRunner(app)
+    await runner.setup()
+
+    # with reuse_port several worker processes listen on the same port and the kernel balances them
+    site = web.TCPSite(runner, host=host, port=port, reuse_port=reuse_port)
+    await site.start()
+
+    # the cleanup runs the shutdown of the dispatcher, so the updates in flight are finished on a stop
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    try:
+        await stop.wait()
+
+    finally:
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
+
+        await runner.cleanup()
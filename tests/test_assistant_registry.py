@@ -0,0 +1,57 @@
+
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from testai.src.interactors.database.gateways.assistant import MemoryAssistantRegistryGateWay
+from testai.src.interactors.database.repositories.assistant import AssistantRegistry
+
+
+def fake_scope(gateway):
+    @asynccontextmanager
+    async def scope():
+        yield gateway
+
+    return scope
+
+
+async def test_created_once():
+    created = 0
+
+    async def create():
+        nonlocal created
+        created += 1
+        await asyncio.sleep(0.01)
+
+        return f"asst_{created}"
+
+    registry = AssistantRegistry(gateway_scope=fake_scope(MemoryAssistantRegistryGateWay()))
+
+    ids = await asyncio.gather(*[
+        registry.get_or_create(model="gpt-4o", instructions="Be friendly", tools=None, create=create)
+        for _ in range(3)
+    ])
+
+    assert ids == ["asst_1"] * 3
+    assert created == 1
+
+
+async def test_reused_after_restart():
+    gateway = MemoryAssistantRegistryGateWay()
+
+    async def create():
+        return "asst_1"
+
+    async def fail():
+        raise AssertionError("The assistant must be reused")
+
+    await AssistantRegistry(gateway_scope=fake_scope(gateway)).get_or_create(
+        model="gpt-4o", instructions="Be friendly", tools=[{"type": "function"}], create=create
+    )
+
+    registry = AssistantRegistry(gateway_scope=fake_scope(gateway))
+    await registry.load()
+
+    assert await registry.get_or_create(
+        model="gpt-4o", instructions="Be friendly", tools=[{"type": "function"}], create=fail
+    ) == "asst_1"
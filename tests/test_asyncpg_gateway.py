@@ -0,0 +1,99 @@
+
+
+from testai.src.interactors.database.gateways import user_asyncpg
+from testai.src.interactors.database.gateways.user_asyncpg import AsyncpgUserGateWay
+from testai.src.interactors.database.repositories.user import UserRepo
+
+USER = {
+    "id": 1,
+    "tg_id": 42,
+    "assistants": [{"id": 1, "user_id": 1, "openai_id": "asst_1", "name": "test"}],
+    "mental": None
+}
+
+
+class FakeTransaction:
+    def __init__(self):
+        self.state = "new"
+
+    async def start(self):
+        self.state = "started"
+
+    async def commit(self):
+        self.state = "committed"
+
+    async def rollback(self):
+        self.state = "rolled back"
+
+
+class FakeConnection:
+    def __init__(self):
+        self.queries = []
+        self.transactions = []
+
+    def transaction(self):
+        self.transactions.append(FakeTransaction())
+
+        return self.transactions[-1]
+
+    async def fetchrow(self, query, *args):
+        self.queries.append((query, args))
+
+        return USER
+
+
+class FakePool:
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.acquired = 0
+        self.released = 0
+
+    async def acquire(self):
+        self.acquired += 1
+
+        return self.connection
+
+    async def release(self, connection):
+        self.released += 1
+
+
+async def test_read_decodes_the_aggregate():
+    pool = FakePool()
+    repo = UserRepo(user_gateway=AsyncpgUserGateWay(pool=pool))
+
+    user = await repo.get_user_by_tg_id(42)
+
+    assert user.tg_id == 42
+    assert user.assistants[0].openai_id == "asst_1"
+    assert user.mental is None
+    assert pool.connection.queries == [(user_asyncpg.USER_BY_TG_ID, (42, ))]
+    assert pool.acquired == pool.released == 1
+
+
+async def test_write_keeps_the_connection_until_commit():
+    pool = FakePool()
+    gateway = AsyncpgUserGateWay(pool=pool)
+
+    await gateway.add_user_assistants(user_id=1, assistant_id="asst_1", assistant_name="test")
+    await gateway.get_user_by_id(1)
+
+    assert gateway.active
+    assert pool.acquired == 1
+    assert pool.connection.transactions[0].state == "started"
+
+    await gateway.commit()
+
+    assert pool.connection.transactions[0].state == "committed"
+    assert pool.released == 1
+    assert not gateway.active
+
+
+async def test_uncommitted_write_is_rolled_back_on_close():
+    pool = FakePool()
+    gateway = AsyncpgUserGateWay(pool=pool)
+
+    await gateway.upsert_user_mental(user_id=1, temperament="calm", profession="developer")
+    await gateway.close()
+
+    assert pool.connection.transactions[0].state == "rolled back"
+    assert pool.released == 1
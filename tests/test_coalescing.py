@@ -0,0 +1,125 @@
+
+
+import asyncio
+
+from testai.src.interactors.coalescing import Coalescer
+
+
+async def test_quick_items_are_one_batch():
+    coalescer = Coalescer(window=0.05)
+    batches = []
+
+    async def process(batch: list[int]):
+        batches.append(batch)
+
+    assert coalescer.submit("user", lambda: 1, process)
+    await asyncio.sleep(0.02)
+    assert not coalescer.submit("user", lambda: 2, process)
+    assert coalescer.submit("other", lambda: 3, process)
+
+    await asyncio.sleep(0.2)
+
+    assert sorted(batches) == [[1, 2], [3]]
+    assert "user" not in coalescer
+
+
+async def test_items_during_a_turn_make_the_next_batch():
+    coalescer = Coalescer(window=0.01)
+    batches = []
+    started = asyncio.Event()
+
+    async def process(batch: list[int]):
+        batches.append(batch)
+        started.set()
+        await asyncio.sleep(0.05)
+
+    coalescer.submit("user", lambda: 1, process)
+    await started.wait()
+
+    coalescer.submit("user", lambda: 2, process)
+    coalescer.submit("user", lambda: 3, process)
+
+    await asyncio.sleep(0.2)
+
+    assert batches == [[1], [2, 3]]
+
+
+async def test_failed_batch_does_not_stop_the_worker():
+    coalescer = Coalescer(window=0.01)
+    batches = []
+    failing = asyncio.Event()
+
+    async def process(batch: list[int]):
+        batches.append(batch)
+
+        if batch == [1]:
+            failing.set()
+            await asyncio.sleep(0.02)
+            raise ValueError()
+
+    coalescer.submit("user", lambda: 1, process)
+    await failing.wait()
+    coalescer.submit("user", lambda: 2, process)
+
+    await asyncio.sleep(0.1)
+
+    assert batches == [[1], [2]]
+    assert "user" not in coalescer
+
+
+async def test_close_answers_the_pending_turns():
+    coalescer = Coalescer(window=10)
+    batches = []
+
+    async def process(batch: list[int]):
+        batches.append(batch)
+
+    coalescer.submit("user", lambda: 1, process)
+    coalescer.submit("user", lambda: 2, process)
+
+    # the window is not waited for, the batch is processed before close returns
+    await asyncio.wait_for(coalescer.close(), 1)
+
+    assert batches == [[1, 2]]
+    assert "user" not in coalescer
+
+
+async def test_close_cancels_slow_turns():
+    coalescer = Coalescer(window=0)
+    cancelled = asyncio.Event()
+
+    async def process(batch: list[int]):
+        try:
+            await asyncio.sleep(10)
+
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    coalescer.submit("user", lambda: 1, process)
+    await asyncio.sleep(0.01)
+
+    await coalescer.close(timeout=0.01)
+
+    assert cancelled.is_set()
+
+
+async def test_workers_are_limited():
+    coalescer = Coalescer(window=0, max_workers=1)
+    release = asyncio.Event()
+    created = []
+
+    async def process(batch: list[int]):
+        await release.wait()
+
+    coalescer.submit("first", lambda: created.append(1), process)
+    # the handler does not wait, the item of the second user waits for the slot in its worker
+    assert coalescer.submit("second", lambda: created.append(2), process)
+    await asyncio.sleep(0.02)
+
+    assert created == [1]
+
+    release.set()
+    await coalescer.close()
+
+    assert created == [1, 2]
@@ -0,0 +1,39 @@
+
+
+import os
+from io import BytesIO
+
+from testai.src.interactors.processing.codec import MP3, OPUS, WAV, AudioCodec, detect_format
+
+
+def test_detect_format():
+    assert detect_format(b"OggS\x00\x02") == OPUS
+    assert detect_format(b"ID3\x04\x00") == MP3
+    assert detect_format(b"RIFF\x00\x00\x00\x00WAVE") == WAV
+    assert detect_format(b"unknown") is None
+
+
+async def test_accepted_format_is_untouched():
+    audio = BytesIO(b"OggS" + b"\x00" * 32)
+
+    result, audio_format = await AudioCodec().negotiate(audio, accepted=(OPUS, MP3))
+
+    assert result is audio
+    assert audio_format == OPUS
+    assert audio.tell() == 0
+
+
+async def test_transcode_runs_ffmpeg(tmp_path, monkeypatch):
+    # a stand-in which passes the audio through, the real ffmpeg is not needed for the pipes
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text("#!/bin/sh\ncat\n")
+    ffmpeg.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+
+    codec = AudioCodec(max_processes=1)
+    result, audio_format = await codec.negotiate(BytesIO(b"RIFF\x00\x00\x00\x00WAVE"), accepted=(MP3, ))
+
+    assert result.read() == b"RIFF\x00\x00\x00\x00WAVE"
+    assert audio_format == MP3
+
+    codec.shutdown()
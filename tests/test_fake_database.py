@@ -60,3 +60,32 @@ async def test_add_two_assistant():
 
     assert user.assistants[1].openai_id == "321"
     assert user.assistants[1].name == "some2"
+
+
+async def test_get_or_create_user():
+    fakerepo = UserRepo(
+        user_gateway=FakeUserGateWay()
+    )
+
+    created = await fakerepo.get_or_create_user(123)
+    await fakerepo.add_assistant(123, "123", "some")
+
+    user = await fakerepo.get_or_create_user(123)
+
+    assert created.id == user.id == 123
+    assert user.assistants[0].openai_id == "123"
+
+
+async def test_writes_return_the_user():
+    fakerepo = UserRepo(
+        user_gateway=FakeUserGateWay()
+    )
+
+    await fakerepo.upsert_user(123)
+
+    user = await fakerepo.add_assistant(123, "123", "some")
+    assert user.assistants[0].openai_id == "123"
+
+    user = await fakerepo.upsert_user_mental(123, temperament="calm", profession="developer")
+    assert user.mental.profession == "developer"
+    assert user.assistants[0].name == "some"
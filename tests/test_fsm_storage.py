@@ -0,0 +1,114 @@
+
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from aiogram.fsm.storage.base import StorageKey
+
+from testai.src.interactors.database.gateways.fsm import FakeFSMGateWay
+from testai.src.presentation.telegram.storage import PostgresStorage
+
+
+class CountingGateWay(FakeFSMGateWay):
+    __slots__ = ("reads", "writes")
+
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+        self.writes = 0
+
+    async def get(self, key):
+        self.reads += 1
+        return await super().get(key)
+
+    async def upsert_many(self, states):
+        self.writes += 1
+        await super().upsert_many(states)
+
+
+def make_storage(gateway: CountingGateWay, **kwargs) -> PostgresStorage:
+    @asynccontextmanager
+    async def scope():
+        yield gateway
+
+    return PostgresStorage(gateway_scope=scope, **kwargs)
+
+
+KEY = StorageKey(bot_id=1, chat_id=2, user_id=3)
+
+
+async def test_writes_are_batched_and_cached():
+    gateway = CountingGateWay()
+    storage = make_storage(gateway, flush_interval=0.05)
+
+    await storage.set_state(KEY, "AudioState:write_audio")
+    await storage.update_data(KEY, {"assistant_id": "asst_1"})
+    await storage.update_data(KEY, {"thread_id": "thread_1"})
+
+    assert gateway.reads == 1
+    assert gateway.writes == 0
+    assert await storage.get_data(KEY) == {"assistant_id": "asst_1", "thread_id": "thread_1"}
+
+    await asyncio.sleep(0.1)
+
+    assert gateway.writes == 1
+
+    restarted = make_storage(gateway)
+    assert await restarted.get_state(KEY) == "AudioState:write_audio"
+    assert await restarted.get_data(KEY) == {"assistant_id": "asst_1", "thread_id": "thread_1"}
+
+
+async def test_cleared_state_is_deleted_on_close():
+    gateway = CountingGateWay()
+    storage = make_storage(gateway, flush_interval=10)
+    built = storage._key_builder.build(KEY)
+
+    await storage.set_state(KEY, "AudioState:write_mental")
+    await storage.close()
+    assert (await gateway.get(built)).state == "AudioState:write_mental"
+
+    await storage.set_state(KEY, None)
+    await storage.set_data(KEY, {})
+    await storage.close()
+
+    assert await gateway.get(built) is None
+
+
+class FailingOnceGateWay(CountingGateWay):
+    __slots__ = ("failed", )
+
+    def __init__(self):
+        super().__init__()
+        self.failed = False
+
+    async def upsert_many(self, states):
+        if not self.failed:
+            self.failed = True
+            raise ConnectionError()
+
+        await super().upsert_many(states)
+
+
+async def test_failed_flush_is_retried():
+    gateway = FailingOnceGateWay()
+    storage = make_storage(gateway, flush_interval=0.02)
+
+    await storage.set_data(KEY, {"thread_id": "thread_1"})
+    await asyncio.sleep(0.1)
+
+    assert gateway.failed
+    assert gateway.writes == 1
+
+
+async def test_shared_storages_see_each_other():
+    gateway = CountingGateWay()
+    first = make_storage(gateway, shared=True)
+    second = make_storage(gateway, shared=True)
+
+    assert await first.get_state(KEY) is None
+
+    # like the webhook workers, the next update of the user goes to another process
+    await second.set_state(KEY, "AudioState:write_audio")
+    assert gateway.writes == 1
+
+    assert await first.get_state(KEY) == "AudioState:write_audio"
@@ -0,0 +1,80 @@
+
+
+from types import SimpleNamespace
+
+from testai.src.interactors.database.gateways.user import LazyUserGateWay
+from testai.src.interactors.database.repositories.user import UserRepo
+
+
+class FakeSession:
+    def __init__(self, sessions: list["FakeSession"]):
+        self.closed = False
+        self.committed = False
+        sessions.append(self)
+
+    async def scalar(self, stmt):
+        return SimpleNamespace(id=1, tg_id=42, assisstants=[], mental=None)
+
+    async def execute(self, stmt):
+        row = SimpleNamespace(id=1, tg_id=42, assistants=[], mental=None)
+
+        return SimpleNamespace(one_or_none=lambda: row)
+
+    async def commit(self):
+        self.committed = True
+
+    async def close(self):
+        self.closed = True
+
+
+def make_gateway() -> tuple[LazyUserGateWay, list[FakeSession]]:
+    sessions = []
+
+    return LazyUserGateWay(sessionmaker=lambda: FakeSession(sessions)), sessions
+
+
+async def test_no_session_without_database_calls():
+    gateway, sessions = make_gateway()
+
+    await gateway.close()
+
+    assert sessions == []
+
+
+async def test_session_is_released_after_a_read():
+    gateway, sessions = make_gateway()
+    repo = UserRepo(user_gateway=gateway)
+
+    user = await repo.get_user_by_tg_id(42)
+
+    assert user.tg_id == 42
+    assert len(sessions) == 1
+    assert sessions[0].closed
+    assert not gateway.active
+
+
+async def test_write_keeps_the_session_until_commit():
+    gateway, sessions = make_gateway()
+
+    await gateway.add_user_assistants(user_id=1, assistant_id="asst_1", assistant_name="test")
+    assert gateway.active
+
+    await gateway.get_user_by_id(1)
+    assert len(sessions) == 1
+    assert gateway.active
+
+    await gateway.commit()
+
+    assert sessions[0].committed
+    assert sessions[0].closed
+    assert not gateway.active
+
+
+async def test_uncommitted_write_is_dropped_on_close():
+    gateway, sessions = make_gateway()
+
+    await gateway.add_user_assistants(user_id=1, assistant_id="asst_1", assistant_name="test")
+    await gateway.close()
+
+    assert not sessions[0].committed
+    assert sessions[0].closed
@@ -0,0 +1,45 @@
+
+
+from loadtest.harness import LoadTest, Scenario
+from loadtest.latency import Latency
+from loadtest.openai_stub import OpenAILatencies
+
+
+async def test_sessions_run_through_the_dispatcher():
+    scenario = Scenario(
+        users=2,
+        ramp_up=0,
+        voice_turns=2,
+        mental_turns=2,
+        voice_seconds=1,
+        think_time=0,
+        step_timeout=20,
+        reply_sentences=2,
+        openai=OpenAILatencies(
+            transcription=Latency(),
+            speech_first_byte=Latency(),
+            run_first_token=Latency(),
+            run_token=Latency(),
+            completion=Latency(),
+            api=Latency()
+        ),
+        telegram=Latency()
+    )
+
+    result = await LoadTest(scenario, config={"voice_coalesce_window": 0.01}).run()
+
+    counts = {value.name: value.count for value in result.handlers}
+
+    assert result.failed_sessions == 0
+    assert all(value.errors == 0 for value in result.handlers)
+    assert counts == {
+        "start": 2,
+        "add_assistant": 2,
+        "assistant_name": 2,
+        "choose_assistant": 2,
+        "voice_turn": 4,
+        "mental_start": 2,
+        "mental_turn": 2,
+        "mental_finish": 2
+    }
+    assert result.openai_calls["completion"] == 2
@@ -0,0 +1,128 @@
+
+
+import pytest
+
+from testai.config.config_reader import Config
+from testai.src.interactors.database.gateways.user_memory import MemoryUserGateWay, MemoryUserStore
+from testai.src.interactors.database.repositories.user import UserRepo
+from testai.src.presentation.telegram.main import build_dispatcher
+
+
+async def test_ids_are_sequences():
+    store = MemoryUserStore()
+    repo = UserRepo(user_gateway=MemoryUserGateWay(store=store))
+
+    first = await repo.get_or_create_user(100)
+    second = await repo.get_or_create_user(200)
+
+    await repo.add_assistant(first.id, "asst_1", "one")
+    user = await repo.add_assistant(first.id, "asst_2", "two")
+    other = await repo.add_assistant(second.id, "asst_3", "three")
+
+    assert (first.id, second.id) == (1, 2)
+    assert [assistant.id for assistant in user.assistants] == [1, 2]
+    assert other.assistants[0].id == 3
+    assert (await repo.get_user_by_tg_id(200)).id == 2
+
+
+async def test_writes_are_visible_after_commit_only():
+    store = MemoryUserStore()
+    writer = MemoryUserGateWay(store=store)
+    reader = MemoryUserGateWay(store=store)
+
+    user = await writer.get_or_create_user(100)
+    await writer.upsert_user_mental(user.id, temperament="calm", profession="developer")
+
+    assert (await writer.get_user_by_tg_id(100)).mental.profession == "developer"
+    assert await reader.get_user_unsafe(100) is None
+
+    await writer.commit()
+
+    assert (await reader.get_user_by_tg_id(100)).mental.profession == "developer"
+
+
+async def test_close_drops_uncommitted_writes():
+    store = MemoryUserStore()
+    gateway = MemoryUserGateWay(store=store)
+
+    await gateway.get_or_create_user(100)
+    await gateway.close()
+    await gateway.commit()
+
+    assert len(store) == 0
+
+
+async def test_concurrent_transactions_do_not_lose_writes():
+    store = MemoryUserStore()
+    repo = UserRepo(user_gateway=MemoryUserGateWay(store=store))
+    user = await repo.get_or_create_user(100)
+
+    first = MemoryUserGateWay(store=store)
+    second = MemoryUserGateWay(store=store)
+
+    await first.add_user_assistants(user.id, "asst_1", "one")
+    await second.add_user_assistants(user.id, "asst_2", "two")
+    await first.commit()
+    await second.commit()
+
+    user = await repo.get_user_by_id(user.id)
+    assert [assistant.openai_id for assistant in user.assistants] == ["asst_1", "asst_2"]
+
+
+async def test_concurrent_creation_returns_the_same_user():
+    store = MemoryUserStore()
+    first = MemoryUserGateWay(store=store)
+    second = MemoryUserGateWay(store=store)
+
+    created = await first.get_or_create_user(100)
+    concurrent = await second.get_or_create_user(100)
+    await first.upsert_user_mental(created.id, temperament="choleric", profession="manager")
+    await second.upsert_user_mental(concurrent.id, temperament="calm", profession="developer")
+
+    await first.commit()
+    await second.commit()
+
+    user = await MemoryUserGateWay(store=store).get_user_by_tg_id(100)
+
+    assert created.id == concurrent.id == user.id
+    assert len(store) == 1
+    # like an upsert on the user id, the later commit updates the row and keeps its id
+    assert user.mental.profession == "developer"
+    assert user.mental.id == 1
+
+
+async def test_snapshot_round_trip(tmp_path):
+    path = tmp_path / "users.snapshot"
+    store = MemoryUserStore(path=path)
+    repo = UserRepo(user_gateway=MemoryUserGateWay(store=store))
+
+    for tg_id in range(1000):
+        user = await repo.get_or_create_user(tg_id)
+        await repo.add_assistant(user.id, f"asst_{tg_id}", "test")
+
+    await repo.upsert_user_mental(1, temperament="calm", profession="developer")
+    await store.close()
+
+    restored = MemoryUserStore(path=path)
+    restored.load()
+    repo = UserRepo(user_gateway=MemoryUserGateWay(store=restored))
+
+    assert len(restored) == 1000
+    assert (await repo.get_user_by_tg_id(999)).assistants[0].openai_id == "asst_999"
+    assert (await repo.get_user_by_id(1)).mental.profession == "developer"
+    # the sequences continue after the restored ids
+    assert (await repo.get_or_create_user(5000)).id == 1001
+
+
+@pytest.mark.parametrize("workers, shards", [(2, 1), (1, 2)])
+async def test_memory_driver_refuses_several_processes(workers: int, shards: int):
+    config = Config(
+        bot_token="42:TEST",
+        openai_key="test",
+        database_url="postgresql://localhost/test",
+        database_driver="memory",
+        webhook_workers=workers
+    )
+
+    with pytest.raises(ValueError):
+        await build_dispatcher(config, shards=shards)
@@ -0,0 +1,93 @@
+
+
+import struct
+
+from testai.src.interactors.processing.ogg import (
+    END_OF_STREAM, OPUS_RATE, OggPage, merge_transcripts, ogg_crc, parse_pages, split_opus
+)
+
+
+def page(granule: int, sequence: int, body: bytes, header_type: int = 0) -> bytes:
+    lacing = bytes([255] * (len(body) // 255) + [len(body) % 255])
+
+    return OggPage(
+        header_type=header_type,
+        granule=granule,
+        serial=7,
+        sequence=sequence,
+        lacing=lacing,
+        body=memoryview(body)
+    ).render(sequence=sequence, granule=granule, header_type=header_type)
+
+
+def opus_stream(seconds: int) -> bytes:
+    head = b"OpusHead" + bytes([1, 1]) + struct.pack("<HIhB", 312, 48000, 0, 0)
+    tags = b"OpusTags" + struct.pack("<I", 0) + struct.pack("<I", 0)
+
+    pages = [page(0, 0, head, header_type=0x02), page(0, 1, tags)]
+    for second in range(seconds):
+        header_type = END_OF_STREAM if second == seconds - 1 else 0
+        pages.append(page((second + 1) * OPUS_RATE, second + 2, bytes([second]) * 100, header_type=header_type))
+
+    return b"".join(pages)
+
+
+def test_crc():
+    assert ogg_crc(b"123456789") == 0x89A1897F
+
+
+def test_crc_of_a_page():
+    # an opus identification page, its checksum was checked with cksum, which is the same crc with the length
+    page = bytes.fromhex(
+        "4f676753000200000000000000004a3b2c1d000000000000000001134f707573486561640101380180bb0000000000"
+    )
+
+    assert ogg_crc(page) == 0xD1A18CFE
+
+    rendered = parse_pages(page[:22] + struct.pack("<I", 0xD1A18CFE) + page[26:])[0].render(
+        sequence=0, granule=0, header_type=0x02
+    )
+    assert rendered[22:26] == struct.pack("<I", 0xD1A18CFE)
+
+
+def test_split_keeps_headers_and_overlaps():
+    segments = split_opus(opus_stream(10), length=4, overlap=1)
+
+    assert len(segments) == 3
+
+    for segment in segments:
+        pages = parse_pages(segment)
+
+        assert bytes(pages[0].body).startswith(b"OpusHead")
+        assert bytes(pages[1].body).startswith(b"OpusTags")
+        assert [item.sequence for item in pages] == list(range(len(pages)))
+        assert [bool(item.header_type & END_OF_STREAM) for item in pages][-2:] == [False, True]
+
+        for item in pages:
+            raw = bytearray(item.render(sequence=item.sequence, granule=item.granule, header_type=item.header_type))
+            assert ogg_crc(raw[:22] + b"\x00" * 4 + raw[26:]) == struct.unpack_from("<I", raw, 22)[0]
+
+    first, second, third = [[bytes(item.body)[0] for item in parse_pages(segment)[2:]] for segment in segments]
+
+    assert first == [0, 1, 2, 3]
+    assert second == [3, 4, 5, 6]
+    assert third == [6, 7, 8, 9]
+
+    # later segments start right after the pre skip
+    assert parse_pages(segments[1])[2].granule == 312 + OPUS_RATE
+
+
+def test_short_stream_is_one_segment():
+    data = opus_stream(3)
+
+    assert split_opus(data, length=60, overlap=2) == [data]
+
+
+def test_merge_transcripts():
+    assert merge_transcripts([
+        "I went to the store and bought",
+        "and bought some milk. Then I",
+        "then I came home."
+    ]) == "I went to the store and bought some milk. Then I came home."
+
+    assert merge_transcripts(["One.", "Two."]) == "One. Two."
@@ -0,0 +1,67 @@
+
+
+import asyncio
+from types import SimpleNamespace
+
+from testai.src.presentation.telegram.progressive import ChatEditLimiter, ProgressiveMessage
+
+
+class FakeReply:
+    def __init__(self, edits):
+        self.edits = edits
+        self.deleted = False
+
+    async def edit_text(self, text, parse_mode=None):
+        self.edits.append(text)
+
+    async def delete(self):
+        self.deleted = True
+
+
+class FakeMessage:
+    def __init__(self):
+        self.chat = SimpleNamespace(id=1)
+        self.edits = []
+        self.replies = []
+
+    async def answer(self, text, parse_mode=None):
+        reply = FakeReply(self.edits)
+        self.replies.append(reply)
+
+        return reply
+
+
+async def deltas(*parts):
+    for part in parts:
+        await asyncio.sleep(0.001)
+        yield part
+
+
+async def test_edits_are_coalesced():
+    message = FakeMessage()
+    limiter = ChatEditLimiter(min_interval=0.05)
+
+    text = await ProgressiveMessage(message, limiter=limiter).stream(deltas(*["a"] * 20))
+
+    assert text == "a" * 20
+    assert message.edits[-1] == text
+    assert len(message.edits) < 20
+    assert len(set(message.edits)) == len(message.edits)
+
+
+async def test_empty_answer_removes_placeholder():
+    message = FakeMessage()
+
+    await ProgressiveMessage(message, limiter=ChatEditLimiter(min_interval=0.01)).stream(deltas())
+
+    assert message.replies[0].deleted
+
+
+def test_flood_slows_down():
+    limiter = ChatEditLimiter(min_interval=1)
+
+    limiter.flood(1, retry_after=5)
+    assert limiter.interval(1) == 5
+
+    limiter.success(1)
+    assert limiter.interval(1) == 4.5
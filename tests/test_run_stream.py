@@ -0,0 +1,87 @@
+
+
+from types import SimpleNamespace
+
+from testai.src.interactors.processing.text_to_response import (
+    ContextBasedResponseContainer,
+    TextDelta,
+    ToolCall,
+    iter_text,
+    read_run_stream
+)
+
+
+class FakeStream:
+    def __init__(self, events):
+        self.events = events
+        self.read = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def __aiter__(self):
+        for event in self.events:
+            self.read += 1
+            yield event
+
+
+class FakeRuns:
+    def __init__(self):
+        self.cancelled = []
+
+    async def cancel(self, thread_id, run_id):
+        self.cancelled.append(run_id)
+
+
+def delta(text):
+    part = SimpleNamespace(type="text", text=SimpleNamespace(value=text))
+
+    return SimpleNamespace(event="thread.message.delta", data=SimpleNamespace(delta=SimpleNamespace(content=[part])))
+
+
+def requires_action(arguments):
+    call = SimpleNamespace(function=SimpleNamespace(name="save_value", arguments=arguments))
+    action = SimpleNamespace(submit_tool_outputs=SimpleNamespace(tool_calls=[call]))
+
+    return SimpleNamespace(
+        event="thread.run.requires_action",
+        data=SimpleNamespace(id="run", required_action=action)
+    )
+
+
+async def test_dispatch_and_stop_on_cancel():
+    runs = FakeRuns()
+    client = SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(runs=runs)))
+
+    stream = FakeStream([
+        delta("Hel"),
+        SimpleNamespace(event="thread.run.step.created", data=None),
+        delta("lo"),
+        requires_action('{"a": 1}'),
+        delta("never")
+    ])
+
+    events = [event async for event in read_run_stream(client, thread_id="thread", stream=stream)]
+
+    assert events == [
+        TextDelta(text="Hel"),
+        TextDelta(text="lo"),
+        ToolCall(run_id="run", name="save_value", arguments='{"a": 1}')
+    ]
+    assert runs.cancelled == ["run"]
+    assert stream.read == 4
+
+
+async def test_iter_text_fills_context():
+    async def events():
+        yield TextDelta(text="a")
+        yield ToolCall(run_id="run", name="save_value", arguments="{}")
+        yield TextDelta(text="b")
+
+    container = ContextBasedResponseContainer()
+
+    assert [text async for text in iter_text(events(), container=container)] == ["a", "b"]
+    assert container.context == "{}"
@@ -0,0 +1,130 @@
+
+
+import asyncio
+
+import httpx
+
+from testai.src.interactors.scheduling import (
+    EndpointLimiter, OpenAIScheduler, Priority, ScheduledTransport, endpoint_of, scheduling
+)
+
+
+async def run_queued(limiter: EndpointLimiter, calls: list[tuple[Priority, int]]) -> list[int]:
+    order = []
+
+    # the only slot is taken, so every call below has to queue
+    await limiter.acquire(Priority.NORMAL, user=None)
+
+    async def call(index: int, priority: Priority, user: int) -> None:
+        await limiter.acquire(priority, user=user)
+        order.append(index)
+        limiter.release(latency=0.1, throttled=False)
+
+    tasks = [asyncio.create_task(call(index, *item)) for index, item in enumerate(calls)]
+    await asyncio.sleep(0)
+
+    assert limiter.stats.queued == len(calls)
+
+    limiter.release(latency=0.1, throttled=False)
+    await asyncio.gather(*tasks)
+
+    return order
+
+
+async def test_priority_goes_first():
+    limiter = EndpointLimiter(initial_limit=1, max_limit=1)
+
+    order = await run_queued(limiter, [
+        (Priority.BACKGROUND, 1),
+        (Priority.NORMAL, 2),
+        (Priority.INTERACTIVE, 3)
+    ])
+
+    assert order == [2, 1, 0]
+
+
+async def test_users_are_interleaved():
+    limiter = EndpointLimiter(initial_limit=1, max_limit=1)
+
+    order = await run_queued(limiter, [
+        (Priority.NORMAL, 1),
+        (Priority.NORMAL, 1),
+        (Priority.NORMAL, 1),
+        (Priority.NORMAL, 2)
+    ])
+
+    assert order == [0, 3, 1, 2]
+
+
+async def test_aimd():
+    limiter = EndpointLimiter(initial_limit=8)
+
+    await limiter.acquire(Priority.NORMAL, user=None)
+    limiter.release(latency=0.1, throttled=True)
+    assert limiter.stats.limit == 4
+
+    for _ in range(4):
+        await limiter.acquire(Priority.NORMAL, user=None)
+        limiter.release(latency=0.1, throttled=False)
+    assert limiter.stats.limit > 4
+
+    limit = limiter.stats.limit
+    await limiter.acquire(Priority.NORMAL, user=None)
+    limiter.release(latency=1.0, throttled=False)
+    assert limiter.stats.limit < limit
+
+
+async def test_cancelled_waiter_is_skipped():
+    limiter = EndpointLimiter(initial_limit=1, max_limit=1)
+    await limiter.acquire(Priority.NORMAL, user=None)
+
+    task = asyncio.create_task(limiter.acquire(Priority.NORMAL, user=None))
+    await asyncio.sleep(0)
+    task.cancel()
+    await asyncio.sleep(0)
+
+    assert limiter.stats.queued == 0
+
+    limiter.release(latency=0.1, throttled=False)
+    assert limiter.stats.in_flight == 0
+
+
+async def test_cancelled_after_handover_is_not_a_failure():
+    limiter = EndpointLimiter(initial_limit=1, max_limit=1)
+    await limiter.acquire(Priority.NORMAL, user=None)
+
+    task = asyncio.create_task(limiter.acquire(Priority.NORMAL, user=None))
+    await asyncio.sleep(0)
+
+    # the slot goes to the waiter, which is cancelled before it runs
+    limiter.release(latency=0.1, throttled=False)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    assert limiter.stats.in_flight == 0
+    assert limiter.stats.failures == 0
+    assert limiter.stats.completed == 1
+
+
+def test_endpoint_of():
+    assert endpoint_of("/v1/threads/thread_abc123/runs") == "/v1/threads/{id}/runs"
+    assert endpoint_of("/v1/audio/speech") == "/v1/audio/speech"
+
+
+async def test_transport_holds_slot_until_body_is_read():
+    scheduler = OpenAIScheduler(initial_limit=2)
+    transport = ScheduledTransport(
+        scheduler,
+        inner=httpx.MockTransport(lambda request: httpx.Response(200, content=b"done"))
+    )
+
+    async with httpx.AsyncClient(transport=transport) as client:
+        with scheduling(priority=Priority.INTERACTIVE, user=1):
+            async with client.stream("POST", "https://api.openai.com/v1/threads/thread_1/runs") as response:
+                stats = scheduler.stats()["POST /v1/threads/{id}/runs"]
+                assert stats.in_flight == 1
+
+                assert await response.aread() == b"done"
+
+    assert stats.in_flight == 0
+    assert stats.completed == 1
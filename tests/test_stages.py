@@ -0,0 +1,57 @@
+
+
+import asyncio
+
+import pytest
+
+from testai.src.interactors.stages import StageGraph
+
+
+async def test_independent_stages_run_concurrently():
+    async def slow(value):
+        await asyncio.sleep(0.05)
+        return value
+
+    async def total(a, b):
+        return a + b
+
+    graph = StageGraph()
+    graph.add("a", lambda: slow(1))
+    graph.add("b", lambda: slow(2))
+    graph.add("total", total, "a", "b")
+
+    started = asyncio.get_running_loop().time()
+    stages = await graph.run()
+
+    assert stages == {"a": 1, "b": 2, "total": 3}
+    assert asyncio.get_running_loop().time() - started < 0.09
+
+
+async def test_failure_cancels_the_rest():
+    cancelled = asyncio.Event()
+
+    async def fail():
+        raise ValueError("Audio undefined")
+
+    async def forever():
+        try:
+            await asyncio.sleep(10)
+
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    graph = StageGraph()
+    graph.add("fail", fail)
+    graph.add("forever", forever)
+
+    with pytest.raises(ValueError):
+        await graph.run()
+
+    await asyncio.sleep(0)
+    assert cancelled.is_set()
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError):
+        StageGraph().add("b", lambda a: a, "a")
@@ -0,0 +1,63 @@
+
+
+import asyncio
+from io import BytesIO
+
+from testai.src.interactors.processing.codec import OPUS
+from testai.src.interactors.processing.streaming import SentenceSplitter, stream_speech
+from testai.src.interactors.processing.text_to_audio import TextToAudioInteractor
+
+
+class FakeTextToAudio(TextToAudioInteractor):
+    audio_format = OPUS
+
+    async def get_response(self, text, getname) -> BytesIO:
+        # longer sentences finish later, the order of sending must not depend on it
+        await asyncio.sleep(len(text) / 1000)
+
+        return BytesIO(text.encode())
+
+    async def stream_response(self, text):
+        yield text.encode()
+
+
+async def deltas(*parts: str):
+    for part in parts:
+        yield part
+
+
+def test_splitter_waits_for_whitespace():
+    splitter = SentenceSplitter(min_length=1)
+
+    assert splitter.feed("Pi is 3.") == []
+    assert splitter.feed("14. And") == ["Pi is 3.14."]
+    assert splitter.flush() == "And"
+
+
+def test_splitter_glues_short_sentences():
+    splitter = SentenceSplitter(min_length=10)
+
+    assert splitter.feed("Hi! How are you doing? ") == ["Hi! How are you doing?"]
+    assert splitter.flush() is None
+
+
+async def test_stream_speech_order():
+    sent = []
+
+    async def send(audio: BytesIO, text: str, last: bool):
+        sent.append((audio.read().decode(), last))
+
+    text = await stream_speech(
+        deltas("A very very long first sentence. ", "Short. ", "Tail"),
+        text_to_audio=FakeTextToAudio(),
+        getname=lambda postfix: postfix,
+        send=send,
+        splitter=SentenceSplitter(min_length=1)
+    )
+
+    assert text == "A very very long first sentence. Short. Tail"
+    assert sent == [
+        ("A very very long first sentence.", False),
+        ("Short.", False),
+        ("Tail", True)
+    ]
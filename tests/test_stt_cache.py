@@ -0,0 +1,57 @@
+
+
+import asyncio
+from io import BytesIO
+
+from testai.src.interactors.caching import TTLCache
+from testai.src.interactors.processing.stt_cache import CachedAudioToText
+
+
+class FakeWhisper:
+    model = "whisper-1"
+
+    async def get_response(self, audio, getname, duration=None):
+        return audio.read().decode()
+
+
+def test_ttl_cache_size():
+    cache = TTLCache(ttl=60, max_size=2)
+
+    cache.set(1, "a")
+    cache.set(2, "b")
+    cache.get(1)
+    cache.set(3, "c")
+
+    assert cache.get(2) is None
+    assert cache.get(1) == "a"
+    assert cache.stats.evictions == 1
+
+
+def test_ttl_cache_expired():
+    cache = TTLCache(ttl=-1, max_size=2)
+
+    cache.set(1, "a")
+
+    assert cache.get(1) is None
+    assert len(cache) == 0
+
+
+async def test_hit_skips_download():
+    downloads = 0
+
+    async def download():
+        nonlocal downloads
+        downloads += 1
+        await asyncio.sleep(0.01)
+
+        return BytesIO(b"hello")
+
+    stt = CachedAudioToText(inner=FakeWhisper())
+
+    results = await asyncio.gather(*[
+        stt.get_response_by_id("unique", download=download, getname=lambda postfix: postfix) for _ in range(3)
+    ])
+    results.append(await stt.get_response_by_id("unique", download=download, getname=lambda postfix: postfix))
+
+    assert results == ["hello"] * 4
+    assert downloads == 1
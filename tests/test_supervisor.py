@@ -0,0 +1,92 @@
+
+
+import os
+import time
+import multiprocessing
+from functools import partial
+
+from aiogram.types import Update
+
+from testai.src.presentation.telegram.supervisor import Supervisor, routing_id, shard_of
+
+
+def message_update(update_id: int, user_id: int) -> Update:
+    return Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "test"},
+            "text": "hello"
+        }
+    })
+
+
+def record_worker(handled, shard, shards, updates, heartbeat):
+    heartbeat.value = time.monotonic()
+
+    # a blocking get, like the thread of a shard, so a kill leaves the lock of the queue taken
+    while (update := updates.get()) is not None:
+        heartbeat.value = time.monotonic()
+        handled.put((os.getpid(), update["update_id"]))
+
+
+def test_users_stick_to_one_shard():
+    shards = {shard_of(user_id, 4) for user_id in range(1000)}
+    assert shards == {0, 1, 2, 3}
+
+    assert shard_of(123456789, 4) == shard_of(123456789, 4)
+    assert routing_id(message_update(1, 42)) == 42
+
+
+def test_route_keeps_the_raw_update():
+    supervisor = Supervisor(partial(record_worker, None), shards=3)
+
+    shard = supervisor.route(message_update(1, 42))
+    update = supervisor._queues[shard].get(timeout=1)
+
+    assert shard == shard_of(42, 3)
+    assert update["message"]["from"]["id"] == 42
+    assert Update.model_validate(update).message.from_user.id == 42
+
+
+def test_killed_shard_is_restarted_and_handles_updates():
+    handled = multiprocessing.Queue()
+    supervisor = Supervisor(partial(record_worker, handled), shards=1, health_timeout=60)
+    supervisor.start()
+
+    supervisor.route(message_update(1, 42))
+    first_pid, update_id = handled.get(timeout=5)
+    assert update_id == 1
+
+    # killed while it waits on the queue
+    time.sleep(0.1)
+    supervisor._workers[0].kill()
+    supervisor._workers[0].join()
+
+    # routed while the shard is dead, it waits for the next incarnation
+    supervisor.route(message_update(2, 42))
+
+    supervisor.check()
+    assert supervisor.restarts == 1
+
+    supervisor.route(message_update(3, 42))
+
+    assert [handled.get(timeout=5) for _ in range(2)] == [(supervisor._workers[0].pid, 2), (supervisor._workers[0].pid, 3)]
+    assert supervisor._workers[0].pid != first_pid
+
+    supervisor.stop(timeout=5)
+    assert not supervisor._workers[0].is_alive()
+
+
+def test_healthy_workers_are_kept():
+    supervisor = Supervisor(partial(record_worker, multiprocessing.Queue()), shards=2, health_timeout=60)
+    supervisor.start()
+
+    time.sleep(0.2)
+    supervisor.check()
+
+    assert supervisor.restarts == 0
+
+    supervisor.stop(timeout=5)
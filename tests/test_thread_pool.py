@@ -0,0 +1,44 @@
+
+
+import asyncio
+from itertools import count
+
+from testai.src.interactors.processing.thread_pool import ThreadPrefetcher
+
+
+def fake_create():
+    ids = count()
+
+    async def create():
+        await asyncio.sleep(0.01)
+
+        return f"thread_{next(ids)}"
+
+    return create
+
+
+async def test_inline_when_empty_then_prefetched():
+    pool = ThreadPrefetcher(create=fake_create(), min_size=2)
+
+    first = await pool.acquire()
+    assert pool.stats.misses == 1
+
+    await asyncio.sleep(0.05)
+    assert len(pool) == 2
+
+    second = await pool.acquire()
+    assert second != first
+    assert pool.stats.hits == 1
+
+    await asyncio.sleep(0.05)
+
+
+async def test_target_grows_with_demand():
+    pool = ThreadPrefetcher(create=fake_create(), min_size=1, max_size=10, window=1.0)
+
+    await asyncio.gather(*[pool.acquire() for _ in range(200)])
+
+    assert pool.target_size() == 10
+
+    await asyncio.sleep(0.05)
+    assert len(pool) == 10
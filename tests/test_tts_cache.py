@@ -0,0 +1,104 @@
+
+
+import os
+import asyncio
+
+from testai.src.interactors.processing.codec import OPUS
+from testai.src.interactors.processing.tts_cache import CachedTextToAudio
+
+
+class FakeTTS:
+    model = "tts-1"
+    voice = "alloy"
+    audio_format = OPUS
+
+    def __init__(self):
+        self.calls = 0
+
+    async def stream_response(self, text):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+
+        yield text.encode()
+        yield b"!"
+
+
+async def test_single_flight():
+    inner = FakeTTS()
+    cache = CachedTextToAudio(inner=inner)
+
+    results = await asyncio.gather(*[
+        cache.get_response("hello", getname=lambda postfix: postfix) for _ in range(5)
+    ])
+
+    assert inner.calls == 1
+    assert {result.read() for result in results} == {b"hello!"}
+    assert cache.stats.misses == 1
+
+
+async def test_eviction_by_bytes():
+    inner = FakeTTS()
+    cache = CachedTextToAudio(inner=inner, max_memory_bytes=12)
+
+    await cache.get_response("first", getname=lambda postfix: postfix)
+    await cache.get_response("second", getname=lambda postfix: postfix)
+
+    assert cache.stats.evictions == 1
+    assert cache.stats.memory_bytes == 7
+
+    await cache.get_response("second", getname=lambda postfix: postfix)
+    assert cache.stats.hits == 1
+
+
+async def test_disk_survives_restart(tmp_path):
+    inner = FakeTTS()
+
+    await CachedTextToAudio(inner=inner, directory=str(tmp_path)).get_response(
+        "hello", getname=lambda postfix: postfix
+    )
+
+    cache = CachedTextToAudio(inner=inner, directory=str(tmp_path))
+    chunks = [bytes(chunk) async for chunk in cache.stream_response("hello")]
+
+    assert b"".join(chunks) == b"hello!"
+    assert inner.calls == 1
+    assert cache.stats.disk_hits == 1
+
+
+async def test_disk_evicts_the_oldest(tmp_path):
+    inner = FakeTTS()
+    cache = CachedTextToAudio(inner=inner, directory=str(tmp_path), max_memory_bytes=0, max_disk_bytes=14)
+
+    await cache.get_response("first", getname=lambda postfix: postfix)
+    await cache.get_response("second", getname=lambda postfix: postfix)
+    await cache.get_response("first", getname=lambda postfix: postfix)
+    await cache.get_response("third", getname=lambda postfix: postfix)
+
+    assert cache.stats.disk_hits == 1
+    assert cache.stats.disk_bytes == 12
+    assert cache.stats.disk_evictions == 1
+    assert cache.stats.evictions == 0
+    assert len(list(tmp_path.glob("*/*"))) == 2
+
+    # the second was used least recently, it is gone after a restart too
+    restarted = CachedTextToAudio(inner=inner, directory=str(tmp_path), max_memory_bytes=0, max_disk_bytes=14)
+    await restarted.get_response("second", getname=lambda postfix: postfix)
+
+    assert restarted.stats.misses == 1
+
+
+async def test_scan_keeps_the_writes_of_live_processes(tmp_path):
+    (tmp_path / "ab").mkdir()
+
+    # one of a live process, one left long ago by a process which is gone
+    live = tmp_path / "ab" / f"abc.{os.getpid()}.tmp"
+    live.write_bytes(b"data")
+    stale = tmp_path / "ab" / "abd.999999999.tmp"
+    stale.write_bytes(b"data")
+    os.utime(stale, (0, 0))
+
+    cache = CachedTextToAudio(inner=FakeTTS(), directory=str(tmp_path))
+
+    assert live.exists()
+    assert not stale.exists()
+    assert cache.stats.disk_bytes == 0
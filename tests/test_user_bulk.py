@@ -0,0 +1,62 @@
+
+
+import io
+
+from testai.src.interactors.database.gateways.user_bulk import FakeUserBulkGateWay
+from testai.src.interactors.database.repositories.user_bulk import UserBulkRepo
+
+NDJSON = """{"tg_id": 1, "mental": {"temperament": "calm", "profession": "developer"}, "assistants": [{"openai_id": "asst_1", "name": "first"}]}
+
+{"tg_id": 2, "mental": null, "assistants": []}
+{"tg_id": 1, "mental": null, "assistants": [{"openai_id": "asst_2", "name": "second"}]}
+"""
+
+CSV = """tg_id,temperament,profession,openai_id,name
+1,calm,developer,asst_1,first
+1,calm,developer,asst_2,second
+2,,,,
+"""
+
+
+async def export(repo: UserBulkRepo, format: str) -> str:
+    output = io.BytesIO()
+
+    async def write(chunk: bytes):
+        output.write(chunk)
+
+    await repo.export_users(write, format)
+
+    return output.getvalue().decode()
+
+
+async def test_import_ndjson():
+    gateway = FakeUserBulkGateWay()
+
+    stats = await UserBulkRepo(gateway=gateway).import_users(io.StringIO(NDJSON), "ndjson")
+
+    assert (stats.records, stats.users, stats.assistants, stats.mentals) == (3, 2, 2, 1)
+    assert [value.openai_id for value in gateway.users[1].assistants] == ["asst_1", "asst_2"]
+    assert gateway.users[1].mental.profession == "developer"
+    assert gateway.users[2].mental is None
+
+
+async def test_import_csv():
+    gateway = FakeUserBulkGateWay()
+
+    stats = await UserBulkRepo(gateway=gateway).import_users(io.StringIO(CSV, newline=""), "csv")
+
+    assert (stats.records, stats.users, stats.assistants) == (3, 2, 2)
+    assert gateway.users[2].assistants == []
+    assert gateway.users[2].mental is None
+
+
+async def test_export_is_read_back():
+    for format, data in (("ndjson", NDJSON), ("csv", CSV)):
+        original = FakeUserBulkGateWay()
+        repo = UserBulkRepo(gateway=original)
+        await repo.import_users(io.StringIO(data), format)
+
+        copy = FakeUserBulkGateWay()
+        await UserBulkRepo(gateway=copy).import_users(io.StringIO(await export(repo, format)), format)
+
+        assert copy.users == original.users
@@ -0,0 +1,108 @@
+
+
+import asyncio
+
+from testai.src.interactors.database.gateways.user import FakeUserGateWay, UserDomain
+from testai.src.interactors.database.repositories.user import UserCache, UserRepo
+
+
+class CountingGateWay(FakeUserGateWay):
+    __slots__ = ("loads", )
+
+    def __init__(self):
+        super().__init__()
+        self.loads = 0
+        self._users[1] = UserDomain(id=1, tg_id=42, assistans=[])
+
+    async def get_user_by_tg_id(self, tg_id: int) -> UserDomain:
+        self.loads += 1
+        await asyncio.sleep(0.01)
+
+        return await super().get_user_by_tg_id(tg_id)
+
+    async def get_user_by_id(self, user_id: int) -> UserDomain:
+        self.loads += 1
+        await asyncio.sleep(0.01)
+
+        return await super().get_user_by_id(user_id)
+
+
+async def test_both_keys_are_cached():
+    gateway = CountingGateWay()
+    cache = UserCache()
+    repo = UserRepo(user_gateway=gateway, cache=cache)
+
+    user = await repo.get_user_by_tg_id(42)
+
+    assert await repo.get_user_by_id(1) is user
+    assert await UserRepo(user_gateway=gateway, cache=cache).get_user_by_tg_id(42) is user
+    assert gateway.loads == 1
+    assert cache.stats.hits == 2
+    assert cache.stats.loads == 1
+    assert cache.stats.load_latency > 0
+
+
+async def test_concurrent_misses_share_one_load():
+    gateway = CountingGateWay()
+    cache = UserCache()
+    repo = UserRepo(user_gateway=gateway, cache=cache)
+
+    users = await asyncio.gather(*[repo.get_user_by_tg_id(42) for _ in range(5)])
+
+    assert gateway.loads == 1
+    assert cache.stats.shared == 4
+    assert all(user is users[0] for user in users)
+
+
+async def test_writes_invalidate_both_keys():
+    gateway = CountingGateWay()
+    repo = UserRepo(user_gateway=gateway, cache=UserCache())
+
+    await repo.get_user_by_tg_id(42)
+
+    user = await repo.add_assistant(user_id=1, openai_id="asst_1", name="test")
+    assert [assistant.openai_id for assistant in user.assistants] == ["asst_1"]
+
+    # the write returned the whole user, it replaced the cached one without a reload
+    assert (await repo.get_user_by_tg_id(42)) is user
+    assert gateway.loads == 1
+
+    await repo.upsert_user_mental(user_id=1, temperament="calm", profession="developer")
+
+    assert (await repo.get_user_by_tg_id(42)).mental.profession == "developer"
+
+
+async def test_load_during_a_write_is_not_cached():
+    gateway = CountingGateWay()
+    cache = UserCache()
+    repo = UserRepo(user_gateway=gateway, cache=cache)
+
+    loading = asyncio.create_task(repo.get_user_by_tg_id(42))
+    await asyncio.sleep(0)
+
+    cache.invalidate(user_id=1)
+    await loading
+
+    await repo.get_user_by_tg_id(42)
+    assert gateway.loads == 2
+
+
+async def test_invalidate_by_id_after_the_id_entry_was_evicted():
+    gateway = CountingGateWay()
+    gateway._users[2] = UserDomain(id=2, tg_id=43, assistans=[])
+    gateway._users[3] = UserDomain(id=3, tg_id=44, assistans=[])
+
+    cache = UserCache(max_size=2)
+    repo = UserRepo(user_gateway=gateway, cache=cache)
+
+    await repo.get_user_by_tg_id(42)
+    await repo.get_user_by_tg_id(43)
+    await repo.get_user_by_tg_id(42)
+    # the third user evicts the id entries of the first two, the telegram id entry of the first one is kept
+    await repo.get_user_by_tg_id(44)
+    assert gateway.loads == 3
+
+    cache.invalidate(user_id=1)
+    await repo.get_user_by_tg_id(42)
+
+    assert gateway.loads == 4
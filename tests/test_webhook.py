@@ -0,0 +1,111 @@
+
+
+import os
+import signal
+import asyncio
+
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import Message
+from aiohttp.test_utils import TestClient, TestServer
+
+from testai.src.presentation.telegram.webhook import create_webhook_app, serve_webhook_app
+
+
+def update(update_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": update_id, "is_bot": False, "first_name": "test"},
+            "text": "hello"
+        }
+    }
+
+
+async def test_updates_are_answered_at_once_and_handled_bounded():
+    router = Router()
+    release = asyncio.Event()
+    running = 0
+    max_running = 0
+    handled = []
+
+    @router.message()
+    async def handler(message: Message):
+        nonlocal running, max_running
+
+        running += 1
+        max_running = max(max_running, running)
+
+        await release.wait()
+
+        running -= 1
+        handled.append(message.message_id)
+
+    dp = Dispatcher()
+    dp.include_router(router)
+
+    bot = Bot(token="42:TEST")
+    app = create_webhook_app(dp, bot, path="/webhook", secret_token="secret", max_concurrency=2)
+
+    # a fake telegram, it posts the updates like the real one does
+    async with TestClient(TestServer(app)) as telegram:
+        unauthorized = await telegram.post("/webhook", json=update(0))
+        assert unauthorized.status == 401
+
+        for update_id in range(1, 6):
+            response = await telegram.post(
+                "/webhook",
+                json=update(update_id),
+                headers={"X-Telegram-Bot-Api-Secret-Token": "secret"}
+            )
+            assert response.status == 200
+
+        await asyncio.sleep(0.05)
+        assert max_running == 2
+        assert not handled
+
+        release.set()
+        await asyncio.sleep(0.05)
+
+    assert sorted(handled) == [1, 2, 3, 4, 5]
+    assert max_running == 2
+
+
+async def test_backlog_is_bounded():
+    router = Router()
+    release = asyncio.Event()
+
+    @router.message()
+    async def handler(message: Message):
+        await release.wait()
+
+    dp = Dispatcher()
+    dp.include_router(router)
+
+    app = create_webhook_app(dp, Bot(token="42:TEST"), path="/webhook", max_concurrency=1, max_pending=2)
+
+    async with TestClient(TestServer(app)) as telegram:
+        statuses = [(await telegram.post("/webhook", json=update(update_id))).status for update_id in range(3)]
+        release.set()
+
+    assert statuses == [200, 200, 503]
+
+
+async def test_sigterm_shuts_the_dispatcher_down():
+    dp = Dispatcher()
+    stopped = asyncio.Event()
+
+    @dp.shutdown()
+    async def on_shutdown():
+        stopped.set()
+
+    app = create_webhook_app(dp, Bot(token="42:TEST"), path="/webhook")
+    server = asyncio.create_task(serve_webhook_app(app, host="127.0.0.1", port=0))
+    await asyncio.sleep(0.05)
+
+    os.kill(os.getpid(), signal.SIGTERM)
+    await asyncio.wait_for(server, 5)
+
+    assert stopped.is_set()
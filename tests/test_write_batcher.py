@@ -0,0 +1,142 @@
+
+
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from testai.src.interactors.database.gateways.user import (
+    LazyUserGateWay,
+    MentalDataDomain,
+    UserDomain,
+    UserWriteBatcher
+)
+
+
+class BatchGateWay:
+    def __init__(self, batches: list):
+        self._batches = batches
+
+    async def get_or_create_users(self, tg_ids: list[int]) -> dict[int, UserDomain]:
+        self._batches.append(tg_ids)
+
+        return {tg_id: UserDomain(id=tg_id + 1000, tg_id=tg_id, assistans=[]) for tg_id in tg_ids}
+
+    async def upsert_user_mentals(self, mentals: list[tuple[int, str, str]]) -> dict[int, UserDomain]:
+        self._batches.append(mentals)
+
+        return {
+            user_id: UserDomain(
+                id=user_id,
+                tg_id=user_id,
+                assistans=[],
+                mental=MentalDataDomain(id=1, user_id=user_id, temperament=temperament, profession=profession)
+            ) for user_id, temperament, profession in mentals
+        }
+
+    async def commit(self):
+        self._batches.append("commit")
+
+
+def make_batcher(batches: list, **kwargs) -> UserWriteBatcher:
+    @asynccontextmanager
+    async def scope():
+        yield BatchGateWay(batches)
+
+    return UserWriteBatcher(gateway_scope=scope, **kwargs)
+
+
+async def test_concurrent_writes_share_one_statement():
+    batches = []
+    batcher = make_batcher(batches)
+
+    users = await asyncio.gather(*[batcher.get_or_create_user(tg_id) for tg_id in range(5)])
+
+    assert [user.id for user in users] == [1000, 1001, 1002, 1003, 1004]
+    assert batches == [[0, 1, 2, 3, 4], "commit"]
+
+
+async def test_full_batch_is_written_without_the_window():
+    batches = []
+    batcher = make_batcher(batches, window=60, max_rows=2)
+
+    users = await asyncio.wait_for(
+        asyncio.gather(batcher.get_or_create_user(1), batcher.get_or_create_user(2)),
+        timeout=1
+    )
+
+    assert [user.tg_id for user in users] == [1, 2]
+
+
+async def test_later_values_of_a_key_win():
+    batches = []
+    batcher = make_batcher(batches)
+
+    first, second = await asyncio.gather(
+        batcher.upsert_user_mental(1, temperament="calm", profession="developer"),
+        batcher.upsert_user_mental(1, temperament="calm", profession="designer")
+    )
+
+    assert batches == [[(1, "calm", "designer")], "commit"]
+    assert first.mental.profession == second.mental.profession == "designer"
+
+
+async def test_failure_reaches_every_caller():
+    @asynccontextmanager
+    async def scope():
+        raise RuntimeError("no database")
+        yield
+
+    batcher = UserWriteBatcher(gateway_scope=scope)
+
+    results = await asyncio.gather(
+        batcher.get_or_create_user(1), batcher.get_or_create_user(2), return_exceptions=True
+    )
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+async def test_rows_are_written_in_the_order_of_their_keys():
+    batches = []
+    batcher = make_batcher(batches)
+
+    await asyncio.gather(*[batcher.get_or_create_user(tg_id) for tg_id in (3, 1, 2)])
+
+    assert batches == [[1, 2, 3], "commit"]
+
+
+async def test_bad_row_fails_only_its_caller():
+    class BadRowGateWay(BatchGateWay):
+        async def get_or_create_users(self, tg_ids: list[int]) -> dict[int, UserDomain]:
+            if -1 in tg_ids:
+                raise ValueError("bad tg id")
+
+            return await super().get_or_create_users(tg_ids)
+
+    batches = []
+
+    @asynccontextmanager
+    async def scope():
+        yield BadRowGateWay(batches)
+
+    batcher = UserWriteBatcher(gateway_scope=scope)
+
+    first, bad, second = await asyncio.gather(
+        batcher.get_or_create_user(1), batcher.get_or_create_user(-1), batcher.get_or_create_user(2),
+        return_exceptions=True
+    )
+
+    assert isinstance(bad, ValueError)
+    assert (first.tg_id, second.tg_id) == (1, 2)
+    assert batches == [[1], "commit", [2], "commit"]
+
+
+async def test_lazy_gateway_does_not_take_a_session_for_batched_writes():
+    batches = []
+    gateway = LazyUserGateWay(sessionmaker=pytest.fail, batcher=make_batcher(batches))
+
+    user = await gateway.get_or_create_user(7)
+    await gateway.commit()
+
+    assert user.tg_id == 7
+    assert not gateway.active